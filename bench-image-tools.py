@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+# Throughput benchmark of container-util and gpt-insert.
+#
+# Containers are created from sparse and dense payloads of each size and timed
+# end to end for --create, --verify and --roothash with each key type. Phase
+# timings are collected from the "dbg: time: PHASE: SECONDS s" debug output of
+# container-util. gpt-insert is timed for plain, incremental and finalize runs.
+#
+# Results are written as JSON and may be compared against an earlier run by
+# --compare, reporting operations slower than --tolerance.
+
+import sys
+import os
+import re
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import importlib.util
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from cryptography.hazmat.primitives.asymmetric import ec
+
+def load_test_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+test_container_util = load_test_module('test_container_util', os.path.join(HERE, 'test-container-util.py'))
+test_gpt_insert = load_test_module('test_gpt_insert', os.path.join(HERE, 'test-gpt-insert.py'))
+
+# Key types of test_key_types in test-container-util.py
+KEY_TYPES = {
+    'rsa-1024': lambda: test_container_util.generate_rsa_keypair(1024),
+    'rsa-2048': lambda: test_container_util.generate_rsa_keypair(2048),
+    'rsa-3072': lambda: test_container_util.generate_rsa_keypair(3072),
+    'rsa-4096': lambda: test_container_util.generate_rsa_keypair(4096),
+    'ec-secp192r1': lambda: test_container_util.generate_ec_keypair(ec.SECP192R1()),
+    'ec-secp224r1': lambda: test_container_util.generate_ec_keypair(ec.SECP224R1()),
+    'ec-secp256k1': lambda: test_container_util.generate_ec_keypair(ec.SECP256K1()),
+    'ec-secp256r1': lambda: test_container_util.generate_ec_keypair(ec.SECP256R1()),
+    'ec-secp384r1': lambda: test_container_util.generate_ec_keypair(ec.SECP384R1()),
+    'ec-secp521r1': lambda: test_container_util.generate_ec_keypair(ec.SECP521R1()),
+}
+
+PAYLOADS = ['sparse', 'dense']
+# Sparse payloads have 1 MiB of data every 64 MiB
+SPARSE_STRIDE = 64 << 20
+DATA_CHUNK = 1 << 20
+DENSE_CHUNK = 64 << 20
+
+TIME_RE = re.compile(r'^dbg: time: (\w+): ([0-9.]+) s$', re.MULTILINE)
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper().rstrip('B').rstrip('I')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def generate_payload(path, size, payload):
+    with open(path, mode='wb') as f:
+        f.truncate(size)
+        if payload == 'sparse':
+            for offset in range(0, size, SPARSE_STRIDE):
+                f.seek(offset)
+                f.write(os.urandom(min(DATA_CHUNK, size - offset)))
+        else:
+            # repeated random chunk, hashing throughput does not depend on uniqueness
+            chunk = os.urandom(min(DENSE_CHUNK, size))
+            for offset in range(0, size, len(chunk)):
+                f.write(chunk[:size - offset])
+
+def run(build, tool, args):
+    start = time.monotonic()
+    r = subprocess.run([os.path.join(build, tool)] + args, capture_output=True, text=True)
+    seconds = time.monotonic() - start
+    if r.returncode != 0:
+        raise RuntimeError('{} {} failed: {}'.format(tool, ' '.join(args), r.stdout + r.stderr))
+    phases = {}
+    for phase, value in TIME_RE.findall(r.stderr):
+        phases[phase] = phases.get(phase, 0.0) + float(value)
+    return seconds, phases
+
+def result(tool, operation, payload, size, seconds, phases, **extra):
+    entry = {'tool': tool, 'operation': operation, 'payload': payload, 'size': size,
+             'seconds': round(seconds, 6), 'mib_per_s': round(size / (1 << 20) / seconds, 3) if seconds else None,
+             'phases': {k: round(v, 6) for k, v in phases.items()}}
+    entry.update(extra)
+    return entry
+
+# Return best of repeat runs
+def best(repeat, fn):
+    runs = [fn() for _ in range(repeat)]
+    return min(runs, key=lambda x: x[0])
+
+def bench_container_util(args, workdir, keys, sizes):
+    results = []
+    for size in sizes:
+        for payload in args.payloads:
+            data = os.path.join(workdir, 'payload')
+            generate_payload(data, size, payload)
+            container = os.path.join(workdir, 'container')
+            for key_name, (private_key, public_key) in keys.items():
+                for threads in args.threads:
+                    shutil.copyfile(data, container)
+                    create = ['-d', '--create', '--force', '--keyfile', private_key, container]
+                    if threads is not None:
+                        create[1:1] = ['--threads', str(threads)]
+                    seconds, phases = best(args.repeat, lambda: run(args.build, 'container-util', create))
+                    results.append(result('container-util', 'create', payload, size, seconds, phases,
+                                          key=key_name, threads=threads))
+                for operation in ['verify', 'roothash']:
+                    seconds, phases = best(args.repeat, lambda: run(
+                        args.build, 'container-util', ['-d', '--' + operation, '--pubkey', public_key, container]))
+                    results.append(result('container-util', operation, payload, size, seconds, phases,
+                                          key=key_name))
+                print('container-util {} {} {}: done'.format(payload, size, key_name), file=sys.stderr)
+    return results
+
+def bench_gpt_insert(args, workdir, sizes):
+    results = []
+    for size in sizes:
+        for payload in args.payloads:
+            data = os.path.join(workdir, 'payload')
+            generate_payload(data, size, payload)
+            disk = os.path.join(workdir, 'disk.img')
+            bmap = os.path.join(workdir, 'disk.img.bmap')
+            sha256 = os.path.join(workdir, 'disk.img.sha256')
+            disk_size = size + (2 << 20)
+            test_gpt_insert.make_gpt(disk, disk_size, [('rootfs', 1 << 20, size)])
+            operations = [
+                ('insert', ['--label', 'rootfs', '--input', data, disk]),
+                ('incremental', ['--label', 'rootfs', '--input', data, '--incremental', disk]),
+                ('finalize', ['--finalize', '--bmap', bmap, '--sha256', sha256, disk]),
+            ]
+            for operation, gpt_args in operations:
+                seconds, phases = best(args.repeat, lambda: run(args.build, 'gpt-insert', gpt_args))
+                results.append(result('gpt-insert', operation, payload, size, seconds, phases))
+            print('gpt-insert {} {}: done'.format(payload, size), file=sys.stderr)
+    return results
+
+# Print operations slower than tolerance compared to baseline, return number of regressions
+def compare(baseline, current, tolerance):
+    def key(entry):
+        return (entry['tool'], entry['operation'], entry['payload'], entry['size'],
+                entry.get('key'), entry.get('threads'))
+    old = {key(entry): entry for entry in baseline['results']}
+    regressions = 0
+    for entry in current['results']:
+        previous = old.get(key(entry))
+        if previous is None or not previous['seconds']:
+            continue
+        ratio = entry['seconds'] / previous['seconds']
+        status = 'REGRESSION' if ratio > 1 + tolerance else 'ok'
+        if status != 'ok':
+            regressions += 1
+        print('{:10} {} {:.3f}s -> {:.3f}s ({:+.1f}%)'.format(
+            status, ' '.join(str(x) for x in key(entry) if x is not None),
+            previous['seconds'], entry['seconds'], (ratio - 1) * 100))
+    return regressions
+
+def git_describe():
+    r = subprocess.run(['git', 'describe', '--dirty', '--always', '--tags'], cwd=HERE,
+                       capture_output=True, text=True)
+    return r.stdout.strip() if r.returncode == 0 else None
+
+def main():
+    parser = ArgumentParser(description='''Benchmark container-util and gpt-insert throughput''',
+                                     epilog='''Return value:
+0 for success, 1 for failure or regressions found by --compare
+
+Sizes accept K, M and G suffixes (powers of 1024), for example
+--sizes 16M,1G,16G. Payload files up to the largest size are created in
+--workdir, which should be on the filesystem being measured.
+
+--threads selects hash tree builders for --create: "default" for libcryptsetup
+and a number for --threads N, for example --threads default,1,0.
+''',
+                                     formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--build', default=os.path.join(HERE, 'build'), help='Path to built tools')
+    parser.add_argument('--output', help='Write JSON results to file, default stdout')
+    parser.add_argument('--compare', help='JSON results of earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='Relative slowdown reported as regression, default 0.10')
+    parser.add_argument('--sizes', default='16M,256M', help='Comma separated payload sizes')
+    parser.add_argument('--payloads', default=','.join(PAYLOADS),
+                        help='Comma separated payload types: {}'.format(', '.join(PAYLOADS)))
+    parser.add_argument('--keys', default=','.join(KEY_TYPES),
+                        help='Comma separated key types, default all of: {}'.format(', '.join(KEY_TYPES)))
+    parser.add_argument('--threads', default='default,0', help='Comma separated --create tree builders')
+    parser.add_argument('--tools', default='container-util,gpt-insert', help='Comma separated tools to benchmark')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per operation, best is reported')
+    parser.add_argument('--workdir', help='Directory for payloads, default temporary directory')
+    args = parser.parse_args()
+
+    sizes = [parse_size(x) for x in args.sizes.split(',')]
+    args.payloads = args.payloads.split(',')
+    if any(x not in PAYLOADS for x in args.payloads):
+        raise ValueError('Invalid payload type in {}'.format(args.payloads))
+    key_names = args.keys.split(',')
+    if any(x not in KEY_TYPES for x in key_names):
+        raise ValueError('Invalid key type in {}'.format(key_names))
+    args.threads = [None if x == 'default' else int(x) for x in args.threads.split(',')]
+    tools = args.tools.split(',')
+    if args.repeat < 1:
+        raise ValueError('Invalid --repeat {}'.format(args.repeat))
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        output = {'commit': git_describe(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                  'host': {'machine': platform.machine(), 'cpus': os.cpu_count(),
+                           'python': platform.python_version()},
+                  'results': []}
+        if 'container-util' in tools:
+            keys = {}
+            for name in key_names:
+                private_pem, public_der = KEY_TYPES[name]()
+                keys[name] = (os.path.join(workdir, name + '.priv'), os.path.join(workdir, name + '.pub'))
+                test_container_util.write_file(keys[name][0], private_pem)
+                test_container_util.write_file(keys[name][1], public_der)
+            output['results'].extend(bench_container_util(args, workdir, keys, sizes))
+        if 'gpt-insert' in tools:
+            output['results'].extend(bench_gpt_insert(args, workdir, sizes))
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(baseline, output, args.tolerance):
+            sys.exit(1)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Error: {}'.format(e))
+    sys.exit(1)
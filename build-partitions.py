@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+FSTYPES = ('ext4', 'fat32')
+# Bumped when commands creating filesystems change, invalidating stamps
+STAMP_VERSION = 1
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+    with open(path, 'rb') as f:
+        while True:
+            bytes = f.readinto(buffer)
+            if not bytes:
+                break
+            digest.update(buffer[:bytes])
+    return digest.hexdigest()
+
+def file_identity(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+# Read partition description, list of partitions with name, label, fstype,
+# size_mib and optional archive, insert and update_container.
+def read_description(path):
+    with open(path, 'r') as f:
+        description = json.load(f)
+    return description.get('partitions', [])
+
+def parse_assignment(arg, option):
+    name, sep, value = arg.partition('=')
+    if not sep or not name or not value:
+        raise ValueError('Invalid {} "{}", expected NAME=PATH'.format(option, arg))
+    return name, value
+
+# Partitions given by --partition NAME LABEL FSTYPE SIZE_MIB with optional
+# --archive, --update-container and --no-insert of NAME. Returns list of
+# partitions as in description.
+def parse_partitions(args):
+    partitions = []
+    by_name = {}
+    for name, label, fstype, size_mib in args.partition:
+        try:
+            size_mib = int(size_mib)
+        except ValueError:
+            raise ValueError('Partition {} invalid size "{}"'.format(name, size_mib))
+        part = {'name': name, 'label': label, 'fstype': fstype, 'size_mib': size_mib}
+        partitions.append(part)
+        by_name.setdefault(name, part)
+    def lookup(name, option):
+        if name not in by_name:
+            raise ValueError('Argument {} of unknown partition {}'.format(option, name))
+        return by_name[name]
+    for arg in args.archive:
+        name, path = parse_assignment(arg, '--archive')
+        lookup(name, '--archive')['archive'] = path
+    for arg in args.update_container:
+        name, path = parse_assignment(arg, '--update-container')
+        lookup(name, '--update-container')['update_container'] = path
+    for name in args.no_insert:
+        lookup(name, '--no-insert')['insert'] = False
+    return partitions
+
+# Validate partitions of description and arguments
+def check_partitions(partitions):
+    names = set()
+    for part in partitions:
+        for key in ('name', 'label', 'fstype', 'size_mib'):
+            if key not in part:
+                raise ValueError('Partition {} missing "{}"'.format(part.get('name', '?'), key))
+        if part['fstype'] not in FSTYPES:
+            raise ValueError('Partition {} unsupported fstype "{}"'.format(part['name'], part['fstype']))
+        if part['name'] in names:
+            raise ValueError('Partition {} provided multiple times'.format(part['name']))
+        names.add(part['name'])
+
+def content_key(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+# Step of build graph. Steps with outputs are skipped if the stamp of a
+# previous build matches key, content of inputs and outputs are unmodified
+# since. Key may be callable if it depends on outputs of other steps.
+# Inputs are recorded in stamp by identity and sha256, content is only
+# hashed again if identity changed.
+class Step:
+    def __init__(self, name, commands, deps=(), outputs=(), key=None, inputs=()):
+        self.name = name
+        self.commands = commands
+        self.deps = list(deps)
+        self.outputs = list(outputs)
+        self.key = key
+        self.inputs = list(inputs)
+        # path: [identity, sha256] of inputs
+        self.digests = {}
+
+    def stamp_path(self):
+        return '{}.stamp'.format(self.outputs[0])
+
+    def stamp_key(self):
+        return self.key() if callable(self.key) else self.key
+
+    def up_to_date(self):
+        if self.key is None or not self.outputs:
+            return False
+        try:
+            with open(self.stamp_path(), 'r') as f:
+                stamp = json.load(f)
+            if (stamp.get('key') != self.stamp_key()
+                    or stamp.get('outputs') != [file_identity(x) for x in self.outputs]):
+                return False
+            recorded = stamp.get('inputs', {})
+            for path in self.inputs:
+                if path not in recorded:
+                    return False
+                identity, digest = recorded[path]
+                if identity != file_identity(path):
+                    identity = file_identity(path)
+                    if sha256_file(path) != digest:
+                        return False
+                self.digests[path] = [identity, digest]
+        except (OSError, ValueError):
+            return False
+        # Record identity of inputs modified without changing content
+        if any(self.digests[path] != recorded[path] for path in self.inputs):
+            self.write_stamp()
+        return True
+
+    def write_stamp(self):
+        if self.key is None or not self.outputs:
+            return
+        with open(self.stamp_path(), 'w') as f:
+            json.dump({'key': self.stamp_key(), 'outputs': [file_identity(x) for x in self.outputs],
+                       'inputs': self.digests}, f)
+
+def input_digests(inputs):
+    digests = {}
+    for path in inputs:
+        identity = file_identity(path)
+        digests[path] = [identity, sha256_file(path)]
+    return digests
+
+# Run commands of step in worker process, inputs are hashed before running
+# commands. Returns (name, seconds, output, digests), raises RuntimeError
+# with output on failure.
+def run_step(name, commands, env, inputs):
+    start = time.monotonic()
+    digests = input_digests(inputs)
+    output = []
+    for command in commands:
+        r = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        output.append(r.stdout)
+        if r.returncode != 0:
+            raise RuntimeError('Step {} failed: {}\n{}'.format(name, ' '.join(command), ''.join(output)))
+    return name, time.monotonic() - start, ''.join(output), digests
+
+# Run steps in process pool, each step as soon as all its dependencies are
+# done. A failed step fails all steps depending on it, independent steps
+# are completed. Raises RuntimeError if any step failed.
+def run_graph(steps, jobs, env, debug):
+    by_name = {step.name: step for step in steps}
+    for step in steps:
+        for dep in step.deps:
+            if dep not in by_name:
+                raise ValueError('Step {} depends on unknown step {}'.format(step.name, dep))
+    done = set()
+    failed = {}
+    waiting = list(steps)
+    running = {}
+    with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        while waiting or running:
+            for step in list(waiting):
+                if any(dep in failed for dep in step.deps):
+                    failed[step.name] = 'dependency failed'
+                    waiting.remove(step)
+                elif all(dep in done for dep in step.deps):
+                    waiting.remove(step)
+                    if step.up_to_date():
+                        print('{}: up to date'.format(step.name), flush=True)
+                        done.add(step.name)
+                    else:
+                        if debug:
+                            for command in step.commands:
+                                print('{}: {}'.format(step.name, ' '.join(command)), flush=True)
+                        running[executor.submit(run_step, step.name, step.commands, env, step.inputs)] = step
+            if not running:
+                # Steps resolved by up to date or failed dependencies are handled next pass
+                if waiting and not any(all(dep in done or dep in failed for dep in step.deps)
+                                       for step in waiting):
+                    raise ValueError('Dependency cycle in steps {}'.format(
+                        ', '.join(step.name for step in waiting)))
+                continue
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                step = running.pop(future)
+                try:
+                    name, seconds, output, step.digests = future.result()
+                except Exception as e:
+                    failed[step.name] = str(e)
+                    print(e, flush=True)
+                    continue
+                if debug and output:
+                    print(output, end='', flush=True)
+                step.write_stamp()
+                done.add(step.name)
+                print('{}: done in {:.1f} s'.format(step.name, seconds), flush=True)
+    if failed:
+        raise RuntimeError('Failed steps: {}'.format(', '.join(
+            '{} ({})'.format(name, reason) if reason == 'dependency failed' else name
+            for name, reason in failed.items())))
+
+def filesystem_commands(fsdir, fsimg, fstype, size_mib, archive):
+    shell = []
+    if archive:
+        shell.append('tar --numeric-owner -xf "$1" -C "$2"')
+    if fstype == 'ext4':
+        # Instruct mkfs to fully initialize file system now instead of first mount.
+        extra = 'assume_storage_prezeroed=0,lazy_itable_init=0,lazy_journal_init=0'
+        shell.append('truncate -s {} "$3"'.format(size_mib * 1024 * 1024))
+        shell.append('/usr/sbin/mkfs.ext4 -E {} -F -b 4096 "$3" -d "$2"'.format(extra))
+    else:
+        shell.append('/usr/sbin/mkfs.vfat -F 32 -C "$3" {}'.format(size_mib * 1024))
+        shell.append('if [ -n "$(ls -A "$2")" ]; then mcopy -i "$3" -smpQ "$2"/* ::/; fi')
+    return [['rm', '-rf', fsdir, fsimg],
+            ['mkdir', '-p', fsdir],
+            ['fakeroot', '--', '/bin/sh', '-c', ' && '.join(shell), 'sh', archive or '', fsdir, fsimg]]
+
+# Build graph of partition description. Filesystems are built in
+# parallel, each inserted in disk and packaged as update container as soon
+# as it is built.
+def make_steps(partitions, build, disk, key):
+    steps = []
+    for part in partitions:
+        name = part['name']
+        fsdir = os.path.join(build, name)
+        fsimg = os.path.join(build, 'partition.{}'.format(name))
+        archive = part.get('archive')
+        steps.append(Step('filesystem:{}'.format(name),
+                          filesystem_commands(fsdir, fsimg, part['fstype'], part['size_mib'], archive),
+                          outputs=[fsimg], inputs=[archive] if archive else [],
+                          key=content_key({'version': STAMP_VERSION, 'fstype': part['fstype'],
+                                           'size_mib': part['size_mib']})))
+        if part.get('insert', True):
+            if disk is None:
+                raise ValueError('Partition {} inserted without --disk'.format(name))
+            steps.append(Step('insert:{}'.format(name),
+                              [['gpt-insert', '--insert', '{}={}'.format(part['label'], fsimg),
+                                '--extent-map', '{}.extents'.format(fsimg), disk]],
+                              deps=['filesystem:{}'.format(name)]))
+        if part.get('update_container'):
+            if key is None:
+                raise ValueError('Partition {} update container requires --key'.format(name))
+            # Filesystem image identity is only known once built
+            steps.append(Step('update:{}'.format(name),
+                              [['make-image-container', '--build', os.path.join(build, 'update-{}'.format(name)),
+                                '--partitions', fsimg, '--key', key, part['update_container']]],
+                              deps=['filesystem:{}'.format(name)], outputs=[part['update_container']],
+                              key=lambda fsimg=fsimg: content_key({'version': STAMP_VERSION,
+                                                                   'partition': file_identity(fsimg),
+                                                                   'key': sha256_file(key)})))
+    return steps
+
+def main():
+    parser = ArgumentParser(description='''Build partition filesystem images in parallel''',
+                                     epilog='''Return value:
+0 for success, 1 for failure
+
+DESCRIPTION is a JSON file of partitions:
+  {"partitions": [{"name": "rootfs", "label": "rootfs1", "fstype": "ext4",
+                   "size_mib": 500, "archive": "image.tar.bz2",
+                   "update_container": "update.container"}]}
+
+Partitions may also be given without DESCRIPTION, the above as:
+  --partition rootfs rootfs1 ext4 500 --archive rootfs=image.tar.bz2
+  --update-container rootfs=update.container
+
+Each partition filesystem is built as BUILD/partition.NAME from the optional
+tar archive, by mkfs.ext4 or mkfs.vfat and mcopy in fakeroot. Filesystems are
+built concurrently in a process pool. As soon as a filesystem is built it is
+inserted in partition "label" of --disk by gpt-insert, writing extent map
+BUILD/partition.NAME.extents, unless "insert" is false, and packaged as update
+container if "update_container" is set.
+
+A built filesystem is recorded in BUILD/partition.NAME.stamp by a hash of its
+fstype, size and archive content. It is not built again while the stamp
+matches and the image is unmodified. The archive is hashed in the worker
+building the filesystem and only hashed again when checking the stamp if its
+size or mtime changed. Update containers are likewise only
+created again if the filesystem image or signing key changed.
+''',
+                                     formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('DESCRIPTION', nargs='?', help='Path to JSON partition description')
+    parser.add_argument('--partition', nargs=4, action='append', default=[],
+                        metavar=('NAME', 'LABEL', 'FSTYPE', 'SIZE_MIB'), help='Partition to build')
+    parser.add_argument('--archive', action='append', default=[], metavar='NAME=PATH',
+                        help='Tar archive extracted to partition NAME')
+    parser.add_argument('--update-container', action='append', default=[], metavar='NAME=PATH',
+                        help='Package partition NAME as update container')
+    parser.add_argument('--no-insert', action='append', default=[], metavar='NAME',
+                        help='Do not insert partition NAME in --disk')
+    parser.add_argument('-b', '--build', required=True, help='Path to build directory')
+    parser.add_argument('--disk', help='Path to disk image with partition table')
+    parser.add_argument('--key', help='Path to private key for signing update containers')
+    parser.add_argument('-p', '--path', default='', help='Additional $PATH for image-tools')
+    parser.add_argument('--jobs', type=int, default=0, help='Number of parallel steps, default one per CPU')
+    parser.add_argument('--debug', action='store_true', help='Print commands and their output')
+    args = parser.parse_args()
+
+    if args.jobs < 0:
+        raise ValueError('Invalid argument --jobs')
+    partitions = read_description(args.DESCRIPTION) if args.DESCRIPTION else []
+    partitions.extend(parse_partitions(args))
+    if not partitions:
+        raise ValueError('Mandatory argument DESCRIPTION or --partition missing')
+    check_partitions(partitions)
+    os.makedirs(args.build, exist_ok=True)
+    if shutil.which('fakeroot') is None:
+        raise RuntimeError('fakeroot not found')
+    env = dict(os.environ)
+    if args.path:
+        env['PATH'] = '{}:{}'.format(args.path, env.get('PATH', ''))
+    start = time.monotonic()
+    run_graph(make_steps(partitions, args.build, args.disk, args.key), args.jobs, env, args.debug)
+    print('Built in {:.1f} s'.format(time.monotonic() - start))
+    sys.exit(0)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Error: {}'.format(e))
+    sys.exit(1)
@@ -15,6 +15,8 @@
 #include <fcntl.h>
 #include <dirent.h>
 #include <sys/stat.h>
+#include <time.h>
+#include <pthread.h>
 #include <openssl/evp.h>
 #include <openssl/err.h>
 #include <openssl/x509.h>
@@ -22,6 +24,7 @@
 #include <openssl/provider.h>
 #include <openssl/store.h>
 #include <openssl/rsa.h>
+#include <openssl/rand.h>
 #include <libcryptsetup.h>
 
 /* return number of elements in array */
@@ -163,6 +166,10 @@ static void disable_info(void)
 #define pr_err(fmt, ...) \
 		if (1) {mprint(stderr, fmt, ##__VA_ARGS__);}
 
+/* Debug output of phase duration, "dbg: time: PHASE: SECONDS s" */
+#define pr_time(phase, start) \
+		pr_dbg("time: %s: %.6f s\n", phase, time_now() - (start))
+
 static void mprint(FILE* stream, const char* fmt, ...)
 {
 	va_list args;
@@ -171,6 +178,14 @@ static void mprint(FILE* stream, const char* fmt, ...)
 	va_end(args);
 }
 
+/* monotonic time in seconds */
+static double time_now(void)
+{
+	struct timespec ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (double) ts.tv_sec + ((double) ts.tv_nsec / 1e9);
+}
+
 struct header {
 	uint32_t magic;
 	uint8_t rsvd[28];
@@ -193,6 +208,7 @@ struct section {
 enum container_flags {
 	CONTAINER_NONE     = 0,
 	CONTAINER_VALID    = 1 << 0, /* container header validated */
+	CONTAINER_CACHED   = 1 << 1, /* validated by verification cache */
 };
 
 struct container {
@@ -204,6 +220,7 @@ struct container {
 	struct section header;
 	char *roothash;
 	EVP_PKEY *pkey;
+	char fingerprint[65]; /* sha256 of pubkey with verification cache */
 	int opt;
 };
 
@@ -270,7 +287,16 @@ static const char* evp_pkey_to_hash(const EVP_PKEY* pkey)
 
 static void dump_container(const struct container* container)
 {
-	const char* key_type = EVP_PKEY_get0_type_name(container->pkey);
+	/* pubkey is not parsed if validated by cache */
+	char key_desc[128];
+	if (container->pkey != NULL) {
+		const char* key_type = EVP_PKEY_get0_type_name(container->pkey);
+		snprintf(key_desc, sizeof(key_desc), "%s-%d + %s", key_type ? key_type : "unknown",
+				EVP_PKEY_get_bits(container->pkey), evp_pkey_to_hash(container->pkey));
+	}
+	else {
+		snprintf(key_desc, sizeof(key_desc), "%s", "cached");
+	}
 	printf("container:\n"
 			"  section   offset     size\n"
 			"  data:     %-10" PRIu64 " [%zu b]\n"
@@ -279,7 +305,7 @@ static void dump_container(const struct container* container)
 			"  pubkey:   %-10" PRIu64 " [%zu b]\n"
 			"  digest:   %-10" PRIu64 " [%zu b]\n"
 			"  header:   %-10" PRIu64 " [%zu b]\n"
-			"  key type: %s-%d + %s\n"
+			"  key type: %s\n"
 			"  roothash: %s\n",
 				container->data.offset, container->data.size,
 				container->tree.offset, container->tree.size,
@@ -287,8 +313,7 @@ static void dump_container(const struct container* container)
 				container->key.offset, container->key.size,
 				container->digest.offset, container->digest.size,
 				container->header.offset, container->header.size,
-				key_type ? key_type : "unknown", EVP_PKEY_get_bits(container->pkey),
-				evp_pkey_to_hash(container->pkey), container->roothash);
+				key_desc, container->roothash);
 }
 
 static void u32tole(uint32_t in, uint8_t* buf)
@@ -407,6 +432,81 @@ static int pread_bytes(int fd, off64_t offset, uint8_t* buf, size_t bytes)
 	return read_bytes(fd, buf, bytes);
 }
 
+/* positional read without moving file offset, safe for concurrent use of fd */
+static int pread_all(int fd, off64_t offset, uint8_t* buf, size_t size)
+{
+	while (size > 0) {
+		const ssize_t bytes = pread64(fd, buf, size, offset);
+		if (bytes < 0)
+			return -errno;
+		if (bytes == 0)
+			return -EIO;
+		size -= (size_t) bytes;
+		buf += bytes;
+		offset += bytes;
+	}
+	return 0;
+}
+
+/* positional write without moving file offset, safe for concurrent use of fd */
+static int pwrite_all(int fd, off64_t offset, const uint8_t* buf, size_t size)
+{
+	while (size > 0) {
+		const ssize_t bytes = pwrite64(fd, buf, size, offset);
+		if (bytes < 0)
+			return -errno;
+		if (bytes == 0)
+			return -EIO;
+		size -= (size_t) bytes;
+		buf += bytes;
+		offset += bytes;
+	}
+	return 0;
+}
+
+/*
+ * Copy size bytes between positions of files with copy_file_range(),
+ * sharing extents or copying in kernel where supported. Falls back to
+ * copying through a buffer if not supported between the files.
+ */
+static int copy_range(int infd, off64_t in_offset, int outfd, off64_t out_offset, size_t size)
+{
+	while (size > 0) {
+		const ssize_t bytes = copy_file_range(infd, &in_offset, outfd, &out_offset, size, 0);
+		if (bytes < 0) {
+			if (errno == EXDEV || errno == ENOSYS || errno == EINVAL || errno == EOPNOTSUPP)
+				break;
+			return -errno;
+		}
+		if (bytes == 0)
+			return -EIO;
+		size -= (size_t) bytes;
+	}
+	if (size == 0)
+		return 0;
+
+	pr_dbg("copy_file_range not supported, copying %zu bytes through buffer\n", size);
+	const size_t buf_size = 1024 * 1024;
+	uint8_t *buf = malloc(buf_size);
+	if (buf == NULL)
+		return -ENOMEM;
+	int r = 0;
+	while (size > 0) {
+		const size_t bytes = size < buf_size ? size : buf_size;
+		r = pread_all(infd, in_offset, buf, bytes);
+		if (r != 0)
+			break;
+		r = pwrite_all(outfd, out_offset, buf, bytes);
+		if (r != 0)
+			break;
+		size -= bytes;
+		in_offset += (off64_t) bytes;
+		out_offset += (off64_t) bytes;
+	}
+	free(buf);
+	return r;
+}
+
 static int error_cb(const char* input, size_t len, void* priv)
 {
 	(void) priv;
@@ -753,6 +853,327 @@ static int match_pubkey(const char* pubkey, const char* pubkey_dir, const char*
 	return -EBADF;
 }
 
+/*
+ * Verification cache of --cache-dir, only used by root.
+ *
+ * File "verified" lists containers with valid roothash signature, most
+ * recently used first, one line each:
+ *   DEV INO SIZE MTIME_SEC MTIME_NSEC ROOTHASH KEY_FINGERPRINT
+ * File "keys" indexes public key files of --pubkey and --pubkey-dir:
+ *   DEV INO SIZE MTIME_SEC MTIME_NSEC KEY_FINGERPRINT PATH
+ * with fingerprint "-" for a file without public keys. Fingerprint is the
+ * sha256 of the DER encoded public key.
+ *
+ * The cache directory and files are ignored unless owned by root and not
+ * writable by group or others.
+ */
+enum {
+	CACHE_ENTRIES       = 64,
+	CACHE_FILE_MAX      = 1024 * 1024,
+	CACHE_FP_SIZE       = 2 * 32 + 1, /* hex sha256 with null terminator */
+	CACHE_IDENTITY_SIZE = 128,
+};
+
+static int cache_trusted(const struct stat* st)
+{
+	return st->st_uid == 0 && (st->st_mode & (S_IWGRP | S_IWOTH)) == 0;
+}
+
+/* Return 0 if dir may be used as cache, created if missing */
+static int cache_open(const char* dir)
+{
+	if (geteuid() != 0)
+		return -EPERM;
+	if (mkdir(dir, 0700) != 0 && errno != EEXIST)
+		return -errno;
+	struct stat st;
+	if (lstat(dir, &st) != 0)
+		return -errno;
+	if (!S_ISDIR(st.st_mode))
+		return -ENOTDIR;
+	if (!cache_trusted(&st))
+		return -EPERM;
+	return 0;
+}
+
+/* Read cache file to null terminated buf, empty if missing or not trusted */
+static int cache_read(const char* dir, const char* name, char** buf)
+{
+	char *path = NULL;
+	if (asprintf(&path, "%s/%s", dir, name) < 0)
+		return -ENOMEM;
+
+	int r = 0;
+	size_t size = 0;
+	struct stat st;
+	const int fd = open(path, O_RDONLY | O_NOFOLLOW | O_CLOEXEC);
+	if (fd < 0) {
+		if (errno != ENOENT)
+			pr_dbg("%s: cache ignored: [%d] %s\n", path, errno, strerror(errno));
+	}
+	else if (fstat(fd, &st) != 0 || !S_ISREG(st.st_mode) || !cache_trusted(&st)
+			|| st.st_size > CACHE_FILE_MAX) {
+		pr_info("%s: cache ignored, not a regular root owned file\n", path);
+	}
+	else {
+		size = (size_t) st.st_size;
+	}
+
+	*buf = calloc(1, size + 1);
+	if (*buf == NULL)
+		r = -ENOMEM;
+	else if (size > 0 && pread_all(fd, 0, (uint8_t*) *buf, size) != 0)
+		(*buf)[0] = '\0';
+	/* stop at any null in file */
+	if (*buf != NULL)
+		(*buf)[size] = '\0';
+
+	if (fd >= 0)
+		close(fd);
+	free(path);
+	return r;
+}
+
+/* Replace cache file atomically */
+static int cache_write(const char* dir, const char* name, const char* buf, size_t size)
+{
+	char *tmppath = NULL;
+	char *path = NULL;
+	if (asprintf(&tmppath, "%s/.%s-XXXXXX", dir, name) < 0)
+		return -ENOMEM;
+	if (asprintf(&path, "%s/%s", dir, name) < 0) {
+		free(tmppath);
+		return -ENOMEM;
+	}
+
+	int r = 0;
+	const int fd = mkostemp(tmppath, O_CLOEXEC);
+	if (fd < 0) {
+		r = -errno;
+		goto exit;
+	}
+	r = write_bytes(fd, (const uint8_t*) buf, size);
+	close(fd);
+	if (r == 0 && rename(tmppath, path) != 0)
+		r = -errno;
+	if (r != 0)
+		unlink(tmppath);
+exit:
+	if (r != 0)
+		pr_info("%s: failed updating cache: [%d] %s\n", path, -r, strerror(-r));
+	free(tmppath);
+	free(path);
+	return r;
+}
+
+static void cache_identity(const struct stat* st, char* identity)
+{
+	snprintf(identity, CACHE_IDENTITY_SIZE, "%ju %ju %jd %jd %ld", (uintmax_t) st->st_dev,
+			(uintmax_t) st->st_ino, (intmax_t) st->st_size, (intmax_t) st->st_mtim.tv_sec,
+			st->st_mtim.tv_nsec);
+}
+
+static int cache_fingerprint(const uint8_t* der, size_t size, char* fp)
+{
+	uint8_t hash[32];
+	if (EVP_Digest(der, size, hash, NULL, EVP_sha256(), NULL) != 1)
+		return -EFAULT;
+	char *hex = crypt_bytes_to_hex(sizeof(hash), (const char*) hash);
+	if (hex == NULL)
+		return -ENOMEM;
+	snprintf(fp, CACHE_FP_SIZE, "%s", hex);
+	free(hex);
+	return 0;
+}
+
+/*
+ * Look up entry of "verified" and move it first. With insert the entry is
+ * added first, replacing entries of the same file, and the least recently
+ * used entries evicted. Return 1 if entry was cached, 0 if not or negative
+ * errno for error reading the cache.
+ */
+static int cache_verified(const char* dir, const char* entry, int insert)
+{
+	char *buf = NULL;
+	int r = cache_read(dir, "verified", &buf);
+	if (r != 0)
+		return r;
+
+	/* entries of same file share "DEV INO " prefix */
+	const char *ino_end = strchr(entry, ' ');
+	ino_end = ino_end != NULL ? strchr(ino_end + 1, ' ') : NULL;
+	const size_t file_prefix = ino_end != NULL ? (size_t) (ino_end - entry) + 1 : strlen(entry);
+
+	char *out = NULL;
+	size_t out_size = 0;
+	FILE *stream = open_memstream(&out, &out_size);
+	if (stream == NULL) {
+		free(buf);
+		return -ENOMEM;
+	}
+	fprintf(stream, "%s\n", entry);
+
+	int found = 0;
+	int first = 1;
+	int moved = 0;
+	size_t entries = 1;
+	char *save = NULL;
+	for (char *line = strtok_r(buf, "\n", &save); line != NULL; line = strtok_r(NULL, "\n", &save)) {
+		if (strcmp(line, entry) == 0) {
+			found = 1;
+			moved = !first;
+		}
+		else if ((!insert || strncmp(line, entry, file_prefix) != 0) && entries < CACHE_ENTRIES) {
+			fprintf(stream, "%s\n", line);
+			entries++;
+		}
+		first = 0;
+	}
+	fclose(stream);
+
+	/* only write if order or content changed, failure is not fatal */
+	if ((found && moved) || (!found && insert))
+		cache_write(dir, "verified", out, out_size);
+	free(out);
+	free(buf);
+	return found;
+}
+
+/*
+ * Write index lines of key file at path to stream, from index if file is
+ * unmodified, else by parsing the file unless parse is 0.
+ * Return 1 if a key matches fp, else 0.
+ */
+static int cache_index_key_file(const char* path, char* index, FILE* stream, const char* fp, int parse)
+{
+	struct stat st;
+	if (stat(path, &st) != 0 || !S_ISREG(st.st_mode))
+		return 0;
+	char identity[CACHE_IDENTITY_SIZE];
+	cache_identity(&st, identity);
+	const size_t identity_size = strlen(identity);
+
+	/* lines of file in index, "IDENTITY FP PATH" */
+	int indexed = 0;
+	int match = 0;
+	for (char *line = index; line != NULL && *line != '\0';) {
+		char *end = strchr(line, '\n');
+		if (end != NULL)
+			*end = '\0';
+		if (strncmp(line, identity, identity_size) == 0 && line[identity_size] == ' ') {
+			const char *line_fp = line + identity_size + 1;
+			const char *line_path = strchr(line_fp, ' ');
+			if (line_path != NULL && strcmp(line_path + 1, path) == 0) {
+				indexed = 1;
+				fprintf(stream, "%s\n", line);
+				if ((size_t) (line_path - line_fp) == strlen(fp) && strncmp(line_fp, fp, strlen(fp)) == 0)
+					match = 1;
+			}
+		}
+		if (end != NULL)
+			*end = '\n';
+		line = end != NULL ? end + 1 : NULL;
+	}
+	if (indexed || !parse)
+		return match;
+
+	struct read_pkey_ctx ctx;
+	if (read_pkey_ctx_create(&ctx, path, NULL, READ_PKEY_TYPE_PUB) != 0)
+		return 0;
+	/* path is last field of line, paths with newline are not indexed */
+	const int index_path = strchr(path, '\n') == NULL;
+	int keys = 0;
+	EVP_PKEY *pkey = NULL;
+	char *name = NULL;
+	while (read_pkey(&ctx, &pkey, &name) == 0) {
+		uint8_t *der = NULL;
+		const int der_size = i2d_PUBKEY(pkey, (unsigned char**) &der);
+		EVP_PKEY_free(pkey);
+		pkey = NULL;
+		char key_fp[CACHE_FP_SIZE];
+		if (der_size < 0 || cache_fingerprint(der, (size_t) der_size, key_fp) != 0) {
+			OPENSSL_free(der);
+			continue;
+		}
+		OPENSSL_free(der);
+		keys++;
+		if (index_path)
+			fprintf(stream, "%s %s %s\n", identity, key_fp, path);
+		if (strcmp(key_fp, fp) == 0)
+			match = 1;
+	}
+	read_pkey_ctx_free(&ctx);
+	if (keys == 0 && index_path)
+		fprintf(stream, "%s - %s\n", identity, path);
+	return match;
+}
+
+/*
+ * As match_pubkey() but matching fingerprint fp of container pubkey to
+ * index of key files in cache. Only new or modified key files are parsed,
+ * the index is rewritten if changed.
+ */
+static int cache_match_pubkey(const char* dir, const char* pubkey, const char* pubkey_dir, const char* fp)
+{
+	char *index = NULL;
+	int r = cache_read(dir, "keys", &index);
+	if (r != 0)
+		return r;
+
+	char *out = NULL;
+	size_t out_size = 0;
+	FILE *stream = open_memstream(&out, &out_size);
+	if (stream == NULL) {
+		free(index);
+		return -ENOMEM;
+	}
+
+	const char *matched = NULL;
+	char *path = NULL;
+	if (pubkey != NULL && cache_index_key_file(pubkey, index, stream, fp, 1) == 1)
+		matched = pubkey;
+
+	if (pubkey_dir != NULL) {
+		DIR *pdir = opendir(pubkey_dir);
+		if (pdir == NULL) {
+			pr_dbg("%s: failed opendir: [%d] %s\n", pubkey_dir, errno, strerror(errno));
+		}
+		else {
+			struct dirent *entry = NULL;
+			while ((entry = readdir(pdir)) != NULL) {
+				char *entry_path = NULL;
+				if (asprintf(&entry_path, "%s/%s", pubkey_dir, entry->d_name) < 0) {
+					r = -ENOMEM;
+					break;
+				}
+				/* after match keep unmodified index lines without parsing */
+				if (cache_index_key_file(entry_path, index, stream, fp, matched == NULL) == 1
+						&& matched == NULL) {
+					matched = path = entry_path;
+					continue;
+				}
+				free(entry_path);
+			}
+			closedir(pdir);
+		}
+	}
+	fclose(stream);
+
+	if (strcmp(out, index) != 0)
+		cache_write(dir, "keys", out, out_size);
+	if (matched != NULL) {
+		pr_info("%s: pubkey used for validation\n", matched);
+		r = 0;
+	}
+	else if (r == 0) {
+		r = -EBADF;
+	}
+	free(path);
+	free(out);
+	free(index);
+	return r;
+}
+
 /* buf must be of size HEADER_SIZE */
 static int create_container_header(struct container* container, uint8_t* buf, size_t size)
 {
@@ -1013,10 +1434,13 @@ struct region {
 	uint8_t **data;
 };
 
-static int read_container(struct container* container, int fd)
+/* cache_dir is optional verification cache */
+static int read_container(struct container* container, int fd, const char* cache_dir)
 {
 	/* read header */
+	double start = time_now();
 	int r = read_container_header(fd, container);
+	pr_time("header", start);
 	switch (r) {
 	case 0:
 		break;
@@ -1059,7 +1483,32 @@ static int read_container(struct container* container, int fd)
 		}
 	}
 
+	/* look up verification cache by file identity, roothash and pubkey */
+	char entry[CACHE_IDENTITY_SIZE + 256];
+	entry[0] = '\0';
+	if (cache_dir != NULL) {
+		start = time_now();
+		struct stat st;
+		const size_t roothash_size = strlen(container->roothash);
+		if (fstat(fd, &st) == 0 && roothash_size > 0 && roothash_size <= 128
+				&& strspn(container->roothash, "0123456789abcdef") == roothash_size
+				&& cache_fingerprint(pubkey, container->key.size, container->fingerprint) == 0) {
+			char identity[CACHE_IDENTITY_SIZE];
+			cache_identity(&st, identity);
+			snprintf(entry, sizeof(entry), "%s %s %s", identity, container->roothash, container->fingerprint);
+			const int cached = cache_verified(cache_dir, entry, 0);
+			pr_time("cache_lookup", start);
+			if (cached == 1) {
+				container->opt |= CONTAINER_VALID | CONTAINER_CACHED;
+				pr_dbg("container - valid, cached\n");
+				r = 0;
+				goto exit;
+			}
+		}
+	}
+
 	/* parse pubkey */
+	start = time_now();
 	r = parse_public_key(pubkey, container->key.size, &container->pkey);
 	if (r != 0) {
 		pr_dbg("container - pubkey: [%d]: %s\n", -r, strerror(-r));
@@ -1068,10 +1517,13 @@ static int read_container(struct container* container, int fd)
 
 	/* validate roothash signature */
 	r = verify_digest((uint8_t*) container->roothash, container->root.size, digest, container->digest.size, container->pkey);
+	pr_time("digest_verify", start);
 	switch (r) {
 	case 1:
 		container->opt |= CONTAINER_VALID;
 		pr_dbg("container - valid\n");
+		if (entry[0] != '\0')
+			cache_verified(cache_dir, entry, 1);
 		break;
 	case 0:
 		container->opt &= ~CONTAINER_VALID;
@@ -1240,45 +1692,392 @@ exit:
 	return r;
 }
 
-static int cat_container(const struct container* container, int fd, int treefd, uint8_t* roothash, uint8_t* digest, uint8_t* pubkey, uint8_t* header)
+/*
+ * Parallel dm-verity hash tree builder.
+ *
+ * Produces the same superblock and tree as verity_create() with
+ * libcryptsetup: format version 1, sha256, 4096 byte data and hash blocks
+ * and 32 byte salt. Superblock is placed in the first hash block and the
+ * hash levels follow with the top level first. Each level is split in
+ * ranges of whole output hash blocks hashed by worker threads.
+ */
+enum {
+	VERITY_BLOCK_SIZE     = 4096,
+	VERITY_DIGEST_SIZE    = 32,
+	VERITY_SALT_SIZE      = 32,
+	VERITY_SB_SIZE        = 512,
+	VERITY_HASH_PER_BLOCK = VERITY_BLOCK_SIZE / VERITY_DIGEST_SIZE,
+	VERITY_HASH_BITS      = 7, /* log2(VERITY_HASH_PER_BLOCK) */
+	VERITY_MAX_LEVELS     = 63,
+	VERITY_CHUNK_BLOCKS   = 256, /* input blocks read per iteration */
+};
+_Static_assert(VERITY_HASH_PER_BLOCK == 1 << VERITY_HASH_BITS, "verity hash bits unexpected\n");
+
+struct verity_level {
+	int infd;
+	off64_t in_offset;    /* offset of input blocks */
+	uint64_t in_blocks;   /* number of input blocks */
+	int outfd;
+	off64_t out_offset;   /* offset of output hash blocks */
+	const uint8_t *salt;
+};
+
+struct verity_job {
+	const struct verity_level *level;
+	uint64_t first;       /* first output hash block */
+	uint64_t count;       /* number of output hash blocks */
+	int r;
+};
+
+static int verity_hash_block(EVP_MD_CTX* ctx, const EVP_MD_CTX* salted, const uint8_t* block, uint8_t* out)
+{
+	if (EVP_MD_CTX_copy_ex(ctx, salted) != 1
+			|| EVP_DigestUpdate(ctx, block, VERITY_BLOCK_SIZE) != 1
+			|| EVP_DigestFinal_ex(ctx, out, NULL) != 1)
+		return -EFAULT;
+	return 0;
+}
+
+static void* verity_worker(void* arg)
 {
+	struct verity_job *job = arg;
+	const struct verity_level *level = job->level;
+	uint8_t *in = malloc((size_t) VERITY_CHUNK_BLOCKS * VERITY_BLOCK_SIZE);
+	uint8_t *out = calloc(VERITY_CHUNK_BLOCKS / VERITY_HASH_PER_BLOCK, VERITY_BLOCK_SIZE);
+	EVP_MD_CTX *salted = EVP_MD_CTX_new();
+	EVP_MD_CTX *ctx = EVP_MD_CTX_new();
 	int r = 0;
-	uint8_t *buf = NULL;
 
-	/* position output at end of file */
-	if (lseek64(fd, 0, SEEK_END) < 0) {
-		r = -errno;
-		pr_err("failed seeking file [%d]: %s\n", -r, strerror(-r));
+	if (in == NULL || out == NULL || salted == NULL || ctx == NULL) {
+		r = -ENOMEM;
+		goto exit;
+	}
+	if (EVP_DigestInit_ex(salted, EVP_sha256(), NULL) != 1
+			|| EVP_DigestUpdate(salted, level->salt, VERITY_SALT_SIZE) != 1) {
+		r = -EFAULT;
 		goto exit;
 	}
 
-	/* position tree at start of file */
-	if (lseek64(treefd, 0, SEEK_SET) < 0) {
-		r = -errno;
-		pr_err("failed seeking tree [%d]: %s\n", -r, strerror(-r));
+	uint64_t block = job->first * VERITY_HASH_PER_BLOCK;
+	const uint64_t end = (job->first + job->count) * VERITY_HASH_PER_BLOCK < level->in_blocks ?
+			(job->first + job->count) * VERITY_HASH_PER_BLOCK : level->in_blocks;
+	while (block < end) {
+		const uint64_t blocks = end - block < VERITY_CHUNK_BLOCKS ? end - block : VERITY_CHUNK_BLOCKS;
+		r = pread_all(level->infd, level->in_offset + (off64_t) (block * VERITY_BLOCK_SIZE),
+				in, blocks * VERITY_BLOCK_SIZE);
+		if (r != 0)
+			goto exit;
+		/* last hash block of level is zero padded */
+		const uint64_t out_blocks = (blocks + VERITY_HASH_PER_BLOCK - 1) / VERITY_HASH_PER_BLOCK;
+		memset(out, 0, out_blocks * VERITY_BLOCK_SIZE);
+		for (uint64_t i = 0; i < blocks; ++i) {
+			r = verity_hash_block(ctx, salted, in + i * VERITY_BLOCK_SIZE, out + i * VERITY_DIGEST_SIZE);
+			if (r != 0)
+				goto exit;
+		}
+		r = pwrite_all(level->outfd, level->out_offset
+				+ (off64_t) (block / VERITY_HASH_PER_BLOCK * VERITY_BLOCK_SIZE),
+				out, out_blocks * VERITY_BLOCK_SIZE);
+		if (r != 0)
+			goto exit;
+		block += blocks;
+	}
+
+	r = 0;
+exit:
+	EVP_MD_CTX_free(ctx);
+	EVP_MD_CTX_free(salted);
+	free(out);
+	free(in);
+	job->r = r;
+	return NULL;
+}
+
+/* Hash level in parallel by splitting output hash blocks between threads */
+static int verity_hash_level(const struct verity_level* level, unsigned int threads)
+{
+	const uint64_t out_blocks = (level->in_blocks + VERITY_HASH_PER_BLOCK - 1) / VERITY_HASH_PER_BLOCK;
+	if (threads > out_blocks)
+		threads = (unsigned int) out_blocks;
+	if (threads == 0)
+		threads = 1;
+
+	struct verity_job *jobs = calloc(threads, sizeof(*jobs));
+	pthread_t *tids = calloc(threads, sizeof(*tids));
+	if (jobs == NULL || tids == NULL) {
+		free(jobs);
+		free(tids);
+		return -ENOMEM;
+	}
+
+	int r = 0;
+	unsigned int started = 0;
+	uint64_t first = 0;
+	for (unsigned int i = 0; i < threads; ++i) {
+		jobs[i].level = level;
+		jobs[i].first = first;
+		jobs[i].count = out_blocks / threads + (i < out_blocks % threads ? 1 : 0);
+		first += jobs[i].count;
+		const int err = pthread_create(&tids[i], NULL, verity_worker, &jobs[i]);
+		if (err != 0) {
+			r = -err;
+			pr_err("pthread_create: [%d] %s\n", err, strerror(err));
+			break;
+		}
+		started++;
+	}
+	for (unsigned int i = 0; i < started; ++i) {
+		pthread_join(tids[i], NULL);
+		if (r == 0 && jobs[i].r != 0)
+			r = jobs[i].r;
+	}
+
+	free(jobs);
+	free(tids);
+	return r;
+}
+
+static void verity_create_sb(uint8_t* sb, const uint8_t* uuid, uint64_t data_blocks, const uint8_t* salt)
+{
+	memset(sb, 0, VERITY_SB_SIZE);
+	memcpy(sb, "verity\0\0", 8);
+	u32tole(1, sb + 8);                    /* version */
+	u32tole(1, sb + 12);                   /* hash_type */
+	memcpy(sb + 16, uuid, 16);
+	memcpy(sb + 32, "sha256", 6);          /* algorithm[32] */
+	u32tole(VERITY_BLOCK_SIZE, sb + 64);   /* data_block_size */
+	u32tole(VERITY_BLOCK_SIZE, sb + 68);   /* hash_block_size */
+	u64tole(data_blocks, sb + 72);
+	sb[80] = VERITY_SALT_SIZE & 0xff;      /* salt_size, u16 */
+	sb[81] = (VERITY_SALT_SIZE >> 8) & 0xff;
+	memcpy(sb + 88, salt, VERITY_SALT_SIZE); /* salt[256] */
+}
+
+/* same random salt and uuid (version 4) as libcryptsetup */
+static int verity_create_salt(uint8_t* salt, uint8_t* uuid)
+{
+	ERR_clear_error();
+	if (RAND_bytes(salt, VERITY_SALT_SIZE) != 1 || RAND_bytes(uuid, 16) != 1) {
+		pr_err("failed generating salt\n");
+		ERR_print_errors_cb(error_cb, NULL);
+		return -EFAULT;
+	}
+	uuid[6] = (uuid[6] & 0x0f) | 0x40;
+	uuid[8] = (uuid[8] & 0x3f) | 0x80;
+	return 0;
+}
+
+/*
+ * Create superblock, hash levels and roothash of data_blocks of datafd.
+ * If leaffd is valid it holds the already hashed level 0, zero padded to
+ * whole hash blocks, which is copied to tree instead of hashing datafd.
+ */
+static int verity_create_tree(int datafd, int leaffd, uint64_t data_blocks, int treefd, unsigned int threads,
+		const uint8_t* salt, const uint8_t* uuid, char** roothash)
+{
+	/* number of levels and level sizes as calculated by libcryptsetup */
+	int levels = 0;
+	while (VERITY_HASH_BITS * levels < 64 && ((data_blocks - 1) >> (VERITY_HASH_BITS * levels)) != 0)
+		levels++;
+	if (levels > VERITY_MAX_LEVELS)
+		return -EINVAL;
+	uint64_t level_start[VERITY_MAX_LEVELS];
+	uint64_t position = 1; /* first block holds superblock */
+	for (int i = levels - 1; i >= 0; --i) {
+		level_start[i] = position;
+		const int shift = (i + 1) * VERITY_HASH_BITS;
+		position += (data_blocks + ((uint64_t) 1 << shift) - 1) >> shift;
+	}
+	pr_dbg("verity: data blocks %" PRIu64 ", levels %d, hash blocks %" PRIu64 ", threads %u\n",
+			data_blocks, levels, position - 1, threads);
+
+	/* tree spans whole hash blocks, also when only holding the superblock */
+	if (ftruncate64(treefd, (off64_t) (position * VERITY_BLOCK_SIZE)) != 0)
+		return -errno;
+	uint8_t sb[VERITY_SB_SIZE];
+	verity_create_sb(sb, uuid, data_blocks, salt);
+	int r = pwrite_all(treefd, 0, sb, sizeof(sb));
+	if (r != 0)
+		return r;
+
+	/* hash levels bottom up, level 0 from data */
+	uint64_t in_blocks = data_blocks;
+	for (int i = 0; i < levels; ++i) {
+		const struct verity_level level = {
+			.infd = i == 0 ? datafd : treefd,
+			.in_offset = i == 0 ? 0 : (off64_t) (level_start[i - 1] * VERITY_BLOCK_SIZE),
+			.in_blocks = in_blocks,
+			.outfd = treefd,
+			.out_offset = (off64_t) (level_start[i] * VERITY_BLOCK_SIZE),
+			.salt = salt,
+		};
+		if (i == 0 && leaffd >= 0) {
+			const uint64_t out_blocks = (in_blocks + VERITY_HASH_PER_BLOCK - 1) / VERITY_HASH_PER_BLOCK;
+			r = copy_range(leaffd, 0, treefd, level.out_offset, out_blocks * VERITY_BLOCK_SIZE);
+		}
+		else {
+			r = verity_hash_level(&level, threads);
+		}
+		if (r != 0) {
+			pr_err("verity: failed hashing level %d: [%d] %s\n", i, -r, strerror(-r));
+			return r;
+		}
+		in_blocks = (in_blocks + VERITY_HASH_PER_BLOCK - 1) / VERITY_HASH_PER_BLOCK;
+	}
+
+	/* roothash of top level block, or of single data block */
+	uint8_t *top = malloc(VERITY_BLOCK_SIZE);
+	EVP_MD_CTX *salted = EVP_MD_CTX_new();
+	EVP_MD_CTX *ctx = EVP_MD_CTX_new();
+	uint8_t hash[VERITY_DIGEST_SIZE];
+	if (top == NULL || salted == NULL || ctx == NULL) {
+		r = -ENOMEM;
+		goto exit;
+	}
+	r = levels == 0 ? pread_all(datafd, 0, top, VERITY_BLOCK_SIZE)
+			: pread_all(treefd, (off64_t) (level_start[levels - 1] * VERITY_BLOCK_SIZE), top, VERITY_BLOCK_SIZE);
+	if (r != 0)
+		goto exit;
+	if (EVP_DigestInit_ex(salted, EVP_sha256(), NULL) != 1
+			|| EVP_DigestUpdate(salted, salt, VERITY_SALT_SIZE) != 1
+			|| verity_hash_block(ctx, salted, top, hash) != 0) {
+		r = -EFAULT;
+		goto exit;
+	}
+	*roothash = crypt_bytes_to_hex(sizeof(hash), (const char*) hash);
+	if (*roothash == NULL) {
+		r = -ENOMEM;
 		goto exit;
 	}
 
-	/* write tree to output */
-	ssize_t bytes = 0;
-	const size_t buf_size = 4096;
-	buf = malloc(buf_size);
-	if (buf == NULL) {
+	r = 0;
+exit:
+	EVP_MD_CTX_free(ctx);
+	EVP_MD_CTX_free(salted);
+	free(top);
+	return r;
+}
+
+static int verity_create_parallel(int datafd, int treefd, unsigned int threads, char** roothash)
+{
+	const off64_t data_size = lseek64(datafd, 0, SEEK_END);
+	if (data_size < 0)
+		return -errno;
+	if (data_size == 0 || data_size % VERITY_BLOCK_SIZE != 0)
+		return -EINVAL;
+
+	uint8_t salt[VERITY_SALT_SIZE];
+	uint8_t uuid[16];
+	const int r = verity_create_salt(salt, uuid);
+	if (r != 0)
+		return r;
+	return verity_create_tree(datafd, -1, (uint64_t) data_size / VERITY_BLOCK_SIZE, treefd, threads,
+			salt, uuid, roothash);
+}
+
+/*
+ * Stream data from infd to datafd and hash level 0 in the same pass, while
+ * the producer of infd is still writing. Leaf hashes are written to leaffd
+ * and the upper levels created from them once input ends, without reading
+ * back the data. A partial last data block is zero padded.
+ */
+static int verity_create_stream(int infd, int datafd, int leaffd, int treefd, unsigned int threads, char** roothash)
+{
+	uint8_t salt[VERITY_SALT_SIZE];
+	uint8_t uuid[16];
+	int r = verity_create_salt(salt, uuid);
+	if (r != 0)
+		return r;
+
+	const size_t in_size = (size_t) VERITY_CHUNK_BLOCKS * VERITY_BLOCK_SIZE;
+	uint8_t *in = malloc(in_size);
+	uint8_t *out = malloc((size_t) VERITY_CHUNK_BLOCKS * VERITY_DIGEST_SIZE);
+	EVP_MD_CTX *salted = EVP_MD_CTX_new();
+	EVP_MD_CTX *ctx = EVP_MD_CTX_new();
+	if (in == NULL || out == NULL || salted == NULL || ctx == NULL) {
 		r = -ENOMEM;
 		goto exit;
 	}
-	while ((bytes = read(treefd, buf, buf_size)) > 0 ) {
-		r = write_bytes(fd, buf, bytes);
+	if (EVP_DigestInit_ex(salted, EVP_sha256(), NULL) != 1
+			|| EVP_DigestUpdate(salted, salt, sizeof(salt)) != 1) {
+		r = -EFAULT;
+		goto exit;
+	}
+
+	uint64_t data_blocks = 0;
+	int eof = 0;
+	while (!eof) {
+		/* fill chunk, pipes return partial reads */
+		size_t filled = 0;
+		while (filled < in_size) {
+			const ssize_t bytes = read(infd, in + filled, in_size - filled);
+			if (bytes < 0) {
+				if (errno == EINTR)
+					continue;
+				r = -errno;
+				pr_err("failed reading input: [%d] %s\n", -r, strerror(-r));
+				goto exit;
+			}
+			if (bytes == 0) {
+				eof = 1;
+				break;
+			}
+			filled += (size_t) bytes;
+		}
+		if (filled % VERITY_BLOCK_SIZE != 0) {
+			const size_t padding = VERITY_BLOCK_SIZE - filled % VERITY_BLOCK_SIZE;
+			pr_info("WARNING: padding FILE by %zu\n", padding);
+			memset(in + filled, 0, padding);
+			filled += padding;
+		}
+		if (filled == 0)
+			break;
+
+		r = write_bytes(datafd, in, filled);
 		if (r != 0) {
-			pr_err("failed writing to file: [%d] %s\n", -r, strerror(-r));
+			pr_err("failed writing to FILE: [%d] %s\n", -r, strerror(-r));
 			goto exit;
 		}
+		const size_t blocks = filled / VERITY_BLOCK_SIZE;
+		for (size_t i = 0; i < blocks; ++i) {
+			r = verity_hash_block(ctx, salted, in + i * VERITY_BLOCK_SIZE, out + i * VERITY_DIGEST_SIZE);
+			if (r != 0)
+				goto exit;
+		}
+		r = write_bytes(leaffd, out, blocks * VERITY_DIGEST_SIZE);
+		if (r != 0)
+			goto exit;
+		data_blocks += blocks;
+	}
+	if (data_blocks == 0) {
+		pr_err("no input data\n");
+		r = -EINVAL;
+		goto exit;
 	}
-	if (bytes < 0) {
+
+	/* last hash block of level 0 is zero padded */
+	const uint64_t leaf_blocks = (data_blocks + VERITY_HASH_PER_BLOCK - 1) / VERITY_HASH_PER_BLOCK;
+	if (ftruncate64(leaffd, (off64_t) (leaf_blocks * VERITY_BLOCK_SIZE)) != 0) {
 		r = -errno;
-		pr_err("failed reading tree [%d]: %s\n", -r, strerror(-r));
 		goto exit;
 	}
+	r = verity_create_tree(datafd, leaffd, data_blocks, treefd, threads, salt, uuid, roothash);
+exit:
+	EVP_MD_CTX_free(ctx);
+	EVP_MD_CTX_free(salted);
+	free(out);
+	free(in);
+	return r;
+}
+
+static int cat_container(const struct container* container, int fd, int treefd, uint8_t* roothash, uint8_t* digest, uint8_t* pubkey, uint8_t* header)
+{
+	/* append tree to output without copying through user space */
+	int r = copy_range(treefd, 0, fd, container->tree.offset, container->tree.size);
+	if (r != 0) {
+		pr_err("failed writing tree to file: [%d] %s\n", -r, strerror(-r));
+		return r;
+	}
 
 	/* write metadata */
 	const struct region regions[] = {
@@ -1292,30 +2091,36 @@ static int cat_container(const struct container* container, int fd, int treefd,
 		r = pwrite_bytes(fd, regions[i].offset, *(regions[i].data), regions[i].size);
 		if (r != 0) {
 			pr_err("failed writing to FILE: [%d] %s\n", -r, strerror(-r));
-			goto exit;
+			return r;
 		}
 	}
 
-	r = 0;
-exit:
-	if (buf != NULL)
-		free(buf);
-	return r;
+	return 0;
 }
 
-static int write_container(int fd, const char* path, EVP_PKEY* pkey, struct container* container)
+/*
+ * threads 0 creates tree with libcryptsetup, else with verity_create_parallel().
+ * If infd is valid FILE data is streamed from it by verity_create_stream().
+ */
+static int write_container(int fd, int infd, const char* path, EVP_PKEY* pkey, unsigned int threads, struct container* container)
 {
 	char tmppath[] = "/tmp/ctutil-XXXXXX";
+	char leafpath[] = "/tmp/ctutil-XXXXXX";
 	uint8_t *pubkey_buf = NULL;
 	uint8_t *digest = NULL;
 	int r = 0;
 	int tmpfd = -1;
+	int leaffd = -1;
 
 	/* fd size must be padded to multiples of 4096 */
-	r = padto_multiple_of(fd, 4096);
-	if (r != 0) {
-		pr_err("%s: failed padding: [%d]: %s\n", path, -r, strerror(-r));
-		goto exit;
+	double start = time_now();
+	if (infd < 0) {
+		r = padto_multiple_of(fd, 4096);
+		pr_time("pad", start);
+		if (r != 0) {
+			pr_err("%s: failed padding: [%d]: %s\n", path, -r, strerror(-r));
+			return r;
+		}
 	}
 
 	/* create temp-file for hash tree output */
@@ -1326,8 +2131,25 @@ static int write_container(int fd, const char* path, EVP_PKEY* pkey, struct cont
 		return r;
 	}
 
+	/* create temp-file for leaf hashes while streaming */
+	if (infd >= 0) {
+		leaffd = mkostemp(leafpath, O_CLOEXEC);
+		if (leaffd < 0) {
+			r = -errno;
+			pr_err("mktmp: [%d] %s\n", -r, strerror(-r));
+			goto exit;
+		}
+	}
+
 	/* verity create */
-	r = verity_create(path, tmppath, &container->roothash);
+	start = time_now();
+	if (infd >= 0)
+		r = verity_create_stream(infd, fd, leaffd, tmpfd, threads > 0 ? threads : 1, &container->roothash);
+	else if (threads > 0)
+		r = verity_create_parallel(fd, tmpfd, threads, &container->roothash);
+	else
+		r = verity_create(path, tmppath, &container->roothash);
+	pr_time("verity_hash", start);
 	if (r != 0)
 		goto exit;
 	const off64_t data_size = lseek64(fd, 0, SEEK_END);
@@ -1348,7 +2170,9 @@ static int write_container(int fd, const char* path, EVP_PKEY* pkey, struct cont
 	/* Sign roothash */
 	container->root.size = strlen(container->roothash);
 	size_t digest_size = 0;
+	start = time_now();
 	r = create_digest((uint8_t*) container->roothash, container->root.size, &digest, &digest_size, pkey);
+	pr_time("digest_sign", start);
 	if (r != 0)
 		goto exit;
 	container->digest.size = digest_size;
@@ -1375,7 +2199,9 @@ static int write_container(int fd, const char* path, EVP_PKEY* pkey, struct cont
 	}
 
 	/* concatenate parts */
+	start = time_now();
 	r = cat_container(container, fd, tmpfd, (uint8_t*) container->roothash, digest, pubkey_buf, header_buf);
+	pr_time("tree_concat", start);
 	if (r != 0) {
 		pr_err("failed assembling container: %[%d]: %s\n", -r, strerror(-r));
 		goto exit;
@@ -1395,6 +2221,11 @@ exit:
 	if (unlink(tmppath) != 0)
 		pr_info("failed removing tmpfile: %s\n", tmppath);
 	close(tmpfd);
+	if (leaffd >= 0) {
+		if (unlink(leafpath) != 0)
+			pr_info("failed removing tmpfile: %s\n", leafpath);
+		close(leaffd);
+	}
 	if (digest != NULL)
 		free(digest);
 	if (pubkey_buf != NULL)
@@ -1425,6 +2256,16 @@ static void print_usage(void)
 	printf("  --pubkey-dir     Path to directory of validation keys\n");
 	printf("  --pubkey-any     Use pubkey from container\n");
 	printf("  --roothash       Dump roothash\n");
+	printf("  --threads        Number of threads for creating hash tree with --create,\n");
+	printf("                     0 for number of online CPUs. By default the tree is\n");
+	printf("                     created by libcryptsetup on a single thread.\n");
+	printf("  --cache-dir      Directory of verification cache for --open and --verify,\n");
+	printf("                     created if missing. Skips signature verification and\n");
+	printf("                     parsing unmodified keys of --pubkey and --pubkey-dir for\n");
+	printf("                     containers previously verified. Only used by root with\n");
+	printf("                     directory owned by root and not writable by others.\n");
+	printf("  --stream         With --create read FILE data from stdin, hashing it while\n");
+	printf("                     written. FILE is replaced.\n");
 	printf("  --version        Dump version\n");
 	printf("\n");
 	printf("Input FILE size when creating a container should be a multiple of 4096,"
@@ -1433,6 +2274,8 @@ static void print_usage(void)
 	printf("Examples:\n");
 	printf("Create container and sign with keyfile:\n");
 	printf(" container-util --keyfile private.pem rootfs.container\n");
+	printf("Create container from data written to pipe:\n");
+	printf(" tar -c rootfs | container-util --create --stream --keyfile private.pem rootfs.container\n");
 	printf("Create container and sigh with pkcs11:\n");
 	printf(" container-util --key-pkcs11 \"pkcs11:token=ms;object=test;pin-value=123456\" rootfs.container\n");
 	printf("Verify container with keyfile:\n");
@@ -1462,6 +2305,7 @@ enum options {
 	OPT_ROOTHASH     = 1 << 4,
 	OPT_PUBKEY_ANY   = 1 << 5,
 	OPT_CLOSE        = 1 << 6,
+	OPT_STREAM       = 1 << 7,
 };
 
 struct config {
@@ -1473,6 +2317,8 @@ struct config {
 	char *pubkey_path;
 	char *pubkey_pkcs11;
 	char *pubkey_dir;
+	char *cache_dir;
+	long threads;
 };
 
 //NOLINTNEXTLINE(readability-function-cognitive-complexity)
@@ -1539,6 +2385,34 @@ int main(int argc, char *argv[])
 			}
 			cfg.pubkey_dir = argv[i];
 		}
+		else if (strcmp("--threads", argv[i]) == 0) {
+			char *end = NULL;
+			if (++i >= argc) {
+				pr_err("invalid argument --threads\n");
+				return EINVAL;
+			}
+			errno = 0;
+			cfg.threads = strtol(argv[i], &end, 10);
+			if (errno != 0 || *end != '\0' || end == argv[i] || cfg.threads < 0 || cfg.threads > 4096) {
+				pr_err("invalid argument --threads\n");
+				return EINVAL;
+			}
+			if (cfg.threads == 0) {
+				cfg.threads = sysconf(_SC_NPROCESSORS_ONLN);
+				if (cfg.threads < 1)
+					cfg.threads = 1;
+			}
+		}
+		else if (strcmp("--cache-dir", argv[i]) == 0) {
+			if (++i >= argc) {
+				pr_err("invalid argument --cache-dir\n");
+				return EINVAL;
+			}
+			cfg.cache_dir = argv[i];
+		}
+		else if (strcmp("--stream", argv[i]) == 0) {
+			cfg.opt |= OPT_STREAM;
+		}
 		else if (strcmp("--pubkey-any", argv[i]) == 0) {
 			cfg.opt |= OPT_PUBKEY_ANY;
 		}
@@ -1588,6 +2462,28 @@ int main(int argc, char *argv[])
 		return EINVAL;
 	}
 
+	if ((cfg.opt & OPT_STREAM) == OPT_STREAM && (cfg.opt & OPT_CREATE) != OPT_CREATE) {
+		pr_err("--stream requires --create\n");
+		return EINVAL;
+	}
+
+	/* verification cache is opt-in and never fails operation */
+	if (cfg.cache_dir != NULL) {
+		int r = 0;
+		if ((cfg.opt & (OPT_OPEN | OPT_VERIFY_ONLY)) == 0 || (cfg.opt & OPT_CREATE) == OPT_CREATE) {
+			pr_err("--cache-dir requires --open or --verify\n");
+			return EINVAL;
+		}
+		if (cfg.pubkey_pkcs11 != NULL) {
+			pr_info("%s: cache not used with --pubkey-pkcs11\n", cfg.cache_dir);
+			cfg.cache_dir = NULL;
+		}
+		else if ((r = cache_open(cfg.cache_dir)) != 0) {
+			pr_info("%s: cache not used: [%d] %s\n", cfg.cache_dir, -r, strerror(-r));
+			cfg.cache_dir = NULL;
+		}
+	}
+
 	if ((cfg.opt & OPT_PUBKEY_ANY) == 0
 			&& cfg.pubkey_path == NULL
 			&& cfg.pubkey_pkcs11 == NULL
@@ -1626,18 +2522,20 @@ int main(int argc, char *argv[])
 	int r = 0;
 	int filefd = -1;
 
-	/* open FILE and validate as container */
+	/* open FILE and validate as container, when streaming FILE is created */
 	filefd = open(cfg.filepath, O_RDONLY | O_CLOEXEC);
-	if (filefd < 0) {
+	if (filefd < 0 && !((cfg.opt & OPT_STREAM) == OPT_STREAM && errno == ENOENT)) {
 		r = -errno;
 		pr_err("%s: [%d] %s\n", cfg.filepath -r, strerror(-r));
 		goto exit;
 	}
 
-	r = read_container(&container, filefd);
-	if (r != 0) {
-		pr_err("%s: failed reading: [%d] %s\n", cfg.filepath, -r, strerror(-r));
-		goto exit;
+	if (filefd >= 0) {
+		r = read_container(&container, filefd, cfg.cache_dir);
+		if (r != 0) {
+			pr_err("%s: failed reading: [%d] %s\n", cfg.filepath, -r, strerror(-r));
+			goto exit;
+		}
 	}
 
 	/* Match pubkey if container is valid.
@@ -1646,13 +2544,17 @@ int main(int argc, char *argv[])
 	 * satisfied with digest verification towards
 	 * pubkey provided by container as part of container
 	 * validation. */
+	double start = time_now();
 	if (((container.opt & CONTAINER_VALID) == CONTAINER_VALID)
 			&& ((cfg.opt & OPT_PUBKEY_ANY) != OPT_PUBKEY_ANY)
-			&& (match_pubkey(cfg.pubkey_path, cfg.pubkey_dir, cfg.pubkey_pkcs11, container.pkey) != 0)) {
+			&& (cfg.cache_dir != NULL ?
+				cache_match_pubkey(cfg.cache_dir, cfg.pubkey_path, cfg.pubkey_dir, container.fingerprint) != 0
+				: match_pubkey(cfg.pubkey_path, cfg.pubkey_dir, cfg.pubkey_pkcs11, container.pkey) != 0)) {
 		r = -EBADF;
 		pr_err("pubkey validation failed\n");
 		goto exit;
 	}
+	pr_time("pubkey_match", start);
 
 	/* verify data and tree to roothash */
 	if ((cfg.opt & OPT_VERIFY_ONLY) == OPT_VERIFY_ONLY) {
@@ -1662,7 +2564,9 @@ int main(int argc, char *argv[])
 			goto exit;
 		}
 
+		start = time_now();
 		r = verity_open(cfg.filepath, NULL, CRYPT_VERITY_CHECK_HASH, &container);
+		pr_time("verity_verify", start);
 		if (r < 0)
 			goto exit;
 		if (info)
@@ -1721,7 +2625,9 @@ int main(int argc, char *argv[])
 				pr_err("--keyfile and --key-pkcs11 are mutually exclusive\n");
 				goto exit;
 			}
+			start = time_now();
 			r = read_private_key(cfg.key_path, cfg.key_pkcs11, &signing_key);
+			pr_time("key_load", start);
 			if (r != 0) {
 				pr_err("Could not read private key: [%d]: %s\n", -r, strerror(-r));
 				goto exit;
@@ -1729,8 +2635,12 @@ int main(int argc, char *argv[])
 		}
 
 		/* reopen for writing */
-		close(filefd);
-		filefd = open(cfg.filepath, O_RDWR | O_CLOEXEC);
+		if (filefd >= 0)
+			close(filefd);
+		if ((cfg.opt & OPT_STREAM) == OPT_STREAM)
+			filefd = open(cfg.filepath, O_RDWR | O_CREAT | O_TRUNC | O_CLOEXEC, 0644);
+		else
+			filefd = open(cfg.filepath, O_RDWR | O_CLOEXEC);
 		if (filefd < 0) {
 			r = -errno;
 			pr_err("%s: [%d] %s\n", cfg.filepath, -r, strerror(-r));
@@ -1738,7 +2648,8 @@ int main(int argc, char *argv[])
 		}
 
 		/* remove header if available */
-		if ((container.opt & CONTAINER_VALID) == CONTAINER_VALID) {
+		if ((container.opt & CONTAINER_VALID) == CONTAINER_VALID
+				&& (cfg.opt & OPT_STREAM) != OPT_STREAM) {
 			if (container.data.offset != 0) {
 				pr_err("expected data offset at 0 but got %" PRId64 "\n", container.data.offset);
 				r = -EFAULT;
@@ -1758,7 +2669,10 @@ int main(int argc, char *argv[])
 		}
 		/* add header */
 		destroy_container(&container);
-		r = write_container(filefd, cfg.filepath, signing_key, &container);
+		r = write_container(filefd, (cfg.opt & OPT_STREAM) == OPT_STREAM ? STDIN_FILENO : -1,
+				cfg.filepath, signing_key, (unsigned int) cfg.threads, &container);
+		if (r != 0)
+			goto exit;
 		if (info)
 			dump_container(&container);
 		pr_info("container - created\n");
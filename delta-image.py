@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import stat
+import struct
+import hashlib
+import functools
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from image_io import zero_buffer, get_numpy, pread_full, pwrite_all, hash_range
+
+DELTA_MAGIC = b'IMGDELTA'
+DELTA_VERSION = 1
+# magic, version, block_size, source_size, target_size, source_sha256, target_sha256
+DELTA_HEADER = struct.Struct('<8sIIQQ32s32s')
+# op, reserved, target_offset, size, source_offset
+DELTA_OP = struct.Struct('<IIQQQ')
+OP_COPY = 0
+OP_LITERAL = 1
+OP_ZERO = 2
+OP_END = 3
+# Placeholder for changed blocks while creating delta
+OP_CHANGED = -1
+
+BLOCK_SIZE = 4096
+CHUNK_SIZE = 8 * 1024 * 1024
+
+@functools.cache
+def fingerprint_weights(words):
+    numpy = get_numpy()
+    rng = numpy.random.default_rng(0x494d4721)
+    return rng.integers(0, 1 << 64, size=words, dtype=numpy.uint64) | numpy.uint64(1)
+
+# Return weak fingerprint of each full block in chunk. Fingerprints are only
+# used for finding candidates, matches are always verified by comparing data.
+def block_fingerprints(chunk, block_size):
+    count = len(chunk) // block_size
+    numpy = get_numpy()
+    if numpy is not None and block_size % 8 == 0:
+        words = numpy.frombuffer(chunk[:count * block_size], dtype=numpy.uint64).reshape(-1, block_size // 8)
+        with numpy.errstate(over='ignore'):
+            return (words * fingerprint_weights(block_size // 8)).sum(axis=1, dtype=numpy.uint64).tolist()
+    return [int.from_bytes(hashlib.blake2b(chunk[x:x + block_size], digest_size=8).digest(), 'little')
+            for x in range(0, count * block_size, block_size)]
+
+# Return per block flags (same, zero) of target chunk compared to source chunk.
+# Only the first source_len bytes of source are valid.
+def compare_blocks(target, source, source_len, block_size):
+    numpy = get_numpy()
+    if numpy is not None and len(target) % block_size == 0 and block_size % 8 == 0:
+        t = numpy.frombuffer(target, dtype=numpy.uint64).reshape(-1, block_size // 8)
+        s = numpy.frombuffer(source[:len(target)], dtype=numpy.uint64).reshape(-1, block_size // 8)
+        same = (t == s).all(axis=1)
+        same[source_len // block_size:] = False
+        return same.tolist(), (~t.any(axis=1)).tolist()
+    zeros = zero_buffer()
+    same = []
+    zero = []
+    for x in range(0, len(target), block_size):
+        block = target[x:x + block_size]
+        same.append(x + len(block) <= source_len and block == source[x:x + len(block)])
+        zero.append(block == zeros[:len(block)])
+    return same, zero
+
+def file_size(fd):
+    return os.lseek(fd, 0, os.SEEK_END)
+
+# Append op to ops, merging with previous op if contiguous
+def add_op(ops, op, target_offset, size, source_offset=0):
+    if ops:
+        last = ops[-1]
+        if (last[0] == op and last[1] + last[2] == target_offset
+                and (op != OP_COPY or last[3] + last[2] == source_offset)):
+            last[2] += size
+            return
+    ops.append([op, target_offset, size, source_offset])
+
+# Classify target blocks as unchanged, zero or changed. Unchanged blocks are copied
+# from same offset of source. Returns ops and sha256 of target.
+def scan_target(source_fd, source_size, target_fd, target_size, block_size):
+    ops = []
+    target_hash = hashlib.sha256()
+    target_buffer = memoryview(bytearray(CHUNK_SIZE))
+    source_buffer = memoryview(bytearray(CHUNK_SIZE))
+    for offset in range(0, target_size, CHUNK_SIZE):
+        target = target_buffer[:min(CHUNK_SIZE, target_size - offset)]
+        pread_full(target_fd, target, offset)
+        target_hash.update(target)
+        source_len = max(0, min(len(target), source_size - offset))
+        pread_full(source_fd, source_buffer[:source_len], offset)
+        source_buffer[source_len:len(target)] = zero_buffer()[:len(target) - source_len]
+        same, zero = compare_blocks(target, source_buffer, source_len, block_size)
+        for n, x in enumerate(range(0, len(target), block_size)):
+            size = min(block_size, len(target) - x)
+            if zero[n]:
+                add_op(ops, OP_ZERO, offset + x, size)
+            elif same[n]:
+                add_op(ops, OP_COPY, offset + x, size, offset + x)
+            else:
+                add_op(ops, OP_CHANGED, offset + x, size)
+    return ops, target_hash.digest()
+
+# Map fingerprint of each non-zero source block to its first offset
+def index_source(source_fd, source_size, block_size):
+    index = {}
+    buffer = memoryview(bytearray(CHUNK_SIZE))
+    zeros = zero_buffer()[:block_size]
+    zero_fingerprint = block_fingerprints(zeros, block_size)[0]
+    for offset in range(0, source_size - source_size % block_size, CHUNK_SIZE):
+        chunk = buffer[:min(CHUNK_SIZE, source_size - source_size % block_size - offset)]
+        pread_full(source_fd, chunk, offset)
+        for n, fingerprint in enumerate(block_fingerprints(chunk, block_size)):
+            if fingerprint == zero_fingerprint and chunk[n * block_size:(n + 1) * block_size] == zeros:
+                continue
+            index.setdefault(fingerprint, offset + n * block_size)
+    return index
+
+# Resolve changed blocks to copies of moved source blocks or literals
+def resolve_changed(ops, source_fd, source_size, target_fd, block_size):
+    index = None
+    resolved = []
+    buffer = memoryview(bytearray(CHUNK_SIZE))
+    candidate = memoryview(bytearray(block_size))
+    for op, target_offset, size, source_offset in ops:
+        if op != OP_CHANGED:
+            add_op(resolved, op, target_offset, size, source_offset)
+            continue
+        if index is None:
+            index = index_source(source_fd, source_size, block_size)
+        for offset in range(target_offset, target_offset + size, CHUNK_SIZE):
+            chunk = buffer[:min(CHUNK_SIZE, target_offset + size - offset)]
+            pread_full(target_fd, chunk, offset)
+            fingerprints = block_fingerprints(chunk, block_size)
+            for x in range(0, len(chunk), block_size):
+                block = chunk[x:x + block_size]
+                match = index.get(fingerprints[x // block_size]) if len(block) == block_size else None
+                if match is not None:
+                    pread_full(source_fd, candidate, match)
+                    if candidate == block:
+                        add_op(resolved, OP_COPY, offset + x, block_size, match)
+                        continue
+                add_op(resolved, OP_LITERAL, offset + x, len(block))
+    return resolved
+
+def create_delta(source, target, delta, block_size, debug):
+    with open(source, 'rb') as source_file, open(target, 'rb') as target_file:
+        source_fd = source_file.fileno()
+        target_fd = target_file.fileno()
+        source_size = file_size(source_fd)
+        target_size = file_size(target_fd)
+        if debug:
+            print('Source size: {} b'.format(source_size))
+            print('Target size: {} b'.format(target_size))
+        ops, target_sha256 = scan_target(source_fd, source_size, target_fd, target_size, block_size)
+        ops = resolve_changed(ops, source_fd, source_size, target_fd, block_size)
+
+        source_hash = hashlib.sha256()
+        buffer = memoryview(bytearray(CHUNK_SIZE))
+        totals = {OP_COPY: 0, OP_LITERAL: 0, OP_ZERO: 0}
+        with open(delta, 'wb') as f:
+            f.write(bytes(DELTA_HEADER.size))
+            for op, target_offset, size, source_offset in ops:
+                f.write(DELTA_OP.pack(op, 0, target_offset, size, source_offset))
+                if op == OP_COPY:
+                    hash_range(source_fd, source_offset, size, [source_hash], buffer)
+                elif op == OP_LITERAL:
+                    for offset in range(target_offset, target_offset + size, CHUNK_SIZE):
+                        chunk = buffer[:min(CHUNK_SIZE, target_offset + size - offset)]
+                        pread_full(target_fd, chunk, offset)
+                        f.write(chunk)
+                totals[op] += size
+            f.write(DELTA_OP.pack(OP_END, 0, target_size, 0, 0))
+            f.seek(0)
+            f.write(DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, block_size, source_size,
+                                      target_size, source_hash.digest(), target_sha256))
+    print('Copy:    {} b'.format(totals[OP_COPY]))
+    print('Literal: {} b'.format(totals[OP_LITERAL]))
+    print('Zero:    {} b'.format(totals[OP_ZERO]))
+
+def read_header(f):
+    data = f.read(DELTA_HEADER.size)
+    if len(data) != DELTA_HEADER.size:
+        raise RuntimeError('Delta too small')
+    magic, version, block_size, source_size, target_size, source_sha256, target_sha256 = DELTA_HEADER.unpack(data)
+    if magic != DELTA_MAGIC:
+        raise RuntimeError('Invalid delta magic')
+    if version != DELTA_VERSION:
+        raise RuntimeError('Unsupported delta version {}'.format(version))
+    return {'block_size': block_size, 'source_size': source_size, 'target_size': target_size,
+            'source_sha256': source_sha256, 'target_sha256': target_sha256}
+
+# Yield ops of delta, positioned at literal data for OP_LITERAL. Ops are
+# validated to cover target in order.
+def read_ops(f, header):
+    expected = 0
+    while True:
+        data = f.read(DELTA_OP.size)
+        if len(data) != DELTA_OP.size:
+            raise RuntimeError('Delta truncated')
+        op, _, target_offset, size, source_offset = DELTA_OP.unpack(data)
+        if target_offset != expected:
+            raise RuntimeError('Delta op at unexpected offset {}'.format(target_offset))
+        if op == OP_END:
+            if target_offset != header['target_size']:
+                raise RuntimeError('Delta does not cover target')
+            return
+        if op not in (OP_COPY, OP_LITERAL, OP_ZERO) or target_offset + size > header['target_size']:
+            raise RuntimeError('Invalid delta op')
+        if op == OP_COPY and source_offset + size > header['source_size']:
+            raise RuntimeError('Delta copy outside of source')
+        yield op, target_offset, size, source_offset
+        expected += size
+
+def apply_delta(delta, source, target, debug):
+    with open(delta, 'rb') as f, open(source, 'rb') as source_file, open(target, 'r+b') as target_file:
+        header = read_header(f)
+        source_fd = source_file.fileno()
+        target_fd = target_file.fileno()
+        if debug:
+            print('Source size: {} b'.format(header['source_size']))
+            print('Target size: {} b'.format(header['target_size']))
+        if stat.S_ISBLK(os.fstat(target_fd).st_mode) and file_size(target_fd) < header['target_size']:
+            raise RuntimeError('Target too small: {} < {}'.format(file_size(target_fd), header['target_size']))
+
+        # Verify source data used by delta before modifying target
+        buffer = memoryview(bytearray(CHUNK_SIZE))
+        source_hash = hashlib.sha256()
+        for op, target_offset, size, source_offset in read_ops(f, header):
+            if op == OP_COPY:
+                hash_range(source_fd, source_offset, size, [source_hash], buffer)
+            elif op == OP_LITERAL:
+                f.seek(size, os.SEEK_CUR)
+        if source_hash.digest() != header['source_sha256']:
+            raise RuntimeError('Source does not match delta')
+
+        f.seek(DELTA_HEADER.size)
+        for op, target_offset, size, source_offset in read_ops(f, header):
+            for offset in range(0, size, CHUNK_SIZE):
+                chunk = buffer[:min(CHUNK_SIZE, size - offset)]
+                if op == OP_COPY:
+                    pread_full(source_fd, chunk, source_offset + offset)
+                elif op == OP_LITERAL:
+                    if f.readinto(chunk) != len(chunk):
+                        raise RuntimeError('Delta truncated')
+                else:
+                    chunk = zero_buffer()[:len(chunk)]
+                pwrite_all(target_fd, chunk, target_offset + offset)
+        os.fsync(target_fd)
+
+        target_hash = hashlib.sha256()
+        hash_range(target_fd, 0, header['target_size'], [target_hash], buffer)
+        if target_hash.digest() != header['target_sha256']:
+            raise RuntimeError('Target sha256 mismatch after applying delta')
+    print('Applied delta: {} b written'.format(header['target_size']))
+
+def main():
+    parser = ArgumentParser(description='''Create and apply block level delta of partition images''',
+                                     epilog='''Return value:
+0 for success, 1 for failure
+
+--create compares SOURCE and TARGET image in blocks and writes DELTA of:
+- copies of blocks of SOURCE, unchanged or moved
+- literal data of blocks not found in SOURCE
+- zero filled ranges
+
+--apply rebuilds TARGET from SOURCE and DELTA. Source data used by DELTA is
+verified before TARGET is written and sha256 of TARGET is verified afterwards.
+SOURCE and TARGET may be block devices larger than the images.
+''',
+                                     formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('DELTA', help='Path to delta file')
+    parser.add_argument('--create', action='store_true', help='Create DELTA from SOURCE to TARGET')
+    parser.add_argument('--apply', action='store_true', help='Write TARGET from SOURCE and DELTA')
+    parser.add_argument('--source', required=True, help='Source image or device')
+    parser.add_argument('--target', required=True, help='Target image or device')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help='Block size of delta, default {}'.format(BLOCK_SIZE))
+    parser.add_argument('--debug', action='store_true', help='Print debug information')
+    args = parser.parse_args()
+
+    if args.create == args.apply:
+        raise ValueError('Exactly one of --create and --apply required')
+    if args.block_size <= 0 or args.block_size % 512 or CHUNK_SIZE % args.block_size:
+        raise ValueError('Invalid block size {}'.format(args.block_size))
+
+    if args.create:
+        create_delta(args.source, args.target, args.DELTA, args.block_size, args.debug)
+    else:
+        apply_delta(args.DELTA, args.source, args.target, args.debug)
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Error: {}'.format(e))
+    sys.exit(1)
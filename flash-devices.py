@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import stat
+import time
+import queue
+import hashlib
+import threading
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from image_bmap import read_bmap
+
+BUFFER_SIZE = 8 * 1024 * 1024
+BUFFER_COUNT = 8
+
+# Chunk of image shared by all device writers. Buffer is returned to
+# pool when released by last writer.
+class Chunk:
+    def __init__(self, pool, buffer, offset, length, users):
+        self.pool = pool
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self.users = users
+        self.lock = threading.Lock()
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            done = self.users == 0
+        if done:
+            self.pool.put(self.buffer)
+
+class Writer(threading.Thread):
+    def __init__(self, path, image_size, allow_file):
+        super().__init__(daemon=True)
+        self.path = path
+        self.image_size = image_size
+        self.allow_file = allow_file
+        self.queue = queue.Queue()
+        self.error = None
+        self.written = 0
+        self.seconds = 0.0
+        self.fd = -1
+
+    # Open device before any chunk is read, a device failing to open is
+    # excluded without affecting other devices. Never created, a missing
+    # device path must not pass as a written regular file.
+    def open(self):
+        try:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_CLOEXEC)
+            st = os.fstat(self.fd)
+            if stat.S_ISBLK(st.st_mode):
+                size = os.lseek(self.fd, 0, os.SEEK_END)
+                if size < self.image_size:
+                    raise RuntimeError('Device smaller than image: {} < {}'.format(size, self.image_size))
+            elif stat.S_ISREG(st.st_mode) and self.allow_file:
+                # no stale data after image
+                os.ftruncate(self.fd, self.image_size)
+            else:
+                raise RuntimeError('Not a block device')
+        except (OSError, RuntimeError) as e:
+            self.fail(e)
+            if self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+        return self.error is None
+
+    def fail(self, e):
+        if self.error is None:
+            self.error = str(e)
+
+    def run(self):
+        start = time.monotonic()
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            try:
+                if self.error is None:
+                    view = memoryview(chunk.buffer)[:chunk.length]
+                    position = 0
+                    while position < chunk.length:
+                        written = os.pwrite(self.fd, view[position:], chunk.offset + position)
+                        if written == 0:
+                            raise OSError('Short write at offset {}'.format(chunk.offset + position))
+                        position += written
+                    view.release()
+                    self.written += chunk.length
+            except OSError as e:
+                self.fail(e)
+            finally:
+                # Failed writers keep consuming their queue to not stall the pool
+                chunk.release()
+        try:
+            if self.error is None:
+                os.fsync(self.fd)
+        except OSError as e:
+            self.fail(e)
+        finally:
+            if self.fd >= 0:
+                os.close(self.fd)
+        self.seconds = time.monotonic() - start
+
+# Read each mapped range of image once, verify its checksum and write it to
+# all devices in parallel. Returns list of writers.
+def flash_devices(image, bmap, devices, buffer_size, buffer_count, allow_file, debug):
+    writers = [Writer(device, bmap['image_size'], allow_file) for device in devices]
+    active = [writer for writer in writers if writer.open()]
+    if not active:
+        return writers
+
+    pool = queue.Queue()
+    for _ in range(buffer_count):
+        pool.put(bytearray(buffer_size))
+    for writer in active:
+        writer.start()
+    try:
+        with open(image, 'rb') as f:
+            fd = f.fileno()
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for offset, size, chksum in bmap['ranges']:
+                # Nothing left to write to
+                if all(writer.error is not None for writer in active):
+                    break
+                if debug:
+                    print('range {}+{}'.format(offset, size))
+                hasher = hashlib.new(bmap['checksum_type'])
+                position = offset
+                end = offset + size
+                while position < end:
+                    # Blocks until all writers released a buffer
+                    buffer = pool.get()
+                    length = min(buffer_size, end - position)
+                    count = os.preadv(fd, [memoryview(buffer)[:length]], position)
+                    if count <= 0:
+                        raise RuntimeError('Unexpected end of image at offset {}'.format(position))
+                    hasher.update(memoryview(buffer)[:count])
+                    chunk = Chunk(pool, buffer, position, count, len(active))
+                    for writer in active:
+                        writer.queue.put(chunk)
+                    position += count
+                if hasher.hexdigest() != chksum:
+                    raise RuntimeError('Image checksum mismatch for range {}-{} b'.format(offset, end - 1))
+    except Exception as e:
+        # Source failure affects all devices
+        for writer in active:
+            writer.fail(e)
+        raise
+    finally:
+        for writer in active:
+            writer.queue.put(None)
+        for writer in active:
+            writer.join()
+    return writers
+
+def main():
+    parser = ArgumentParser(description='''Write image to multiple devices in parallel''',
+                                     epilog='''Return value:
+0 if image was written to all devices, 1 for failure of any device
+
+Each mapped range of the bmap is read once from IMAGE, verified against the
+range checksum of the bmap and written to all DEVICE at the same time by one
+writer thread per device. Memory is bounded by --buffers of --buffer-size.
+
+DEVICE must be a block device at least the size of the image, or with
+--allow-file an existing regular file. DEVICE is never created.
+
+A failing device does not interrupt writing to other devices. Each device is
+reported as "DEVICE: OK BYTES b in SECONDS s (MIB/S MiB/s)" or
+"DEVICE: FAILED REASON".
+''',
+                                     formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('IMAGE', help='Path to image')
+    parser.add_argument('DEVICE', nargs='+', help='Path to target device')
+    parser.add_argument('--bmap', required=True, help='Path to bmap of IMAGE')
+    parser.add_argument('--buffers', type=int, default=BUFFER_COUNT,
+                        help='Number of buffers in pool, default {}'.format(BUFFER_COUNT))
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE,
+                        help='Size of each buffer in bytes, default {}'.format(BUFFER_SIZE))
+    parser.add_argument('--allow-file', action='store_true',
+                        help='Allow existing regular file as DEVICE, truncated to image size')
+    parser.add_argument('--debug', action='store_true', help='Print each range written')
+    args = parser.parse_args()
+
+    if args.buffers < 1:
+        raise ValueError('Invalid --buffers {}'.format(args.buffers))
+    if args.buffer_size < 4096 or args.buffer_size % 4096:
+        raise ValueError('Invalid --buffer-size {}, must be a multiple of 4096'.format(args.buffer_size))
+    if len(set(os.path.realpath(x) for x in args.DEVICE)) != len(args.DEVICE):
+        raise ValueError('Duplicate DEVICE')
+
+    bmap = read_bmap(args.bmap)
+    writers = flash_devices(args.IMAGE, bmap, args.DEVICE, args.buffer_size, args.buffers,
+                            args.allow_file, args.debug)
+    for writer in writers:
+        if writer.error is None:
+            rate = writer.written / (1 << 20) / writer.seconds if writer.seconds else 0.0
+            print('{}: OK {} b in {:.3f} s ({:.1f} MiB/s)'.format(writer.path, writer.written, writer.seconds, rate))
+        else:
+            print('{}: FAILED {}'.format(writer.path, writer.error))
+    sys.exit(0 if all(writer.error is None for writer in writers) else 1)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Error: {}'.format(e))
+    sys.exit(1)
@@ -2,11 +2,113 @@
 
 import sys
 import os
-import parted
 import errno
+import struct
+import zlib
+import uuid
+import importlib.util
+import hashlib
+import json
+import functools
+import stat
+import contextlib
+import subprocess
+import gzip
+import lzma
+import bz2
+import ctypes
+import base64
+import bisect
+import time
+import threading
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from image_io import zero_buffer, get_numpy, pread_full, pwrite_all, hash_range
 
-def get_partitions(image):
+GPT_SIGNATURE = b'EFI PART'
+# signature, revision, header_size, header_crc32, reserved, current_lba, backup_lba,
+# first_usable_lba, last_usable_lba, disk_guid, entries_lba, num_entries, entry_size, entries_crc32
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+# type_guid, unique_guid, first_lba, last_lba, attributes, name
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+GPT_SECTOR_SIZES = (512, 4096)
+
+def read_exact(fd, offset, size):
+    data = os.pread(fd, size, offset)
+    if len(data) != size:
+        raise ValueError('IMAGE truncated at offset {}'.format(offset))
+    return data
+
+def read_gpt_header(fd, lba, sector_size):
+    data = read_exact(fd, lba * sector_size, sector_size)
+    header = dict(zip(('signature', 'revision', 'header_size', 'header_crc32', 'reserved',
+                       'current_lba', 'backup_lba', 'first_usable_lba', 'last_usable_lba',
+                       'disk_guid', 'entries_lba', 'num_entries', 'entry_size', 'entries_crc32'),
+                      GPT_HEADER.unpack_from(data)))
+    if header['signature'] != GPT_SIGNATURE:
+        raise ValueError('IMAGE gpt header at lba {} missing signature'.format(lba))
+    if header['header_size'] < GPT_HEADER.size or header['header_size'] > sector_size:
+        raise ValueError('IMAGE gpt header at lba {} invalid size {}'.format(lba, header['header_size']))
+    crc_data = bytearray(data[:header['header_size']])
+    crc_data[16:20] = bytes(4)
+    if zlib.crc32(crc_data) != header['header_crc32']:
+        raise ValueError('IMAGE gpt header at lba {} crc32 mismatch'.format(lba))
+    if header['current_lba'] != lba:
+        raise ValueError('IMAGE gpt header at lba {} claims lba {}'.format(lba, header['current_lba']))
+    if header['entry_size'] < GPT_ENTRY.size or header['entry_size'] % 8:
+        raise ValueError('IMAGE gpt header at lba {} invalid entry size {}'.format(lba, header['entry_size']))
+    return header
+
+def read_gpt_entries(fd, header, sector_size):
+    data = read_exact(fd, header['entries_lba'] * sector_size, header['num_entries'] * header['entry_size'])
+    if zlib.crc32(data) != header['entries_crc32']:
+        raise ValueError('IMAGE gpt partition entries at lba {} crc32 mismatch'.format(header['entries_lba']))
+    return data
+
+# Read partitions from gpt of IMAGE without libparted.
+# Primary header and entries are validated by crc32 and compared to the backup.
+def read_gpt(image):
+    fd = os.open(image, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        for sector_size in GPT_SECTOR_SIZES:
+            if os.pread(fd, len(GPT_SIGNATURE), sector_size) == GPT_SIGNATURE:
+                break
+        else:
+            raise ValueError('IMAGE header not of type gpt')
+
+        primary = read_gpt_header(fd, 1, sector_size)
+        entries = read_gpt_entries(fd, primary, sector_size)
+        backup = read_gpt_header(fd, primary['backup_lba'], sector_size)
+        if (backup['backup_lba'] != primary['current_lba']
+                or any(backup[x] != primary[x] for x in ('first_usable_lba', 'last_usable_lba', 'disk_guid',
+                                                         'num_entries', 'entry_size', 'entries_crc32'))):
+            raise ValueError('IMAGE gpt backup header does not match primary header')
+        if read_gpt_entries(fd, backup, sector_size) != entries:
+            raise ValueError('IMAGE gpt backup partition entries do not match primary entries')
+    finally:
+        os.close(fd)
+
+    part_data = {}
+    for i in range(primary['num_entries']):
+        type_guid, guid, first_lba, last_lba, attributes, name = \
+            GPT_ENTRY.unpack_from(entries, i * primary['entry_size'])
+        if type_guid == bytes(16):
+            # Unused entry
+            continue
+        if first_lba > last_lba or first_lba < primary['first_usable_lba'] or last_lba > primary['last_usable_lba']:
+            raise ValueError('IMAGE gpt partition entry {} outside usable area'.format(i))
+        name = name.decode('utf-16-le', errors='replace').split('\0', 1)[0]
+        part_data[name] = {'offset': first_lba * sector_size,
+                           'size': (last_lba - first_lba + 1) * sector_size,
+                           'type_guid': str(uuid.UUID(bytes_le=type_guid)),
+                           'guid': str(uuid.UUID(bytes_le=guid)),
+                           'attributes': attributes}
+    return part_data
+
+def get_partitions_parted(image):
+    import parted
     dev = parted.device.Device(image)
     if (dev.type != parted._ped.DEVICE_FILE):
         raise ValueError('IMAGE [{}] not of type FILE [{}]'.format(dev.type, parted._ped.DEVICE_FILE))
@@ -19,71 +121,1101 @@ def get_partitions(image):
                                 'size': part.geometry.length * dev.sectorSize}
     return part_data
 
-def write(input, size, output):
+# Read partitions by builtin gpt reader. pyparted is used as fallback if
+# available and builtin reader fails, or if explicitly requested.
+def get_partitions(image, reader='auto'):
+    if reader == 'parted':
+        return get_partitions_parted(image)
+    try:
+        return read_gpt(image)
+    except ValueError:
+        if reader != 'auto' or importlib.util.find_spec('parted') is None:
+            raise
+    return get_partitions_parted(image)
+
+# Copy engines in order of preference for --copy-engine auto
+COPY_ENGINES = ['copy_file_range', 'sendfile', 'read']
+# Errors indicating engine is not supported for given file descriptors
+COPY_ENGINE_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF)
+# Buffer size used by engine "read"
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Time and number of syscalls per category and bytes written, collected
+# per partition for --stats and --progress. Functions taking stats accept None.
+STATS_CATEGORIES = ('read', 'write', 'copy', 'seek')
+
+class Stats:
+    def __init__(self):
+        self.time = dict.fromkeys(STATS_CATEGORIES, 0.0)
+        self.syscalls = dict.fromkeys(STATS_CATEGORIES, 0)
+        # Bytes written to IMAGE and total to be written if known
+        self.written = 0
+        self.total = None
+        self.extents = []
+
+    def add(self, category, start, written=0):
+        self.time[category] += time.perf_counter() - start
+        self.syscalls[category] += 1
+        self.written += written
+
+    def snapshot(self):
+        return dict(self.time), dict(self.syscalls)
+
+    # Record extent with time and syscalls since snapshot
+    def extent(self, offset, size, start, snapshot):
+        times, syscalls = snapshot
+        self.extents.append({'offset': offset, 'size': size,
+                             'seconds': round(time.perf_counter() - start, 6),
+                             'time': {k: round(self.time[k] - times[k], 6) for k in STATS_CATEGORIES},
+                             'syscalls': {k: self.syscalls[k] - syscalls[k] for k in STATS_CATEGORIES}})
+
+def copy_file_range(input_fd, offset, output_fd, output_offset, size, stats=None):
     bytes_remaining = size
-    block_size = 4096
     while bytes_remaining:
-        bytes = input.read(min(block_size, bytes_remaining))
-        if len(bytes) == 0 or len(bytes) > bytes_remaining:
+        start = time.perf_counter()
+        bytes = os.copy_file_range(input_fd, output_fd, bytes_remaining, offset, output_offset)
+        if stats:
+            stats.add('copy', start, bytes)
+        if bytes == 0 or bytes > bytes_remaining:
+            raise RuntimeError('Unexpected number of bytes copied from input')
+        offset += bytes
+        output_offset += bytes
+        bytes_remaining -= bytes
+
+def copy_sendfile(input_fd, offset, output_fd, output_offset, size, stats=None):
+    start = time.perf_counter()
+    os.lseek(output_fd, output_offset, os.SEEK_SET)
+    if stats:
+        stats.add('seek', start)
+    bytes_remaining = size
+    while bytes_remaining:
+        start = time.perf_counter()
+        bytes = os.sendfile(output_fd, input_fd, offset, bytes_remaining)
+        if stats:
+            stats.add('copy', start, bytes)
+        if bytes == 0 or bytes > bytes_remaining:
+            raise RuntimeError('Unexpected number of bytes copied from input')
+        offset += bytes
+        bytes_remaining -= bytes
+
+def copy_read(input_fd, offset, output_fd, output_offset, size, buffer, hashers=(), stats=None):
+    bytes_remaining = size
+    while bytes_remaining:
+        view = buffer[:min(len(buffer), bytes_remaining)]
+        start = time.perf_counter()
+        bytes = os.preadv(input_fd, [view], offset)
+        if stats:
+            stats.add('read', start)
+        if bytes == 0 or bytes > bytes_remaining:
             raise RuntimeError('Unexpected number of bytes read from input')
-        if output.write(bytes) != len(bytes):
-            raise RuntimeError('Unexpected number of bytes written to output')
-        bytes_remaining -= len(bytes)
+        for hasher in hashers:
+            hasher.update(view[:bytes])
+        pwrite_all(output_fd, view[:bytes], output_offset, stats)
+        offset += bytes
+        output_offset += bytes
+        bytes_remaining -= bytes
+
+# Copy byte ranges between file descriptors with selected engine.
+# Engine "auto" falls back to the next engine in COPY_ENGINES if the current
+# engine is not supported for the file descriptors. Copies are positional
+# and may safely be restarted with another engine.
+# If hashers are provided the data is copied by engine "read" and hashers
+# are updated with the copied data. Another explicitly selected engine is
+# rejected by argument checks before copying.
+class Copier:
+    def __init__(self, engine='auto'):
+        if engine != 'auto' and engine not in COPY_ENGINES:
+            raise ValueError('Unknown copy engine "{}"'.format(engine))
+        self.engines = list(COPY_ENGINES) if engine == 'auto' else [engine]
+        self.buffer = None
+        self.used = set()
+
+    def copy(self, input_fd, offset, output_fd, output_offset, size, hashers=(), stats=None):
+        while True:
+            engine = 'read' if hashers else self.engines[0]
+            try:
+                if engine == 'copy_file_range':
+                    copy_file_range(input_fd, offset, output_fd, output_offset, size, stats)
+                elif engine == 'sendfile':
+                    copy_sendfile(input_fd, offset, output_fd, output_offset, size, stats)
+                else:
+                    if self.buffer is None:
+                        self.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+                    copy_read(input_fd, offset, output_fd, output_offset, size, self.buffer, hashers, stats)
+            except OSError as e:
+                if engine == 'read' or len(self.engines) == 1 or e.errno not in COPY_ENGINE_FALLBACK_ERRNOS:
+                    raise
+                self.engines.pop(0)
+                continue
+            self.used.add(engine)
+            return
+
+# Yield (offset, size) of data extents in input
+def data_extents(input_fd, stats=None):
+    offset = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            offset = os.lseek(input_fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No further data available
+                break
+            raise
+        finally:
+            if stats:
+                stats.add('seek', start)
+        start = time.perf_counter()
+        next_hole = os.lseek(input_fd, offset, os.SEEK_HOLE)
+        if stats:
+            stats.add('seek', start)
+        yield offset, next_hole - offset
+        offset = next_hole
+
+# Block size of bmap files and alignment of extents
+BMAP_BLOCK_SIZE = 4096
+
+# Align extents outwards to block_size, clip to limit and merge overlapping
+# and adjacent extents. Returns sorted list of (offset, size).
+def align_extents(extents, block_size, limit):
+    merged = []
+    for offset, size in sorted(extents):
+        start = offset - offset % block_size
+        end = min(-(-(offset + size) // block_size) * block_size, limit)
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end - start) for start, end in merged]
+
+# Update hashers with size zero bytes, used for holes
+def hash_zeros(hashers, size):
+    zeros = zero_buffer()
+    while size:
+        chunk = zeros[:min(len(zeros), size)]
+        for hasher in hashers:
+            hasher.update(chunk)
+        size -= len(chunk)
+
+# Write bmaptool compatible block map of format version 2.0.
+# ranges is list of block aligned (offset, size, sha256).
+def write_bmap(path, image_size, ranges):
+    blocks_count = -(-image_size // BMAP_BLOCK_SIZE)
+    mapped_count = sum(-(-size // BMAP_BLOCK_SIZE) for offset, size, chksum in ranges)
+    checksum_placeholder = '0' * hashlib.sha256().digest_size * 2
+    lines = ['<?xml version="1.0" ?>',
+             '<bmap version="2.0">',
+             '    <!-- Image size in bytes -->',
+             '    <ImageSize> {} </ImageSize>'.format(image_size),
+             '    <!-- Size of a block in bytes -->',
+             '    <BlockSize> {} </BlockSize>'.format(BMAP_BLOCK_SIZE),
+             '    <!-- Count of blocks in the image file -->',
+             '    <BlocksCount> {} </BlocksCount>'.format(blocks_count),
+             '    <!-- Count of mapped blocks -->',
+             '    <MappedBlocksCount> {} </MappedBlocksCount>'.format(mapped_count),
+             '    <!-- Type of checksum used in this file -->',
+             '    <ChecksumType> sha256 </ChecksumType>',
+             '    <!-- The checksum of this bmap file, calculated with this value set to zeros -->',
+             '    <BmapFileChecksum> {} </BmapFileChecksum>'.format(checksum_placeholder),
+             '    <BlockMap>']
+    for offset, size, chksum in ranges:
+        first = offset // BMAP_BLOCK_SIZE
+        last = first + -(-size // BMAP_BLOCK_SIZE) - 1
+        blocks = str(first) if first == last else '{}-{}'.format(first, last)
+        lines.append('        <Range chksum="{}"> {} </Range>'.format(chksum, blocks))
+    lines.extend(['    </BlockMap>', '</bmap>', ''])
+    content = '\n'.join(lines)
+    checksum = hashlib.sha256(content.encode()).hexdigest()
+    content = content.replace('<BmapFileChecksum> {} </BmapFileChecksum>'.format(checksum_placeholder),
+                              '<BmapFileChecksum> {} </BmapFileChecksum>'.format(checksum))
+    with open(path, 'w') as f:
+        f.write(content)
+
+# Write sha256 in format of sha256sum reading from stdin
+def write_sha256(path, digest):
+    with open(path, 'w') as f:
+        f.write('{}  -\n'.format(digest))
+
+# Extent map lists byte ranges of IMAGE written by gpt-insert
+def write_extent_map(path, extents):
+    with open(path, 'w') as f:
+        json.dump({'block_size': BMAP_BLOCK_SIZE, 'extents': extents}, f)
+
+def read_extent_map(path):
+    with open(path, 'r') as f:
+        extent_map = json.load(f)
+    if extent_map.get('block_size') != BMAP_BLOCK_SIZE:
+        raise ValueError('Extent map "{}" block size not {}'.format(path, BMAP_BLOCK_SIZE))
+    return [(offset, size) for offset, size in extent_map['extents']]
+
+# Byte ranges of IMAGE holding primary and backup gpt
+def gpt_metadata_extents(image):
+    fd = os.open(image, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        for sector_size in GPT_SECTOR_SIZES:
+            if os.pread(fd, len(GPT_SIGNATURE), sector_size) == GPT_SIGNATURE:
+                break
+        else:
+            raise ValueError('IMAGE header not of type gpt')
+        primary = read_gpt_header(fd, 1, sector_size)
+    finally:
+        os.close(fd)
+    backup_start = (primary['last_usable_lba'] + 1) * sector_size
+    return [(0, primary['first_usable_lba'] * sector_size),
+            (backup_start, (primary['backup_lba'] + 1) * sector_size - backup_start)]
+
+# Create bmap and sha256 of IMAGE in a single pass.
+# Without extent maps the mapped ranges are the data extents of IMAGE, as by
+# bmaptool create. With extent maps the mapped ranges are the gpt and the
+# extents written by gpt-insert, other ranges are treated as zero. The sha256
+# is then of IMAGE as installed by bmaptool to a zeroed device.
+def finalize(image, extent_maps, bmap, sha256, debug):
+    with open(image, 'rb') as image_file:
+        fd = image_file.fileno()
+        image_size = os.lseek(fd, 0, os.SEEK_END)
+        if extent_maps:
+            extents = gpt_metadata_extents(image)
+            for path in extent_maps:
+                extents.extend(read_extent_map(path))
+        else:
+            extents = list(data_extents(fd))
+        extents = align_extents(extents, BMAP_BLOCK_SIZE, image_size)
+
+        buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+        digest = hashlib.sha256()
+        ranges = []
+        position = 0
+        for offset, size in extents:
+            if debug:
+                print('mapped: {} -> {} [{} b]'.format(offset, offset + size, size))
+            hash_zeros([digest], offset - position)
+            range_digest = hashlib.sha256()
+            hash_range(fd, offset, size, [digest, range_digest], buffer)
+            ranges.append((offset, size, range_digest.hexdigest()))
+            position = offset + size
+        hash_zeros([digest], image_size - position)
+
+    if bmap:
+        write_bmap(bmap, image_size, ranges)
+    if sha256:
+        write_sha256(sha256, digest.hexdigest())
+
+# Parse insert in form LABEL=INPUT
+def parse_insert(arg):
+    label, sep, input = arg.partition('=')
+    if not sep or not label or not input:
+        raise ValueError('Invalid insert "{}", expected LABEL=INPUT'.format(arg))
+    return label, input
+
+# Read manifest of LABEL=INPUT lines. Empty lines and lines starting with #
+# are ignored. Relative INPUT paths are relative to manifest location.
+def read_manifest(path):
+    inserts = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            label, input = parse_insert(line)
+            inserts.append((label, os.path.join(os.path.dirname(path), input)))
+    return inserts
+
+# Validate inserts towards partition table and return list of jobs
+def prepare_jobs(inserts, part_data):
+    jobs = []
+    for label, input in inserts:
+        if label not in part_data:
+            raise RuntimeError('Partition label "{}" not found in IMAGE'.format(label))
+        if any(job['label'] == label for job in jobs):
+            raise ValueError('Partition label "{}" provided multiple times'.format(label))
+        if input == '-' and any(job['input'] == '-' for job in jobs):
+            raise ValueError('Input "-" provided multiple times')
+        # Size of streamed input is unknown and checked while writing
+        stream = input == '-' or not stat.S_ISREG(os.stat(input).st_mode) or detect_compression(input)
+        input_size = None if stream else os.stat(input).st_size
+        if input_size is not None and part_data[label]['size'] < input_size:
+            raise RuntimeError('Partition "{}" [{} b] smaller than input [{} b]'
+                                .format(label, part_data[label]['size'], input_size))
+        jobs.append({'label': label, 'input': input, 'input_size': input_size, 'stream': bool(stream),
+                     'offset': part_data[label]['offset'], 'size': part_data[label]['size']})
+
+    # Target ranges must not overlap as they are written concurrently
+    ordered = sorted(jobs, key=lambda job: job['offset'])
+    for previous, job in zip(ordered, ordered[1:]):
+        if previous['offset'] + previous['size'] > job['offset']:
+            raise RuntimeError('Partition "{}" overlaps partition "{}"'
+                                .format(previous['label'], job['label']))
+    return jobs
+
+# Compressed inputs are detected by magic and decompressed while streaming
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'xz'),
+                     (b'BZh', 'bzip2'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+def compression_from_magic(head):
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def detect_compression(path):
+    with open(path, 'rb') as f:
+        return compression_from_magic(f.read(max(len(magic) for magic, compression in COMPRESSION_MAGIC)))
+
+# Open input for streaming, decompressing if needed. Resources are
+# registered on stack.
+def open_stream(stack, path):
+    if path == '-':
+        raw = sys.stdin.buffer
+        compression = compression_from_magic(raw.peek(8))
+    else:
+        raw = stack.enter_context(open(path, 'rb'))
+        compression = detect_compression(path)
+    if compression == 'gzip':
+        return stack.enter_context(gzip.GzipFile(fileobj=raw, mode='rb')), compression
+    if compression == 'xz':
+        return stack.enter_context(lzma.LZMAFile(raw)), compression
+    if compression == 'bzip2':
+        return stack.enter_context(bz2.BZ2File(raw)), compression
+    if compression == 'zstd':
+        if importlib.util.find_spec('zstandard') is not None:
+            import zstandard
+            return stack.enter_context(zstandard.ZstdDecompressor().stream_reader(raw)), compression
+        if path == '-':
+            raise ValueError('zstd compressed stdin requires python zstandard module')
+        proc = stack.enter_context(subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE))
+        def check_zstd():
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise RuntimeError('zstd failed decompressing "{}"'.format(path))
+        stack.callback(check_zstd)
+        return proc.stdout, compression
+    return raw, 'none'
+
+# Read into buffer until full or end of input
+def readinto_full(input_file, buffer):
+    bytes = 0
+    while bytes < len(buffer):
+        count = input_file.readinto(buffer[bytes:])
+        if not count:
+            break
+        bytes += count
+    return bytes
+
+# Return list of [start, end] of blocks not being all zero in chunk
+def nonzero_runs(chunk, block_size):
+    zeros = zero_buffer()
+    if chunk == zeros[:len(chunk)]:
+        return []
+    numpy = get_numpy()
+    if numpy is not None and len(chunk) % block_size == 0 and block_size % 8 == 0:
+        flags = numpy.frombuffer(chunk, dtype=numpy.uint64).reshape(-1, block_size // 8).any(axis=1)
+        edges = numpy.flatnonzero(numpy.diff(flags, prepend=False, append=False)) * block_size
+        return [[int(start), int(end)] for start, end in zip(edges[0::2], edges[1::2])]
+    runs = []
+    for start in range(0, len(chunk), block_size):
+        block = chunk[start:start + block_size]
+        if block == zeros[:len(block)]:
+            continue
+        end = start + len(block)
+        if runs and runs[-1][1] == start:
+            runs[-1][1] = end
+        else:
+            runs.append([start, end])
+    return runs
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+@functools.cache
+def get_fallocate():
+    libc = ctypes.CDLL(None, use_errno=True)
+    fallocate = libc.fallocate64 if hasattr(libc, 'fallocate64') else libc.fallocate
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+# Deallocate range of file, reading back as zeros
+def punch_hole(fd, offset, size):
+    if get_fallocate()(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, size) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, 'Failed punching hole at {} [{} b]: {}'.format(offset, size, os.strerror(e)))
+
+# Punch holes in partition for all ranges not written by insert and for
+# all blocks of zeros in written ranges. written is list of (offset, size)
+# relative to IMAGE. Returns number of bytes deallocated.
+def sparsify_partition(image, job, written, debug):
+    prefix = '[{}] '.format(job['label'])
+    holes = []
+    position = job['offset']
+    buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    with open(image, 'r+b') as image_file:
+        fd = image_file.fileno()
+        for offset, size in sorted(written) + [(job['offset'] + job['size'], 0)]:
+            if offset > position:
+                holes.append([position, offset])
+            # Scan written range for blocks of zeros
+            end = offset + size
+            while offset < end:
+                view = buffer[:min(len(buffer), end - offset)]
+                bytes = os.preadv(fd, [view], offset)
+                if bytes == 0:
+                    raise RuntimeError('Unexpected number of bytes read from IMAGE')
+                chunk = view[:bytes]
+                start = 0
+                for run_start, run_end in nonzero_runs(chunk, BMAP_BLOCK_SIZE) + [[bytes, bytes]]:
+                    if run_start > start:
+                        if holes and holes[-1][1] == offset + start:
+                            holes[-1][1] = offset + run_start
+                        else:
+                            holes.append([offset + start, offset + run_start])
+                    start = run_end
+                offset += bytes
+            position = max(position, end)
+
+        for start, end in holes:
+            if debug:
+                print('{}punch: {} -> {} [{} b]'.format(prefix, start - job['offset'],
+                                                        end - job['offset'], end - start))
+            punch_hole(fd, start, end - start)
+    punched = sum(end - start for start, end in holes)
+    if debug:
+        print('{}Punched:     {} b'.format(prefix, punched))
+    return punched
+
+# Stream input to partition in chunks. Blocks of all zeros are skipped,
+# keeping IMAGE sparse. Partition size is checked while streaming.
+# Returns same as insert_partition().
+def stream_partition(image, job, debug):
+    prefix = '[{}] '.format(job['label'])
+    digest = hashlib.sha256() if job.get('sha256') else None
+    buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    # written extents as [offset, size] relative to input and bmap range digests
+    extents = []
+    range_digests = []
+    position = 0
+    with contextlib.ExitStack() as stack:
+        input_file, compression = open_stream(stack, job['input'])
+        if debug:
+            print('{}Input stream compression: {}'.format(prefix, compression))
+        output_fd = stack.enter_context(open(image, 'r+b')).fileno()
+        stats = job.get('stats')
+        while True:
+            start = time.perf_counter()
+            bytes = readinto_full(input_file, buffer)
+            if stats:
+                stats.add('read', start)
+            if bytes == 0:
+                break
+            if position + bytes > job['size']:
+                raise RuntimeError('Partition "{}" [{} b] smaller than input [> {} b]'
+                                    .format(job['label'], job['size'], position + bytes))
+            chunk = buffer[:bytes]
+            if digest:
+                digest.update(chunk)
+            for start, end in nonzero_runs(chunk, BMAP_BLOCK_SIZE):
+                offset = position + start
+                pwrite_all(output_fd, chunk[start:end], job['offset'] + offset, stats)
+                if extents and extents[-1][0] + extents[-1][1] == offset:
+                    extents[-1][1] += end - start
+                else:
+                    extents.append([offset, end - start])
+                    if job.get('bmap'):
+                        range_digests.append(hashlib.sha256())
+                if job.get('bmap'):
+                    range_digests[-1].update(chunk[start:end])
+            position += bytes
+
+    job['input_size'] = position
+    if debug:
+        for offset, size in extents:
+            print('{}input: {} -> {} [{} b]'.format(prefix, offset, offset + size, size))
+        print('{}Input size:  {} b'.format(prefix, position))
+    if job.get('bmap'):
+        write_bmap(job['bmap'], position, [(offset, size, range_digest.hexdigest())
+                                           for (offset, size), range_digest in zip(extents, range_digests)])
+    if digest:
+        write_sha256(job['sha256'], digest.hexdigest())
+    return [(job['offset'] + offset, size) for offset, size in extents]
+
+# Block size compared by --incremental and hashed for --index
+INCREMENTAL_BLOCK_SIZE = 64 * 1024
+INDEX_DIGEST_SIZE = 16
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=INDEX_DIGEST_SIZE).digest()
+
+@functools.cache
+def zero_block_digest():
+    return block_digest(zero_buffer()[:INCREMENTAL_BLOCK_SIZE])
+
+# Identity of IMAGE for validating index, None if not a regular file
+def image_identity(image):
+    st = os.stat(image)
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+# Index holds digests of INCREMENTAL_BLOCK_SIZE blocks of partitions written
+# by --incremental. An index is only valid while IMAGE is unmodified.
+def read_index(path, image):
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return {}
+    identity = image_identity(image)
+    if (identity is None or index.get('image') != identity
+            or index.get('block_size') != INCREMENTAL_BLOCK_SIZE
+            or index.get('digest_size') != INDEX_DIGEST_SIZE):
+        return {}
+    partitions = index.get('partitions', {})
+    for entry in partitions.values():
+        entry['hashes'] = base64.b64decode(entry['hashes'])
+    return partitions
+
+def write_index(path, image, partitions):
+    index = {'image': image_identity(image), 'block_size': INCREMENTAL_BLOCK_SIZE,
+             'digest_size': INDEX_DIGEST_SIZE,
+             'partitions': {label: {'offset': entry['offset'], 'size': entry['size'],
+                                    'hashes': base64.b64encode(entry['hashes']).decode()}
+                            for label, entry in partitions.items()}}
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+
+# Write only blocks of input differing from partition content. Blocks are
+# compared to digests in index if available, else to data read from IMAGE.
+# Digests of input blocks are stored in job['hashes'] if index is used.
+# Returns same as insert_partition().
+def incremental_partition(image, job, index, debug):
+    prefix = '[{}] '.format(job['label'])
+    block_size = INCREMENTAL_BLOCK_SIZE
+    entry = index.get(job['label']) if index is not None else None
+    old = entry['hashes'] if entry and entry['offset'] == job['offset'] and entry['size'] == job['size'] else None
+    if debug:
+        print('{}Input size:  {} b'.format(prefix, job['input_size']))
+        print('{}Part offset: {} b'.format(prefix, job['offset']))
+        print('{}Part size:   {} b'.format(prefix, job['size']))
+        print('{}Index:       {}'.format(prefix, 'valid' if old is not None else 'none'))
+    hashes = bytearray()
+    input_buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    target_buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    rewritten = 0
+    stats = job.get('stats')
+    with open(job['input'], 'rb') as input_file, open(image, 'r+b') as output_file:
+        input_fd = input_file.fileno()
+        output_fd = output_file.fileno()
+        extents = align_extents(data_extents(input_fd, stats), block_size, job['input_size'])
+        extent_ends = [offset + size for offset, size in extents]
+        for offset in range(0, job['input_size'], len(input_buffer)):
+            size = min(len(input_buffer), job['input_size'] - offset)
+            blocks = range(0, size, block_size)
+            # Batches in input holes are zero and not read
+            i = bisect.bisect_right(extent_ends, offset)
+            hole = i == len(extents) or extents[i][0] >= offset + size
+            chunk = zero_buffer()[:size] if hole else input_buffer[:size]
+            if not hole:
+                pread_full(input_fd, chunk, offset, stats)
+
+            if index is not None:
+                digests = [zero_block_digest() if hole and len(chunk[x:x + block_size]) == block_size
+                           else block_digest(chunk[x:x + block_size]) for x in blocks]
+                hashes.extend(b''.join(digests))
+            first = offset // block_size
+            if old is not None and len(old) >= (first + len(blocks)) * INDEX_DIGEST_SIZE:
+                differ = [x for n, x in enumerate(blocks)
+                          if old[(first + n) * INDEX_DIGEST_SIZE:(first + n + 1) * INDEX_DIGEST_SIZE] != digests[n]]
+            else:
+                target = target_buffer[:size]
+                pread_full(output_fd, target, job['offset'] + offset, stats)
+                differ = [x for x in blocks if chunk[x:x + block_size] != target[x:x + block_size]]
+
+            for x in differ:
+                data = chunk[x:x + block_size]
+                pwrite_all(output_fd, data, job['offset'] + offset + x, stats)
+                rewritten += len(data)
+
+    if index is not None:
+        job['hashes'] = bytes(hashes)
+    ratio = 100 * rewritten / job['input_size'] if job['input_size'] else 0
+    print('{}Rewritten:   {} of {} b ({:.1f}%)'.format(prefix, rewritten, job['input_size'], ratio))
+    return [(job['offset'] + offset, size)
+            for offset, size in align_extents(extents, BMAP_BLOCK_SIZE, job['input_size'])]
+
+# Extents are journaled in pieces of at most JOURNAL_EXTENT_SIZE. Journal
+# and written data are synced when either limit is reached.
+JOURNAL_EXTENT_SIZE = 64 * 1024 * 1024
+JOURNAL_SYNC_BYTES = 256 * 1024 * 1024
+JOURNAL_SYNC_SECONDS = 5
+JOURNAL_VERSION = 1
+
+def journal_digest():
+    return hashlib.blake2b(digest_size=INDEX_DIGEST_SIZE)
+
+# Journal of input extents written to IMAGE, one JSON object per line.
+# First line identifies IMAGE, inputs and target partitions, following
+# lines are completed extents {label, offset, size, hash}. Data is synced
+# to IMAGE before extents are appended, so each extent in the journal is
+# durable. With resume an existing journal is continued if it matches.
+class Journal:
+    def __init__(self, path, image, jobs, part_data, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.synced = time.monotonic()
+        self.done = {}
+        st = os.stat(image)
+        self.header = {'version': JOURNAL_VERSION, 'image': [st.st_dev, st.st_ino],
+                       'partitions': {}}
+        for job in jobs:
+            input_st = os.stat(job['input'])
+            self.header['partitions'][job['label']] = {
+                'input': os.path.abspath(job['input']),
+                'input_identity': [input_st.st_dev, input_st.st_ino, input_st.st_size, input_st.st_mtime_ns],
+                'partition': part_data[job['label']]}
+        # Normalize as read back from file
+        self.header = json.loads(json.dumps(self.header))
+        self.image_fd = os.open(image, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            if resume and os.path.exists(path):
+                self.load(jobs)
+                self.file = open(path, 'a')
+            else:
+                self.file = open(path, 'w')
+                self.file.write(json.dumps(self.header) + '\n')
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        except Exception:
+            os.close(self.image_fd)
+            raise
+
+    def load(self, jobs):
+        with open(self.path, 'r') as f:
+            lines = f.read().split('\n')
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if header != self.header:
+            raise RuntimeError('Journal {} does not match IMAGE, inputs or partitions, '
+                               'remove it or run without --resume'.format(self.path))
+        last = {}
+        length = len(lines[0]) + 1
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line may be incomplete if interrupted
+                break
+            self.done[(entry['label'], entry['offset'], entry['size'])] = entry['hash']
+            last[entry['label']] = entry
+            length += len(line) + 1
+        # Drop incomplete line before appending
+        os.truncate(self.path, length)
+        # Last extent of each partition is read back from IMAGE and redone if modified
+        offsets = {job['label']: job['offset'] for job in jobs}
+        for label, entry in last.items():
+            digest = journal_digest()
+            hash_range(self.image_fd, offsets[label] + entry['offset'], entry['size'], [digest],
+                       memoryview(bytearray(min(entry['size'], COPY_BUFFER_SIZE))))
+            if digest.hexdigest() != entry['hash']:
+                del self.done[(label, entry['offset'], entry['size'])]
+
+    def is_done(self, label, offset, size):
+        return (label, offset, size) in self.done
+
+    def record(self, label, offset, size, digest):
+        with self.lock:
+            self.pending.append(json.dumps({'label': label, 'offset': offset, 'size': size, 'hash': digest}))
+            self.pending_bytes += size
+            if (self.pending_bytes >= JOURNAL_SYNC_BYTES
+                    or time.monotonic() - self.synced >= JOURNAL_SYNC_SECONDS):
+                self._sync()
+
+    def _sync(self):
+        # Data of pending extents must be durable before they are journaled
+        os.fdatasync(self.image_fd)
+        if self.pending:
+            self.file.write(''.join(line + '\n' for line in self.pending))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.pending = []
+        self.pending_bytes = 0
+        self.synced = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        self.file.close()
+        os.close(self.image_fd)
+
+# Split extents in pieces journaled separately
+def journal_pieces(offset, size, journal):
+    if journal is None:
+        return [(offset, size)]
+    return [(x, min(JOURNAL_EXTENT_SIZE, offset + size - x))
+            for x in range(offset, offset + size, JOURNAL_EXTENT_SIZE)]
+
+def write_partition(image, job, args, index):
+    start = time.perf_counter()
+    if args.incremental:
+        written = incremental_partition(image, job, index, args.debug)
+    else:
+        written = insert_partition(image, job, args.copy_engine, args.debug)
+    if args.sparsify:
+        sparsify_partition(image, job, written, args.debug)
+    job['seconds'] = time.perf_counter() - start
+    job['data_bytes'] = sum(size for offset, size in written)
+    return written
+
+# Throughput summary of stats, totals of all partitions and per partition
+def stats_summary(input_bytes, data_bytes, written, seconds, times, syscalls):
+    return {'input_bytes': input_bytes, 'data_bytes': data_bytes, 'hole_bytes': input_bytes - data_bytes,
+            'written_bytes': written,
+            'sparse_ratio': round((input_bytes - data_bytes) / input_bytes, 6) if input_bytes else 0.0,
+            'seconds': round(seconds, 6),
+            'input_bytes_per_s': round(input_bytes / seconds) if seconds else None,
+            'data_bytes_per_s': round(data_bytes / seconds) if seconds else None,
+            'time': {k: round(v, 6) for k, v in times.items()}, 'syscalls': syscalls}
+
+def write_stats(path, jobs, seconds):
+    partitions = {}
+    for job in jobs:
+        stats = job['stats']
+        partitions[job['label']] = stats_summary(job['input_size'], job['data_bytes'], stats.written,
+                                                 job['seconds'], stats.time, stats.syscalls)
+        partitions[job['label']]['extents'] = stats.extents
+    total = stats_summary(sum(x['input_bytes'] for x in partitions.values()),
+                          sum(x['data_bytes'] for x in partitions.values()),
+                          sum(x['written_bytes'] for x in partitions.values()), seconds,
+                          {k: sum(job['stats'].time[k] for job in jobs) for k in STATS_CATEGORIES},
+                          {k: sum(job['stats'].syscalls[k] for job in jobs) for k in STATS_CATEGORIES})
+    with open(path, 'w') as f:
+        json.dump({'total': total, 'partitions': partitions}, f, indent=2)
+        f.write('\n')
+
+# Report bytes written at interval from a separate thread, the copy loop
+# only updates counters of Stats.
+class Progress(threading.Thread):
+    def __init__(self, jobs, interval):
+        super().__init__(daemon=True)
+        self.jobs = jobs
+        self.interval = interval
+        self.done = threading.Event()
+        self.start_time = time.perf_counter()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.report()
+
+    def report(self):
+        written = sum(job['stats'].written for job in self.jobs)
+        seconds = time.perf_counter() - self.start_time
+        rate = written / (1 << 20) / seconds if seconds else 0.0
+        totals = [job['stats'].total for job in self.jobs]
+        if None in totals:
+            print('Progress:    {} b, {:.1f} MiB/s'.format(written, rate), flush=True)
+        else:
+            total = sum(totals)
+            ratio = 100 * written / total if total else 100.0
+            print('Progress:    {} of {} b ({:.1f}%), {:.1f} MiB/s'.format(written, total, ratio, rate), flush=True)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.report()
+
+# Write input to partition. Each call uses its own file descriptors and
+# positional writes and is thus safe to run concurrently for non-overlapping partitions.
+# Data extents are aligned to BMAP_BLOCK_SIZE and returned as list of
+# (offset, size) relative to IMAGE. If bmap or sha256 paths are set for the job
+# these are created for input while copying.
+def insert_partition(image, job, copy_engine, debug):
+    prefix = '[{}] '.format(job['label'])
+    if job['stream']:
+        if debug:
+            print('{}Input:       stream'.format(prefix))
+            print('{}Part offset: {} b'.format(prefix, job['offset']))
+            print('{}Part size:   {} b'.format(prefix, job['size']))
+        return stream_partition(image, job, debug)
+    if debug:
+        print('{}Input size:  {} b'.format(prefix, job['input_size']))
+        print('{}Part offset: {} b'.format(prefix, job['offset']))
+        print('{}Part size:   {} b'.format(prefix, job['size']))
+    written = []
+    journal = job.get('journal')
+    resumed = 0
+    stats = job.get('stats')
+    with open(job['input'], 'rb') as input_file, open(image, 'r+b') as output_file:
+        copier = Copier(copy_engine)
+        extents = align_extents(data_extents(input_file.fileno(), stats), BMAP_BLOCK_SIZE, job['input_size'])
+        if stats:
+            stats.total = sum(size for offset, size in extents)
+        digest = hashlib.sha256() if job.get('sha256') else None
+        ranges = []
+        position = 0
+        for offset, size in extents:
+            if debug:
+                print('{}input: {} -> {} [{} b]'.format(prefix, offset, offset + size, size))
+            if stats:
+                extent_start = time.perf_counter()
+                snapshot = stats.snapshot()
+            hashers = []
+            if digest:
+                hash_zeros([digest], offset - position)
+                hashers.append(digest)
+            range_digest = hashlib.sha256() if job.get('bmap') else None
+            if range_digest:
+                hashers.append(range_digest)
+            for piece_offset, piece_size in journal_pieces(offset, size, journal):
+                if journal and journal.is_done(job['label'], piece_offset, piece_size):
+                    # Already written, only hashed for bmap and sha256
+                    if hashers:
+                        if copier.buffer is None:
+                            copier.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+                        hash_range(input_file.fileno(), piece_offset, piece_size, hashers, copier.buffer)
+                    resumed += piece_size
+                    continue
+                piece_digest = journal_digest() if journal else None
+                if journal and hashers:
+                    # Copied by engine read anyway, hashed while copied
+                    copier.copy(input_file.fileno(), piece_offset, output_file.fileno(),
+                                job['offset'] + piece_offset, piece_size, hashers + [piece_digest], stats)
+                else:
+                    copier.copy(input_file.fileno(), piece_offset, output_file.fileno(),
+                                job['offset'] + piece_offset, piece_size, hashers, stats)
+                    if journal:
+                        # Hash written range of IMAGE, as verified on resume
+                        if copier.buffer is None:
+                            copier.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+                        hash_range(output_file.fileno(), job['offset'] + piece_offset, piece_size,
+                                   [piece_digest], copier.buffer, stats)
+                if journal:
+                    journal.record(job['label'], piece_offset, piece_size, piece_digest.hexdigest())
+            if range_digest:
+                ranges.append((offset, size, range_digest.hexdigest()))
+            if stats:
+                stats.extent(offset, size, extent_start, snapshot)
+            written.append((job['offset'] + offset, size))
+            position = offset + size
+        if digest:
+            hash_zeros([digest], job['input_size'] - position)
+        if debug:
+            print('{}Copy engine: {}'.format(prefix, ', '.join(sorted(copier.used)) or 'none'))
+    if journal:
+        print('{}Resumed:     {} of {} b'.format(prefix, resumed, job['input_size']))
+
+    if job.get('bmap'):
+        write_bmap(job['bmap'], job['input_size'], ranges)
+    if digest:
+        write_sha256(job['sha256'], digest.hexdigest())
+    return written
 
 def main():
     parser = ArgumentParser(description='''Write data to image file gpt partitions''',
                                      epilog='''Return value:
 0 for success, 1 for failure
+
+Multiple partitions may be written in one invocation by --insert and --manifest.
+The partition table is then only parsed once and partitions written in parallel.
+Manifest format is one LABEL=INPUT per line, lines starting with # are ignored.
+
+With --sparsify the whole target partition is left sparse after writing:
+blocks of zeros and ranges not covered by INPUT, such as stale data from
+earlier writes, are deallocated by punching holes.
+
+With --incremental INPUT is compared to the partition in blocks of 64 KiB
+and only differing blocks are written. The number of rewritten bytes is
+reported. An --index file of block digests avoids reading IMAGE on the next
+run, it is only used while IMAGE is unmodified since it was written.
+
+With --journal extents written are recorded in a journal file, synced in
+batches together with IMAGE. If interrupted, a run with --resume and the same
+arguments continues after the last journaled extent. The journal is only
+used if IMAGE, inputs and target partitions are unchanged, else it fails.
+The journal is kept after completion, a resumed run then writes nothing.
+Journaled extents are copied by --copy-engine and hashed from IMAGE after
+being written.
+
+INPUT may be "-" for stdin. Inputs compressed by gzip, xz, bzip2 or zstd are
+decompressed while writing. Such inputs are streamed and blocks of all zeros
+are not written, keeping IMAGE sparse.
+
+With --stats a JSON summary is written with totals and per partition data,
+hole and written bytes, throughput, and time and number of syscalls spent
+reading, writing, copying and seeking, including each data extent for
+uncompressed inputs. --progress prints bytes written at an interval.
+--profile writes cProfile statistics of the run, readable by
+"python3 -m pstats". Partitions written in parallel are profiled in each
+worker thread and merged with the main thread.
+
+Bmap and sha256 of IMAGE may be created in a single pass by --finalize.
+If extent maps written by --extent-map are provided only the gpt and the
+extents written by gpt-insert are mapped, all other ranges are treated as zero.
 ''',
                                      formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument('IMAGE', help='Path to image file')
     parser.add_argument('--label', help='Label of target partition')
-    parser.add_argument('--input', help='Data being written to target partition')
+    parser.add_argument('--input', help='Data being written to target partition, "-" for stdin')
+    parser.add_argument('--insert', action='append', default=[], metavar='LABEL=INPUT',
+                        help='Write INPUT to partition LABEL, may be provided multiple times')
+    parser.add_argument('--manifest', help='Path to file with LABEL=INPUT lines')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='Number of partitions written in parallel, default one per partition')
+    parser.add_argument('--bmap', help='Create bmap of INPUT while writing, or of IMAGE with --finalize')
+    parser.add_argument('--sha256', help='Create sha256 of INPUT while writing, or of IMAGE with --finalize')
+    parser.add_argument('--extent-map', action='append', default=[],
+                        help='Write extents written to IMAGE to file, or with --finalize '
+                             'read extents from file. May be provided multiple times with --finalize')
+    parser.add_argument('--finalize', action='store_true',
+                        help='Create --bmap and/or --sha256 of IMAGE')
+    parser.add_argument('--sparsify', action='store_true',
+                        help='Deallocate blocks of zeros and ranges of partition not written by INPUT')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only write blocks of INPUT differing from partition content')
+    parser.add_argument('--index', help='Block digest index of IMAGE used and updated by --incremental')
+    parser.add_argument('--journal', help='Record extents written to IMAGE in file')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue writing after extents recorded in --journal')
+    parser.add_argument('--stats', help='Write JSON throughput statistics to file')
+    parser.add_argument('--progress', type=float, metavar='SECONDS',
+                        help='Print progress every SECONDS')
+    parser.add_argument('--profile', help='Write cProfile statistics of run to file')
+    parser.add_argument('--gpt-reader', default='auto', choices=['auto', 'builtin', 'parted'],
+                        help='Partition table reader, default builtin with pyparted as fallback')
+    parser.add_argument('--copy-engine', default='auto', choices=['auto'] + COPY_ENGINES,
+                        help='Method for copying data extents, default auto. '
+                             'Only auto and read with --bmap and --sha256')
     parser.add_argument('--debug', action='store_true')
     args = parser.parse_args()
 
-    if not args.label:
-        raise ValueError('Mandatory argument --label missing')
-    if not args.input:
-        raise ValueError('Mandatory argument --input missing')
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiles = []
+        try:
+            profiler.runcall(run, args, profiles)
+        finally:
+            write_profile(args.profile, profiler, profiles)
+    else:
+        run(args)
+
+# Call function with its own profiler, appended to profiles. cProfile only
+# profiles the thread it is enabled in.
+def run_profiled(profiles, function, *args):
+    profiler = cProfile.Profile()
+    profiles.append(profiler)
+    return profiler.runcall(function, *args)
+
+# Write statistics of main thread profiler merged with worker profiles
+def write_profile(path, profiler, profiles):
+    stats = pstats.Stats(profiler)
+    for worker in profiles:
+        stats.add(worker)
+    stats.dump_stats(path)
+
+# profiles is list collecting profilers of worker threads if profiling
+def run(args, profiles=None):
+    if args.finalize:
+        if args.label or args.input or args.insert or args.manifest:
+            raise ValueError('Argument --finalize can not be combined with writing partitions')
+        if args.stats or args.progress:
+            raise ValueError('Arguments --stats and --progress can not be combined with --finalize')
+        if not args.bmap and not args.sha256:
+            raise ValueError('Argument --finalize requires --bmap and/or --sha256')
+        finalize(args.IMAGE, args.extent_map, args.bmap, args.sha256, args.debug)
+        sys.exit(0)
+
+    inserts = [parse_insert(x) for x in args.insert]
+    if args.manifest:
+        inserts.extend(read_manifest(args.manifest))
+    if args.label or args.input:
+        if not args.label:
+            raise ValueError('Mandatory argument --label missing')
+        if not args.input:
+            raise ValueError('Mandatory argument --input missing')
+        inserts.insert(0, (args.label, args.input))
+    if not inserts:
+        raise ValueError('Mandatory argument --label and --input, --insert or --manifest missing')
+    if args.jobs < 0:
+        raise ValueError('Invalid argument --jobs')
+    if (args.bmap or args.sha256) and len(inserts) != 1:
+        raise ValueError('Arguments --bmap and --sha256 require a single input')
+    if len(args.extent_map) > 1:
+        raise ValueError('Argument --extent-map provided multiple times')
+    if args.index and not args.incremental:
+        raise ValueError('Argument --index requires --incremental')
+    if args.incremental and (args.bmap or args.sha256):
+        raise ValueError('Argument --incremental can not be combined with --bmap or --sha256')
+    if args.resume and not args.journal:
+        raise ValueError('Argument --resume requires --journal')
+    if args.journal and args.incremental:
+        raise ValueError('Argument --journal can not be combined with --incremental')
+    if args.copy_engine not in ('auto', 'read') and (args.bmap or args.sha256):
+        raise ValueError('Argument --copy-engine {} can not be combined with --bmap or --sha256, '
+                         'data is hashed while copied by engine read'.format(args.copy_engine))
+    if args.progress is not None and args.progress <= 0:
+        raise ValueError('Invalid argument --progress')
 
-    part_data = get_partitions(args.IMAGE)
+    part_data = get_partitions(args.IMAGE, args.gpt_reader)
 
-    if not args.label in part_data:
+    try:
+        jobs = prepare_jobs(inserts, part_data)
+    except RuntimeError:
         if args.debug:
             print(part_data)
-        raise RuntimeError('Partition label "{}" not found in IMAGE'.format(args.label))
+        raise
+    if args.incremental and any(job['stream'] for job in jobs):
+        raise ValueError('Argument --incremental requires uncompressed regular file inputs')
+    if args.journal and any(job['stream'] for job in jobs):
+        raise ValueError('Argument --journal requires uncompressed regular file inputs')
+    index = read_index(args.index, args.IMAGE) if args.index else None
+    journal = Journal(args.journal, args.IMAGE, jobs, part_data, args.resume) if args.journal else None
+    for job in jobs:
+        job['journal'] = journal
+        job['stats'] = Stats() if args.stats or args.progress else None
+    progress = Progress(jobs, args.progress) if args.progress else None
+    if progress:
+        progress.start()
+    start = time.perf_counter()
 
-    with open(args.input, 'rb') as input_file:
-        input_size = os.fstat(input_file.fileno()).st_size
-        if part_data[args.label]['size'] < input_size:
-            raise RuntimeError('Partition "{}" [{} b] smaller than input [{} b]'
-                                .format(args.label, part_data[args.label]['size'], input_size))
-        if args.debug:
-            print('Input size:  {} b'.format(input_size))
-            print('Part offset: {} b'.format(part_data[args.label]['offset']))
-            print('Part size:   {} b'.format(part_data[args.label]['size']))
-
-        with open(args.IMAGE, 'r+b') as output_file:
-            offset = 0
-            size = 0
-            while True:
-                try:
-                    offset = input_file.seek(offset, os.SEEK_DATA)
-                except OSError as e:
-                    if e.errno == errno.ENXIO:
-                        # No further data available
-                        break
-                next_hole = input_file.seek(offset, os.SEEK_HOLE)
-                size = next_hole - offset
-
-                if args.debug:
-                    print('input: {} -> {} [{} b]'.format(offset, offset + size, size))
-
-                input_file.seek(offset, os.SEEK_SET)
-                output_file.seek(part_data[args.label]['offset'] + offset, os.SEEK_SET)
-                write(input_file, size, output_file)
-                offset += size
+    try:
+        if len(jobs) == 1:
+            jobs[0]['bmap'] = args.bmap
+            jobs[0]['sha256'] = args.sha256
+            written = write_partition(args.IMAGE, jobs[0], args, index)
+        else:
+            written = []
+            target = write_partition
+            if profiles is not None:
+                target = functools.partial(run_profiled, profiles, write_partition)
+            with ThreadPoolExecutor(max_workers=args.jobs or len(jobs)) as executor:
+                futures = [executor.submit(target, args.IMAGE, job, args, index)
+                           for job in jobs]
+                for future in futures:
+                    written.extend(future.result())
+    finally:
+        # Extents completed before a failure are kept for --resume
+        if journal:
+            journal.sync()
+            journal.close()
+        if progress:
+            progress.stop()
+
+    if args.stats:
+        write_stats(args.stats, jobs, time.perf_counter() - start)
+
+    if args.extent_map:
+        write_extent_map(args.extent_map[0], sorted(written))
+    if args.index:
+        # Partitions not written keep their digests as IMAGE was unmodified at start
+        index.update({job['label']: job for job in jobs})
+        write_index(args.index, args.IMAGE, index)
 
     sys.exit(0)
 
@@ -0,0 +1,49 @@
+# bmap parsing shared by verify-device and flash-devices. Installed next to
+# them in bindir, where it is found as the directory of the running script.
+
+import hashlib
+import xml.etree.ElementTree as ET
+
+# Parse bmap and validate BmapFileChecksum. Returns dict of image_size,
+# block_size, checksum_type and ranges of (offset, size, chksum) in bytes.
+def read_bmap(path):
+    with open(path, 'r') as f:
+        content = f.read()
+    root = ET.fromstring(content)
+    if root.tag != 'bmap':
+        raise ValueError('{}: not a bmap file'.format(path))
+    major = root.get('version', '1').split('.')[0]
+    if major != '2':
+        raise ValueError('{}: unsupported bmap version {}'.format(path, root.get('version')))
+
+    def field(name):
+        element = root.find(name)
+        if element is None:
+            raise ValueError('{}: missing {}'.format(path, name))
+        return element.text.strip()
+
+    image_size = int(field('ImageSize'))
+    block_size = int(field('BlockSize'))
+    checksum_type = field('ChecksumType')
+    if checksum_type not in hashlib.algorithms_available:
+        raise ValueError('{}: unsupported checksum type {}'.format(path, checksum_type))
+    file_checksum = field('BmapFileChecksum')
+    placeholder = content.replace(file_checksum, '0' * len(file_checksum), 1)
+    if hashlib.new(checksum_type, placeholder.encode()).hexdigest() != file_checksum:
+        raise ValueError('{}: BmapFileChecksum mismatch'.format(path))
+
+    ranges = []
+    for element in root.find('BlockMap').findall('Range'):
+        chksum = element.get('chksum')
+        if chksum is None:
+            raise ValueError('{}: range without checksum'.format(path))
+        blocks = element.text.strip().split('-')
+        first = int(blocks[0])
+        last = int(blocks[-1])
+        offset = first * block_size
+        size = min((last + 1) * block_size, image_size) - offset
+        if last < first or size <= 0:
+            raise ValueError('{}: invalid range {}'.format(path, element.text.strip()))
+        ranges.append((offset, size, chksum))
+    return {'image_size': image_size, 'block_size': block_size,
+            'checksum_type': checksum_type, 'ranges': ranges}
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Read and verify image containers in process.
+#
+# A container is memory mapped and its regions are exposed as memoryviews of
+# the mapping, no data is copied. Signature of the roothash is verified with
+# the hash function selected by key size as described in README.md, and data
+# is verified against the dm-verity hash tree.
+#
+# Trusted keys are loaded once by TrustedKeys and may be shared by any number
+# of verifications, verify_many() verifies containers in parallel threads.
+
+import sys
+import os
+import mmap
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
+
+HEADER_MAGIC = 0x494d4721
+# magic, reserved, tree_offset, root_offset, digest_offset, key_offset
+HEADER = struct.Struct('<I28sQQQQ')
+
+VERITY_SIGNATURE = b'verity\0\0'
+# signature, version, hash_type, uuid, algorithm, data_block_size,
+# hash_block_size, data_blocks, salt_size, reserved, salt
+VERITY_SUPERBLOCK = struct.Struct('<8sII16s32sIIQH6s256s')
+VERITY_SUPERBLOCK_SIZE = 512
+
+class ContainerError(RuntimeError):
+    pass
+
+# Return hash algorithm for key as selected by container-util
+def key_hash(public_key):
+    if isinstance(public_key, rsa.RSAPublicKey):
+        bits = public_key.key_size
+        if bits >= 15360:
+            return hashes.SHA512()
+        if bits >= 7680:
+            return hashes.SHA384()
+        return hashes.SHA256()
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        bits = public_key.curve.key_size
+        if bits >= 512:
+            return hashes.SHA512()
+        if bits >= 384:
+            return hashes.SHA384()
+        return hashes.SHA256()
+    raise ContainerError('Unsupported key type {}'.format(type(public_key).__name__))
+
+def public_key_der(public_key):
+    return public_key.public_bytes(encoding=serialization.Encoding.DER,
+                                   format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+# Return public keys of PEM or DER encoded file, private keys are reduced to their public key
+def load_public_keys(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    keys = []
+    if b'-----BEGIN ' in data:
+        blocks = [b'-----BEGIN ' + block for block in data.split(b'-----BEGIN ')[1:]]
+        loaders = [serialization.load_pem_public_key,
+                   lambda x: serialization.load_pem_private_key(x, password=None).public_key()]
+    else:
+        blocks = [data]
+        loaders = [serialization.load_der_public_key,
+                   lambda x: serialization.load_der_private_key(x, password=None).public_key()]
+    for block in blocks:
+        for loader in loaders:
+            try:
+                keys.append(loader(block))
+                break
+            except (ValueError, TypeError):
+                continue
+    return keys
+
+class TrustedKeys:
+    # Keys are loaded from files and all regular files of directories once
+    def __init__(self, paths=(), dirs=()):
+        self.keys = {}
+        for key_dir in dirs:
+            for name in sorted(os.listdir(key_dir)):
+                path = os.path.join(key_dir, name)
+                if os.path.isfile(path):
+                    self.add(path)
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        for key in load_public_keys(path):
+            self.keys.setdefault(public_key_der(key), path)
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Return path of matching trusted key or None
+    def match(self, public_key):
+        return self.keys.get(public_key_der(public_key))
+
+class Container:
+    def __init__(self, path):
+        self.path = path
+        self._views = []
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise ContainerError('{}: not a container'.format(path))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse(size)
+        except Exception:
+            self.close()
+            raise
+
+    def _view(self, start, end):
+        view = memoryview(self._mmap)[start:end]
+        self._views.append(view)
+        return view
+
+    def _parse(self, size):
+        header_offset = size - HEADER.size
+        magic, _, tree, root, digest, key = HEADER.unpack_from(self._mmap, header_offset)
+        if magic != HEADER_MAGIC:
+            raise ContainerError('{}: not a container'.format(self.path))
+        # Regions are in order and non-empty, same as container-util
+        offsets = [0, tree, root, digest, key, header_offset]
+        if any(start >= end for start, end in zip(offsets, offsets[1:])):
+            raise ContainerError('{}: invalid header offsets'.format(self.path))
+        self.data, self.tree, self.root, self.digest, self.key = [
+            self._view(start, end) for start, end in zip(offsets, offsets[1:])]
+        self.header = self._view(header_offset, size)
+        try:
+            self.public_key = serialization.load_der_public_key(self.key)
+        except ValueError as e:
+            raise ContainerError('{}: invalid public key: {}'.format(self.path, e))
+
+    @property
+    def roothash(self):
+        return bytes(self.root).rstrip(b'\0').decode('ascii').strip()
+
+    # Return True if roothash is signed by key of container
+    def verify_signature(self):
+        public_key = self.public_key
+        try:
+            if isinstance(public_key, rsa.RSAPublicKey):
+                public_key.verify(self.digest, self.root, padding.PKCS1v15(), key_hash(public_key))
+            elif isinstance(public_key, ec.EllipticCurvePublicKey):
+                public_key.verify(self.digest, self.root, ec.ECDSA(key_hash(public_key)))
+            else:
+                raise ContainerError('{}: unsupported key type'.format(self.path))
+        except InvalidSignature:
+            return False
+        return True
+
+    # Return True if data and tree match roothash
+    def verify_tree(self):
+        sb = self.tree[:VERITY_SUPERBLOCK_SIZE]
+        if len(sb) < VERITY_SUPERBLOCK.size:
+            return False
+        (signature, version, hash_type, _, algorithm, data_block_size, hash_block_size,
+         data_blocks, salt_size, _, salt) = VERITY_SUPERBLOCK.unpack_from(sb)
+        algorithm = algorithm.rstrip(b'\0').decode('ascii')
+        if (signature != VERITY_SIGNATURE or version != 1 or hash_type != 1
+                or algorithm not in hashlib.algorithms_available):
+            raise ContainerError('{}: unsupported verity superblock'.format(self.path))
+        salt = salt[:salt_size]
+        digest_size = hashlib.new(algorithm).digest_size
+        # Digests are padded to a power of two in hash blocks, only unpadded supported
+        if digest_size & (digest_size - 1):
+            raise ContainerError('{}: unsupported verity hash {}'.format(self.path, algorithm))
+        if (data_blocks == 0 or data_blocks * data_block_size > len(self.data)
+                or hash_block_size < digest_size):
+            return False
+        hash_per_block_bits = (hash_block_size // digest_size).bit_length() - 1
+
+        # Block numbers of levels, top level first after superblock
+        levels = 0
+        while hash_per_block_bits * levels < 64 and (data_blocks - 1) >> (hash_per_block_bits * levels):
+            levels += 1
+        level_sizes = [(data_blocks + (1 << ((i + 1) * hash_per_block_bits)) - 1) >> ((i + 1) * hash_per_block_bits)
+                       for i in range(levels)]
+        position = (VERITY_SUPERBLOCK_SIZE + hash_block_size - 1) // hash_block_size
+        level_starts = [0] * levels
+        for i in reversed(range(levels)):
+            level_starts[i] = position
+            position += level_sizes[i]
+        if position * hash_block_size > len(self.tree):
+            return False
+
+        def block_hash(block):
+            h = hashlib.new(algorithm, salt)
+            h.update(block)
+            return h.digest()
+
+        # Hash each level from data and compare to stored level
+        blocks = (self.data[x:x + data_block_size]
+                  for x in range(0, data_blocks * data_block_size, data_block_size))
+        for i in range(levels):
+            digests = b''.join(map(block_hash, blocks))
+            start = level_starts[i] * hash_block_size
+            stored = self.tree[start:start + level_sizes[i] * hash_block_size]
+            per_block = (1 << hash_per_block_bits) * digest_size
+            for n in range(level_sizes[i]):
+                expected = digests[n * per_block:(n + 1) * per_block]
+                block = stored[n * hash_block_size:(n + 1) * hash_block_size]
+                if block[:len(expected)] != expected or any(block[len(expected):]):
+                    return False
+            blocks = (stored[x:x + hash_block_size] for x in range(0, len(stored), hash_block_size))
+        top = next(iter(blocks))
+        return block_hash(top).hex() == self.roothash
+
+    # Raise ContainerError unless signature is valid, key is trusted and
+    # data matches roothash. Any key is trusted if trusted is None.
+    def verify(self, trusted=None, tree=True):
+        if not self.verify_signature():
+            raise ContainerError('{}: invalid signature'.format(self.path))
+        if trusted is not None and trusted.match(self.public_key) is None:
+            raise ContainerError('{}: pubkey validation failed'.format(self.path))
+        if tree and not self.verify_tree():
+            raise ContainerError('{}: data does not match roothash'.format(self.path))
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def verify(path, trusted=None, tree=True):
+    with Container(path) as container:
+        container.verify(trusted, tree)
+
+# Verify containers in parallel, returns list of None for valid
+# containers or error message for invalid containers in order of paths.
+def verify_many(paths, trusted=None, tree=True, jobs=0):
+    def verify_one(path):
+        try:
+            verify(path, trusted, tree)
+        except (ContainerError, OSError) as e:
+            return str(e)
+        return None
+    with ThreadPoolExecutor(max_workers=jobs if jobs > 0 else None) as executor:
+        return list(executor.map(verify_one, paths))
+
+def main():
+    parser = ArgumentParser(description='''Verify image containers''',
+                                     epilog='''Return value:
+0 if all containers are valid, 1 for failure
+
+Trusted keys are loaded once and containers are verified in parallel.
+Each container is reported as "CONTAINER: OK" or "CONTAINER: REASON".
+''',
+                                     formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('CONTAINER', nargs='+', help='Path to container')
+    parser.add_argument('--pubkey', action='append', default=[], help='Path to validation key')
+    parser.add_argument('--pubkey-dir', action='append', default=[],
+                        help='Path to directory of validation keys')
+    parser.add_argument('--pubkey-any', action='store_true', help='Use pubkey from container')
+    parser.add_argument('--signature-only', action='store_true',
+                        help='Only verify roothash signature, not data')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='Number of containers verified in parallel, default one per CPU')
+    args = parser.parse_args()
+
+    if args.pubkey_any == bool(args.pubkey or args.pubkey_dir):
+        raise ValueError('Exactly one of --pubkey/--pubkey-dir or --pubkey-any required')
+    trusted = None if args.pubkey_any else TrustedKeys(args.pubkey, args.pubkey_dir)
+
+    results = verify_many(args.CONTAINER, trusted, not args.signature_only, args.jobs)
+    for path, error in zip(args.CONTAINER, results):
+        print('{}: OK'.format(path) if error is None else error)
+    sys.exit(0 if all(error is None for error in results) else 1)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Error: {}'.format(e))
+    sys.exit(1)
@@ -0,0 +1,62 @@
+# Positional I/O helpers shared by gpt-insert, delta-image and verify-device.
+# Installed next to them in bindir, where it is found as the directory of the
+# running script.
+#
+# Functions taking stats accept None, else an object with method
+# add(category, start, written=0) as gpt-insert Stats.
+
+import os
+import time
+import functools
+import importlib.util
+
+ZERO_BUFFER_SIZE = 8 * 1024 * 1024
+
+@functools.cache
+def zero_buffer():
+    return memoryview(bytes(ZERO_BUFFER_SIZE))
+
+# numpy is optional and used for vectorized block scanning
+@functools.cache
+def get_numpy():
+    if importlib.util.find_spec('numpy') is None:
+        return None
+    import numpy
+    return numpy
+
+def pread_full(fd, view, offset, stats=None):
+    bytes = 0
+    while bytes < len(view):
+        start = time.perf_counter()
+        count = os.preadv(fd, [view[bytes:]], offset + bytes)
+        if stats:
+            stats.add('read', start)
+        if count == 0:
+            raise RuntimeError('Unexpected number of bytes read at offset {}'.format(offset + bytes))
+        bytes += count
+
+def pwrite_all(fd, data, offset, stats=None):
+    while data:
+        start = time.perf_counter()
+        count = os.pwrite(fd, data, offset)
+        if stats:
+            stats.add('write', start, count)
+        if count == 0:
+            raise RuntimeError('Unexpected number of bytes written to output')
+        data = data[count:]
+        offset += count
+
+# Update hashers with size bytes of fd at offset, read in chunks of buffer
+def hash_range(fd, offset, size, hashers, buffer, stats=None):
+    while size:
+        view = buffer[:min(len(buffer), size)]
+        start = time.perf_counter()
+        bytes = os.preadv(fd, [view], offset)
+        if stats:
+            stats.add('read', start)
+        if bytes == 0 or bytes > size:
+            raise RuntimeError('Unexpected number of bytes read from input')
+        for hasher in hashers:
+            hasher.update(view[:bytes])
+        offset += bytes
+        size -= bytes
@@ -30,32 +30,38 @@ print_usage() {
     echo "Usage: install-container [OPTIONS] CONTAINER"
     echo "Install container to blockdevice"
     echo "Mandatory:"
-    echo "  -d,--device           Path to target blockdevice"
+    echo "  -d,--device           Path to target blockdevice. May be supplied multiple times for disk images,"
+    echo "                        the disk image is then read once and written to all devices in parallel."
     echo "Optional:"
     echo "  --any-pubkey          Flag to only use public key in container for validation -- do not match public key to known key"
     echo "  -p,--path             Additional \$PATH for container-util application"
     echo "  --key-dir             Path to directory of public keys for validating container signature"
+    echo "  --cache-dir           Path to root owned directory caching container signature verification"
+    echo "                        and parsed keys of --key-dir, see container-util --cache-dir"
     echo "  --verify-device       Verify disk image to device by:"
-    echo "                         - zero full device before image installation"
     echo "                         - do NOT execute preinstall and postinstall"
     echo "                         - write disk image to device"
-    echo "                         - sha256 whole device and compare to disk sha256 in container"
-    echo "                         - return 0 if sha256 sums are equal"
+    echo "                         - read back mapped ranges of disk bmap and compare to range checksums"
+    echo "                         - require ranges of disk.img.zeros in container, if any, to read as zero"
+    echo "                         - return 0 if all ranges are equal"
     echo "                        Warning: should only be used with full disk images and no partitions"
     echo "  --alias               Map container partitions to actual partition names with form \"name:target\""
     echo "                        For example a container partition named rootfs can be mapped to rootfs2 by:"
     echo "                        \"rootfs:rootfs2\". This option can be supplied multiple times."
+    echo "  --delta-source        Path to blockdevice used as source for delta images \"delta.NAME\" in container."
+    echo "                        Target partition is rebuilt from source and delta."
     echo "  --reset-nvram-update  Reset nvram A/B update to defaults"
     echo "  --unmount             Unmount target --device before installation"
 }
 
 declare -A part_aliases
+declare -a devices
 validate_pubkey="yes"
 while [ "$#" -gt 0 ]; do
 	case $1 in
 	-d|--device)
 		[ "$#" -gt 1 ] || die "Invalid argument -d/--device"
-		device="$2"
+		devices+=("$2")
 		shift # past argument
 		shift # past value
 		;;
@@ -71,6 +77,12 @@ while [ "$#" -gt 0 ]; do
 		shift # past argument
 		shift # past value
 		;;
+	--cache-dir)
+		[ "$#" -gt 1 ] || die "Invalid argument --cache-dir"
+		cachedir="$2"
+		shift # past argument
+		shift # past value
+		;;
 	--any-pubkey)
 		validate_pubkey="no"
 		shift # past argument
@@ -79,6 +91,12 @@ while [ "$#" -gt 0 ]; do
 		verify_device="yes"
 		shift # past argument
 		;;
+	--delta-source)
+		[ "$#" -gt 1 ] || die "Invalid argument --delta-source"
+		delta_source="$2"
+		shift # past argument
+		shift # past value
+		;;
 	--reset-nvram-update)
 		reset_nvram_update="yes"
 		shift # past argument
@@ -108,7 +126,8 @@ while [ "$#" -gt 0 ]; do
 done
 
 [ "$validate_pubkey" = "yes" -a "x$keydir" = "x" ] && die "Missing argument --keydir or --any-pubkey"
-[ "x$device" != "x" ] || die "Missing argument -d/--device"
+[ "${#devices[@]}" -gt 0 ] || die "Missing argument -d/--device"
+device="${devices[0]}"
 [ "x$container" != "x" ] || die "Missing argument CONTAINER"
 
 TMP="$(mktemp -d)" || die "Failed creating tmp directory"
@@ -122,6 +141,9 @@ elif [ "x$keydir" != "x" ]; then
 else
 	die "No known key validation provided"
 fi
+if [ "x$cachedir" != "x" ]; then
+	container_util_args="$container_util_args --cache-dir "$cachedir""
+fi
 PATH="$path:$PATH" container-util $container_util_args || die "Failed opening container"
 VERITY="imageinstaller"
 mkdir "${TMP}/mnt" || die "Failed creating mnt dir"
@@ -152,6 +174,32 @@ if [ "x$partition_images" != "x" ]; then
 	done
 fi
 
+# Detect whether partition deltas are provided
+declare -A delta_targets
+declare -A delta_devices
+delta_images="$(find "${TMP}/mnt"  -name 'delta\.*' -type f,l)" || die "Failed reading container content"
+if [ "x$delta_images" != "x" ]; then
+	[ "x$delta_source" != "x" ] || die "ERROR: container contains delta images, missing argument --delta-source"
+	for image in $delta_images; do
+		# Strip path and file prefix "delta." to get target partition name
+		partname="${image#*delta.}"
+		# Use alias if available
+		if [ "x${part_aliases["$partname"]}" != "x" ]; then
+			tmp="$partname"
+			partname="${part_aliases["$partname"]}"
+			unset part_aliases["$tmp"]
+		fi
+		delta_targets["$partname"]="$image"
+		# resolve partition name to blockdevice
+		blkdev="$(blkid -l -o device -t PARTLABEL="$partname" "$device")" || die "Failed finding blockdev for partition \"$partname\""
+		delta_devices["$partname"]="$blkdev"
+	done
+	echo "Delta targets:"
+	for part in "${!delta_targets[@]}"; do
+		echo "  ${delta_devices["$part"]}[$part]=${delta_targets["$part"]} source=${delta_source}"
+	done
+fi
+
 if [ "${#part_aliases[@]}" -ne 0 ]; then
 	echo "Provided aliases did not match partitions in container"
 	for part in "${!part_aliases[@]}"; do
@@ -166,11 +214,13 @@ if [ -f "${TMP}/mnt/disk.img" ]; then
 fi
 
 # Something must be installable
-[ "x$partition_images" = "x" -a "x$disk_image" = "x" ] && die "ERROR: container contains no disk or partition images"
+[ "x$partition_images" = "x" -a "x$delta_images" = "x" -a "x$disk_image" = "x" ] && die "ERROR: container contains no disk or partition images"
 # We do not now how to manage both full disk and partition images
-[ "x$partition_images" != "x" -a "x$disk_image" != "x" ] && die "ERROR: container contains both disk and partition images"
+[ "x$partition_images$delta_images" != "x" -a "x$disk_image" != "x" ] && die "ERROR: container contains both disk and partition images"
 # --verify-device only supported on full disk images
-[ "$verify_device" = "yes" -a "x$partition_images" != "x" ] && die "ERROR: --verify-device only supported on disk images"
+[ "$verify_device" = "yes" -a "x$partition_images$delta_images" != "x" ] && die "ERROR: --verify-device only supported on disk images"
+# multiple devices only supported on full disk images
+[ "${#devices[@]}" -gt 1 -a "x$partition_images$delta_images" != "x" ] && die "ERROR: multiple devices only supported on disk images"
 
 # Check if mounted
 all_mounted=""
@@ -178,13 +228,16 @@ if [ "x$disk_image" != "x" ]; then
 	# Find mounted partitions on device
 	# If device name ends with a digit the partitions will be prefixed with a "p",
 	# for example device /devmmcblk0 first partition is /dev/mmcblk0p1
-	prefix=""
-	[[ "$device" =~ .[0-9]$ ]] && prefix="p"
-	all_mounted="$(cut -d ' ' -f 1 /proc/self/mounts | grep "^${device}${prefix}*" | tr '\n' ' ')" || die "Failed checking /proc/self/mounts"
+	for dev in "${devices[@]}"; do
+		prefix=""
+		[[ "$dev" =~ .[0-9]$ ]] && prefix="p"
+		mounted="$(cut -d ' ' -f 1 /proc/self/mounts | grep "^${dev}${prefix}*" | tr '\n' ' ')" || die "Failed checking /proc/self/mounts"
+		all_mounted="$all_mounted $mounted"
+	done
 fi
-if [ "x$partition_images" != "x" ]; then
+if [ "x$partition_images$delta_images" != "x" ]; then
 	# Check if target partitions are mounted
-	for part in "${partition_devices[@]}"; do
+	for part in "${partition_devices[@]}" "${delta_devices[@]}"; do
 		if findmnt "$part" >/dev/null; then
 			all_mounted="$all_mounted $part"
 		fi
@@ -203,17 +256,20 @@ if [ "$unmount" = "yes" ]; then
 	done
 fi
 
-# Zero device when verifying device or run preinstall in normal flow
-if [ "$verify_device" = "yes" ]; then
-	echo "Zeroing $device"
-	cat /dev/zero > "$device" || die "Failed zeroing device"
-elif [ -x "${TMP}/mnt/preinstall" ]; then
+# Run preinstall in normal flow, not when verifying device
+if [ "$verify_device" != "yes" -a -x "${TMP}/mnt/preinstall" ]; then
 	echo "preinstall: $(readlink ${TMP}/mnt/preinstall)"
-	"${TMP}/mnt/preinstall" "$device" || die "Failed executing preinstall"
+	for dev in "${devices[@]}"; do
+		"${TMP}/mnt/preinstall" "$dev" || die "Failed executing preinstall on \"$dev\""
+	done
 fi
 
 # Perform installation
-if [ "x$disk_image" != "x" ]; then
+if [ "x$disk_image" != "x" -a "${#devices[@]}" -gt 1 ]; then
+	# Source is read once, a failing device does not interrupt the others
+	PATH="$path:$PATH" flash-devices --bmap "${disk_image}.bmap" "$disk_image" "${devices[@]}" \
+		|| die "Failed installing disk image to one or more devices"
+elif [ "x$disk_image" != "x" ]; then
 	bmaptool copy --bmap "${disk_image}.bmap" "$disk_image" "$device" || die "Failed installing disk image"
 fi
 if [ "x$partition_images" != "x" ]; then
@@ -223,21 +279,33 @@ if [ "x$partition_images" != "x" ]; then
 							"${partition_devices["$part"]}" || die "Failed installing partition image"
 	done
 fi
+if [ "x$delta_images" != "x" ]; then
+	for part in "${!delta_targets[@]}"; do
+		[ "$(realpath "$delta_source")" != "$(realpath "${delta_devices["$part"]}")" ] || die "ERROR: delta source equals target \"$part\""
+		PATH="$path:$PATH" delta-image --apply --source "$delta_source" \
+							--target "${delta_devices["$part"]}" \
+							"${delta_targets["$part"]}" || die "Failed installing partition delta"
+	done
+fi
 
-# Validate device sha256sum when verifying device or run postinstall in normal flow
+# Validate mapped ranges of device when verifying device or run postinstall in normal flow
 if [ "$verify_device" = "yes" ]; then
-	echo "Calculating device checksum"
-	imagesize="$(stat -L -c %s ${TMP}/mnt/disk.img)" || die "Failed getting image size"
-	echo "Size: ${imagesize}"
-	device_sha256="$(head --bytes ${imagesize} ${device} | sha256sum)" || die "Failed calculating device sha256"
-	image_sha256="$(cat ${TMP}/mnt/disk.img.sha256)" || die "Failed reading image sha256"
-	echo "device sha256: ${device_sha256}"
-	echo "image sha256:  ${image_sha256}"
-	[ "$device_sha256" = "$image_sha256" ] || die "sha256 mismatch"
-	echo "Valid!"
+	zero_ranges=""
+	[ -f "${disk_image}.zeros" ] && zero_ranges="${disk_image}.zeros"
+	failed=""
+	for dev in "${devices[@]}"; do
+		echo "Verifying device ranges: $dev"
+		PATH="$path:$PATH" verify-device --direct --bmap "${disk_image}.bmap" \
+			${zero_ranges:+--zero-ranges "$zero_ranges"} "$dev" || failed="$failed $dev"
+	done
+	[ "x$failed" = "x" ] || die "Device verification failed:$failed"
 elif [ -x "${TMP}/mnt/postinstall" ]; then
 	echo "postinstall: $(readlink ${TMP}/mnt/postinstall)"
-	"${TMP}/mnt/postinstall" "$device" || die "Failed executing postinstall"
+	failed=""
+	for dev in "${devices[@]}"; do
+		"${TMP}/mnt/postinstall" "$dev" || failed="$failed $dev"
+	done
+	[ "x$failed" = "x" ] || die "Failed executing postinstall:$failed"
 fi
 
 if [ "$reset_nvram_update" = "yes" ]; then
@@ -8,13 +8,21 @@ die () {
 print_usage() {
     echo "Usage: image-container [OPTIONS] CONTAINER"
     echo "Make image container of disk"
-    echo "  Reserved names: disk.img disk.img.sha256 disk.img.bmap preinstall postinstall"
+    echo "  Reserved names: disk.img disk.img.sha256 disk.img.bmap disk.img.zeros preinstall postinstall"
     echo ""
     echo "Mandatory:"
     echo "  -b,--build        Path to build directory, will be created if needed"
     echo "Optional:"
     echo "  --partitions      Space separated list to paths of partitions"
     echo "  --disk            Path to disk image"
+    echo "  --delta-source    Path to previous version of partition image. A block level delta"
+    echo "                    \"delta.NAME\" from it to partition image \"partition.NAME\" is packaged"
+    echo "                    instead of the full partition. Requires a single entry in --partitions."
+    echo "  --extent-maps     Space separated list of gpt-insert extent maps of disk image."
+    echo "                    Only gpt and extents written by gpt-insert are mapped in disk bmap."
+    echo "  --zero-ranges     Path to gpt-insert extent map of disk image ranges required to read as zero"
+    echo "                    after installation. Packaged as \"disk.img.zeros\" and verified by"
+    echo "                    install-image-container --verify-device. Requires --disk."
     echo "  -p,--path         Additional \$PATH for container-util application"
     echo "  --key             Path to private key for signing image"
     echo "  --key-pkcs11      PKCS#11 URL for private key"
@@ -49,6 +57,24 @@ while [ "$#" -gt 0 ]; do
 		shift # past argument
 		shift # past value
 		;;
+	--delta-source)
+		[ "$#" -gt 1 ] || die "Invalid argument --delta-source"
+		delta_source="$2"
+		shift # past argument
+		shift # past value
+		;;
+	--extent-maps)
+		[ "$#" -gt 1 ] || die "Invalid argument --extent-maps"
+		extent_maps="$2"
+		shift # past argument
+		shift # past value
+		;;
+	--zero-ranges)
+		[ "$#" -gt 1 ] || die "Invalid argument --zero-ranges"
+		zero_ranges="$2"
+		shift # past argument
+		shift # past value
+		;;
 	--key)
 		[ "$#" -gt 1 ] || die "Invalid argument --key"
 		keyfile="$2"
@@ -97,13 +123,24 @@ count=0
 [ "x$disk" != "x" ] && count=$(( $count + 1 ))
 [ $count -eq 1 ] || ie "Invalid argument --partitions and --disk are mutually exclusive"
 [ "x$container_name" != "x" ] || die "Missing argument CONTAINER"
+if [ "x$delta_source" != "x" ]; then
+	[ "$(echo $partitions | wc -w)" -eq 1 ] || die "Invalid argument --delta-source requires a single partition"
+	case "$(basename "$partitions")" in
+	partition.*)
+		;;
+	*)
+		die "Invalid argument --delta-source requires partition named \"partition.NAME\""
+		;;
+	esac
+fi
+[ "x$zero_ranges" != "x" -a "x$disk" = "x" ] && die "Invalid argument --zero-ranges requires --disk"
 [ "x$keyfile" = "x" -a "x$key_pkcs11" = "x" ] && die "No signing method provided"
 
 # Verify no reserved names are used
 for x in "$container_name" "$preinstall" "$postinstall" $partitions; do
 	if [ "x${x}" != "x" ]; then
 		basename="$(basename ${x})" || die "Failed basename"
-		for reserved in "disk.img" "disk.img.sha256" "disk.img.bmap" "preinstall" "postinstall"; do
+		for reserved in "disk.img" "disk.img.sha256" "disk.img.bmap" "disk.img.zeros" "preinstall" "postinstall"; do
 			[ "$x" = "$reserved" ] && die "Invalid use of reserved name ${reserved}"
 		done
 	fi
@@ -111,23 +148,31 @@ done
 
 mkdir -p "$build" || die "Failed creating build dir"
 
-if [ "x$partitions" != "x" ]; then
+if [ "x$delta_source" != "x" ]; then
+	part_basename="$(basename "$partitions")" || die "Failed getting partition basename"
+	delta_name="delta.${part_basename#partition.}"
+	PATH="$path:$PATH" delta-image --create --source "$delta_source" --target "$partitions" \
+		"${build}/${delta_name}" || die "Failed creating delta"
+	artifacts="${build}/${delta_name}"
+elif [ "x$partitions" != "x" ]; then
 	artifacts=""
 	# Create bmap file for each partition
 	for part in $partitions; do
 		part_basename="$(basename "$part")" || die "Failed getting partition basename"
-		bmaptool create -o "${build}/${part_basename}.bmap" "$part" || die "Failed creating bmap"
+		PATH="$path:$PATH" gpt-insert --finalize --bmap "${build}/${part_basename}.bmap" "$part" || die "Failed creating bmap"
 		artifacts="${artifacts} ${part} ${build}/${part_basename}.bmap"
 	done
 fi
 
 if [ "x$disk" != "x" ]; then
 	disk_basename="$(basename "$disk")" || die "Failed getting disk basename"
-	# Create bmap
-	bmaptool create -o "${build}/${disk_basename}.bmap" "$disk" || die "Failed creating bmap"
-	# Calculate sha256
-	disk_sha256="$(cat ${disk} | sha256sum)" || die "Failed calculating sha256"
-	echo "$disk_sha256" > "${build}/${disk_basename}.sha256"|| die "Failed writing sha256"
+	# Create bmap and calculate sha256 in a single pass
+	finalize_args=""
+	for extent_map in $extent_maps; do
+		finalize_args="$finalize_args --extent-map $extent_map"
+	done
+	PATH="$path:$PATH" gpt-insert --finalize $finalize_args --bmap "${build}/${disk_basename}.bmap" \
+		--sha256 "${build}/${disk_basename}.sha256" "$disk" || die "Failed creating bmap and sha256"
 	artifacts="${disk} ${build}/${disk_basename}.bmap ${build}/${disk_basename}.sha256"
 	# Create links unless already named disk.img
 	if [ "$disk_basename" != "disk.img" ]; then
@@ -136,6 +181,10 @@ if [ "x$disk" != "x" ]; then
 		ln -sf "$disk_basename.bmap" "${build}/disk.img.bmap" || die "Failed creating link"
 		artifacts="${artifacts} ${build}/disk.img.bmap ${build}/disk.img.sha256 ${build}/disk.img"
 	fi
+	if [ "x$zero_ranges" != "x" ]; then
+		cp "$zero_ranges" "${build}/disk.img.zeros" || die "Failed copying zero ranges"
+		artifacts="${artifacts} ${build}/disk.img.zeros"
+	fi
 fi
 
 # Add pre/postinstall if requested
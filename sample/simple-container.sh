@@ -20,36 +20,6 @@ fstype_to_gpt_type() {
 	esac
 }
 
-build_filesystem() {
-	local fsdir="$1"
-	local fsimg="$2"
-	local fstype="$3"
-	local size_mib="$4"
-	local archive="$5"
-
-	local fs_size_bytes="$((${size_mib}*1024*1024))"
-	local fs_size_kbytes="$((${size_mib}*1024))"
-	local cmd="true"
-
-	# Create rootfs dir, remove if already exists to ensure clean build
-	mkdir "$fsdir" || die "Failed creating fsdir"
-	if [ "x$archive" != "x" ]; then
-		cmd="$cmd && tar --numeric-owner -xf "$archive" -C "$fsdir""
-	fi
-	if [ "$fstype" = "ext4" ]; then
-		# Instruct mkfs to fully initialize file system now instead of first mount.
-		extra="assume_storage_prezeroed=0,lazy_itable_init=0,lazy_journal_init=0"
-		cmd="$cmd && truncate -s "$fs_size_bytes" "$fsimg" && /usr/sbin/mkfs.ext4 -E "$extra" -F -b 4096 "$fsimg" -d "$fsdir""
-	elif [ "$fstype" = "fat32" ]; then
-		cmd="$cmd && /usr/sbin/mkfs.vfat -F 32 -C "$fsimg" "$fs_size_kbytes" && mcopy -i "$fsimg" -smpQ "$fsdir"/* \:\:/ "
-	else
-		die "Unsupported filesystem: $fstype"
-	fi
-	echo "Executing as fakeroot:"
-	echo "\"$cmd\""
-	fakeroot -- /bin/sh -c "$cmd" || die "Failed creating filesystem"
-}
-
 print_usage() {
 	echo "Usage: simple-container"
 	echo ""
@@ -230,14 +200,10 @@ fi
 disk_size_bytes_weighted=$(echo "scale=0; ${disk_size_gb}*1000000000*${disk_size_ratio}/1" | bc) || die "Failed calculating disk size"
 echo "Creating disk of size $disk_size_bytes_weighted bytes ($disk_size_gb GB * $disk_size_ratio)"
 
-# Remove any existing disk
+# Remove any existing disk. Partition filesystems are kept and only
+# rebuilt by build-partitions if their inputs changed.
 rm -rf "${build}/disk.img" || die "Failed removing existing disk"
-# Remove any existing rootfs
-rm -rf "${build}/partition.rootfs" || die "Failed removing existing rootfs"
-rm -rf "${build}/rootfs" || die "Failed removing existing rootfs"
-# Remove any existing data
-rm -rf "${build}/partition.data" || die "Failed removing existing data"
-rm -rf "${build}/data" || die "Failed removing existing data"
+rm -f "${build}"/partition.*.extents || die "Failed removing existing partition extent maps"
 
 # Create sparse disk
 truncate -s "$disk_size_bytes_weighted" "${build}/disk.img" || die "Failed creating disk"
@@ -245,6 +211,10 @@ truncate -s "$disk_size_bytes_weighted" "${build}/disk.img" || die "Failed creat
 # Create partition table
 /usr/sbin/parted -s "${build}/disk.img" mklabel gpt || die "Failed creating partition table"
 end=4
+# Partition filesystems built and inserted in disk by build-partitions,
+# arguments collected as positional parameters
+set --
+extent_maps=""
 
 # Add esp partition
 if [ "x$esp_label" != "x" ]; then
@@ -278,12 +248,10 @@ if [ "x$rootfs_label" != "x" ]; then
 	fi
 
 	if [ "x$rootfs_image" != "x" ]; then
-		# Build and inject rootfs
-		echo "Building and inserting rootfs"
-		build_filesystem "${build}/rootfs" "${build}/partition.rootfs" "$rootfs_fstype" "$rootfs_size_mib" "$rootfs_image"
-		PATH="$path:$PATH" gpt-insert --label "$rootfs_label" --input "${build}/partition.rootfs" "${build}/disk.img" || die "Failed inserting filesystem in disk"
-		# Build rootfs update container
-		PATH="$path:$PATH" make-image-container --build "${build}/update" --partitions "${build}/partition.rootfs" --key "$keyfile" "${build}/${name}-update.container" || die "Failed creating update container"
+		# Build and inject rootfs, also packaged as update container
+		set -- "$@" --partition rootfs "$rootfs_label" "$rootfs_fstype" "$rootfs_size_mib" \
+			--archive "rootfs=${rootfs_image}" --update-container "rootfs=${build}/${name}-update.container"
+		extent_maps="$extent_maps ${build}/partition.rootfs.extents"
 	fi
 fi
 
@@ -295,9 +263,15 @@ if [ "x$data_label" != "x" ]; then
 	data_gpt_type="$(fstype_to_gpt_type "$data_fstype")"
 	/usr/sbin/parted -s "${build}/disk.img" mkpart "$data_label" "$data_gpt_type" "${start}MiB" "${end}MiB" || die "Failed creating partition"
 	# Format partition
-	echo "Building and inserting data partition"
-	build_filesystem "${build}/data" "${build}/partition.data" "$data_fstype" "$data_size_mib" ""
-	PATH="$path:$PATH" gpt-insert --label "$data_label" --input "${build}/partition.data" "${build}/disk.img" || die "Failed inserting filesystem in disk"
+	set -- "$@" --partition data "$data_label" "$data_fstype" "$data_size_mib"
+	extent_maps="$extent_maps ${build}/partition.data.extents"
+fi
+
+# Build filesystems in parallel, each inserted in disk as soon as it is built
+if [ "$#" -gt 0 ]; then
+	echo "Building partitions"
+	PATH="$path:$PATH" build-partitions --build "$build" --disk "${build}/disk.img" --key "$keyfile" \
+		"$@" || die "Failed building partitions"
 fi
 
 # Dump partition table
@@ -315,7 +289,7 @@ parted -s --fix "$1" align-check optimal 1
 EOF
 
 # Build full disk container
-PATH="$path:$PATH" make-image-container --build "${build}/disk" --disk "${build}/disk.img" --key "$keyfile" --postinstall "${build}/fix-gpt.sh" "${build}/${name}-disk.container" || die "Failed creating disk container"
+PATH="$path:$PATH" make-image-container --build "${build}/disk" --disk "${build}/disk.img" ${extent_maps:+--extent-maps "$extent_maps"} --key "$keyfile" --postinstall "${build}/fix-gpt.sh" "${build}/${name}-disk.container" || die "Failed creating disk container"
 
 echo "Success!"
 
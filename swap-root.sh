@@ -18,6 +18,7 @@ cmd_cancel=""
 cmd_rollback=""
 cmd_counter=""
 image=""
+cache_dir=""
 
 print_usage() {
     echo "Usage: ${1} [OPTIONS] COMMAND ARGS..."
@@ -40,6 +41,7 @@ print_usage() {
 	echo ""
     echo "Options:"
     echo " -c/--container       IMAGE is of type CONTAINER. This is the default operation."
+    echo " --cache-dir DIR      Cache container verification in DIR, see install-image-container"
     echo " -h/--help:           This help message"
 }
 
@@ -49,6 +51,12 @@ while [ $# -gt 0 ]; do
 		container="yes"
 		shift # past argument
 		;;
+	--cache-dir)
+		[ $# -gt 1 ] || die "Invalid argument --cache-dir"
+		cache_dir="${2}"
+		shift # past argument
+		shift # past value
+		;;
 	-h|--help)
 		print_usage
 		exit 1
@@ -185,7 +193,9 @@ if [ "$cmd_update" = "true" ]; then
 	echo "New root:     $new_root_label"
 	echo "Installing image.."
 	# Install container
-	install-image-container --device "$current_root_device" --any-pubkey --alias "rootfs:${new_root_label}" "$image" || die "Failed installation"
+	install-image-container --device "$current_root_device" --any-pubkey --alias "rootfs:${new_root_label}" \
+		--delta-source "$current_root_partition" ${cache_dir:+--cache-dir "$cache_dir"} "$image" \
+		|| die "Failed installation"
 	echo "Success!"
 
 	NVRAM_SYSTEM_UNLOCK=16440 nvram --sys --set SYS_BOOT_SWAP "$new_root_label" || die "Failed setting nvram variable SYS_BOOT_SWAP"
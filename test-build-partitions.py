@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import unittest
+import tempfile
+import os
+import json
+import tarfile
+import subprocess
+import importlib.util
+
+def load_test_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+test_gpt_insert = load_test_module('test_gpt_insert', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                   'test-gpt-insert.py'))
+
+class EBUILDPARTITIONS(RuntimeError):
+    pass
+
+def build_partitions(args):
+    largs = ['build/build-partitions', '--path', 'build']
+    largs.extend(args)
+    r = subprocess.run(largs, capture_output=True)
+    if r.returncode != 0:
+        raise EBUILDPARTITIONS((r.stdout + r.stderr).decode())
+    return r.stdout.decode()
+
+def read_file(path, offset=0, size=-1):
+    with open(path, mode='rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+# Read file of ext4 image
+def debugfs_cat(image, path):
+    r = subprocess.run(['/usr/sbin/debugfs', '-R', 'cat {}'.format(path), image], capture_output=True)
+    return r.stdout
+
+# Read file of fat image
+def mtype(image, path):
+    r = subprocess.run(['mtype', '-i', image, '::{}'.format(path)], capture_output=True)
+    return r.stdout
+
+class test_build(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(delete=True)
+        self.dir = self.tmpdir.name
+        self.build = os.path.join(self.dir, 'build')
+        self.disk = os.path.join(self.dir, 'disk.img')
+        self.description = os.path.join(self.dir, 'partitions.json')
+        self.archive = os.path.join(self.dir, 'rootfs.tar')
+        test_gpt_insert.make_gpt(self.disk, 32 << 20, [('rootfs1', 1 << 20, 8 << 20), ('data', 9 << 20, 8 << 20)])
+        self.make_archive(b'content1')
+        self.partitions = [
+            {'name': 'rootfs', 'label': 'rootfs1', 'fstype': 'ext4', 'size_mib': 8, 'archive': self.archive},
+            {'name': 'data', 'label': 'data', 'fstype': 'ext4', 'size_mib': 8},
+        ]
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_archive(self, content):
+        source = os.path.join(self.dir, 'file1')
+        with open(source, 'wb') as f:
+            f.write(content)
+        with tarfile.open(self.archive, 'w') as tar:
+            tar.add(source, arcname='file1')
+
+    def run_build(self, args=[]):
+        with open(self.description, 'w') as f:
+            json.dump({'partitions': self.partitions}, f)
+        return build_partitions(['--build', self.build, '--disk', self.disk] + args + [self.description])
+
+    def make_key(self):
+        key = os.path.join(self.dir, 'key.pem')
+        subprocess.run(['openssl', 'genpkey', '-algorithm', 'RSA', '-pkeyopt', 'rsa_keygen_bits:2048',
+                        '-out', key], check=True, capture_output=True)
+        return key
+
+    def test_ok(self):
+        out = self.run_build()
+        for name in ['rootfs', 'data']:
+            self.assertIn('filesystem:{}: done'.format(name), out)
+            self.assertIn('insert:{}: done'.format(name), out)
+            self.assertTrue(os.path.exists(os.path.join(self.build, 'partition.{}.extents'.format(name))))
+        rootfs = os.path.join(self.build, 'partition.rootfs')
+        self.assertEqual(debugfs_cat(rootfs, '/file1'), b'content1')
+        self.assertEqual(read_file(self.disk, 1 << 20, 8 << 20), read_file(rootfs))
+        self.assertEqual(read_file(self.disk, 9 << 20, 8 << 20),
+                         read_file(os.path.join(self.build, 'partition.data')))
+
+    def test_ok_arguments(self):
+        # Partitions given by arguments instead of description
+        out = build_partitions(['--build', self.build, '--disk', self.disk,
+                                '--partition', 'rootfs', 'rootfs1', 'ext4', '8',
+                                '--archive', 'rootfs={}'.format(self.archive),
+                                '--partition', 'data', 'data', 'ext4', '8', '--no-insert', 'data'])
+        self.assertIn('insert:rootfs: done', out)
+        self.assertNotIn('insert:data', out)
+        rootfs = os.path.join(self.build, 'partition.rootfs')
+        self.assertEqual(debugfs_cat(rootfs, '/file1'), b'content1')
+        self.assertEqual(read_file(self.disk, 1 << 20, 8 << 20), read_file(rootfs))
+
+    def test_ok_fat32(self):
+        self.partitions[1]['fstype'] = 'fat32'
+        self.partitions[1]['archive'] = self.archive
+        out = self.run_build()
+        self.assertIn('insert:data: done', out)
+        data = os.path.join(self.build, 'partition.data')
+        self.assertEqual(mtype(data, '/file1'), b'content1')
+        self.assertEqual(read_file(self.disk, 9 << 20, 8 << 20), read_file(data))
+
+    def test_ok_update_container(self):
+        container = os.path.join(self.dir, 'update.container')
+        self.partitions[0]['update_container'] = container
+        key = self.make_key()
+        out = self.run_build(['--key', key])
+        self.assertIn('update:rootfs: done', out)
+        self.assertTrue(os.path.exists(container))
+        out = self.run_build(['--key', key])
+        self.assertIn('update:rootfs: up to date', out)
+        # Stamp of update container follows rebuilt filesystem image
+        self.make_archive(b'content2')
+        out = self.run_build(['--key', key])
+        self.assertIn('filesystem:rootfs: done', out)
+        self.assertIn('update:rootfs: done', out)
+
+    def test_ok_up_to_date(self):
+        self.run_build()
+        out = self.run_build()
+        self.assertIn('filesystem:rootfs: up to date', out)
+        self.assertIn('filesystem:data: up to date', out)
+        self.assertIn('insert:rootfs: done', out)
+        # Modified archive with unchanged content is not built again
+        st = os.stat(self.archive)
+        os.utime(self.archive, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        out = self.run_build()
+        self.assertIn('filesystem:rootfs: up to date', out)
+        # Changed archive content rebuilds rootfs only
+        self.make_archive(b'content2')
+        out = self.run_build()
+        self.assertIn('filesystem:rootfs: done', out)
+        self.assertIn('filesystem:data: up to date', out)
+        self.assertEqual(debugfs_cat(os.path.join(self.build, 'partition.rootfs'), '/file1'), b'content2')
+        # Changed size rebuilds data
+        self.partitions[1]['size_mib'] = 4
+        out = self.run_build()
+        self.assertIn('filesystem:rootfs: up to date', out)
+        self.assertIn('filesystem:data: done', out)
+        self.assertEqual(os.path.getsize(os.path.join(self.build, 'partition.data')), 4 << 20)
+
+    def test_error_isolated(self):
+        with open(self.archive, 'wb') as f:
+            f.write(b'not an archive')
+        with self.assertRaisesRegex(EBUILDPARTITIONS, r'Failed steps: filesystem:rootfs, '
+                                                      r'insert:rootfs \(dependency failed\)') as cm:
+            self.run_build()
+        # Independent partition is built and inserted
+        self.assertIn('insert:data: done', str(cm.exception))
+
+    def test_error_description(self):
+        self.partitions[1]['fstype'] = 'btrfs'
+        with self.assertRaisesRegex(EBUILDPARTITIONS, 'unsupported fstype "btrfs"'):
+            self.run_build()
+        self.partitions[1]['fstype'] = 'ext4'
+        self.partitions[1]['name'] = 'rootfs'
+        with self.assertRaisesRegex(EBUILDPARTITIONS, 'provided multiple times'):
+            self.run_build()
+        self.partitions[1]['name'] = 'data'
+        self.partitions[1]['update_container'] = os.path.join(self.dir, 'update.container')
+        with self.assertRaisesRegex(EBUILDPARTITIONS, 'Partition data update container requires --key'):
+            self.run_build()
+
+    def test_error_arguments(self):
+        args = ['--build', self.build, '--disk', self.disk]
+        with self.assertRaisesRegex(EBUILDPARTITIONS, 'DESCRIPTION or --partition missing'):
+            build_partitions(args)
+        with self.assertRaisesRegex(EBUILDPARTITIONS, 'Partition data invalid size "8M"'):
+            build_partitions(args + ['--partition', 'data', 'data', 'ext4', '8M'])
+        with self.assertRaisesRegex(EBUILDPARTITIONS, '--archive of unknown partition rootfs'):
+            build_partitions(args + ['--partition', 'data', 'data', 'ext4', '8',
+                                     '--archive', 'rootfs={}'.format(self.archive)])
+        with self.assertRaisesRegex(EBUILDPARTITIONS, 'Invalid --update-container "data"'):
+            build_partitions(args + ['--partition', 'data', 'data', 'ext4', '8', '--update-container', 'data'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ set -x
 
 TMP="NONE"
 LODEV="NONE"
+LODEV2="NONE"
 
 cleanup() {
 	if [ "$TMP" != "NONE" ]; then
@@ -26,6 +27,13 @@ cleanup() {
 		fi
 		LODEV="NONE"
 	fi
+	if [ "$LODEV2" != "NONE" ]; then
+		if ! sudo losetup -d "$LODEV2"; then
+			echo "Failed destroying loopback device"
+			exit 1
+		fi
+		LODEV2="NONE"
+	fi
 }
 die() {
 	echo "$1"
@@ -87,6 +95,23 @@ sudo mount "${LODEV}p2" "${TMP}/mnt2" || die "Failed mounting loop device"
 sudo build/install-image-container --device "$LODEV" --any-pubkey --path build "${TMP}/build/sample-disk.container" && die "Should fail on unmount on disk"
 sudo build/install-image-container --device "$LODEV" --any-pubkey --path build "${TMP}/build/sample-disk.container" --unmount || die "Failed with unmount on disk"
 
+sudo umount "${TMP}/mnt" || die "Failed unmounting"
+sudo umount "${TMP}/mnt2" || die "Failed unmounting"
+
+# Install disk container to multiple devices
+truncate -s 1000000000 "${TMP}/blockdevice2" || die "Failed creating blockdevice"
+LODEV2="$(sudo losetup --show -P -f "${TMP}/blockdevice2")" || die "Failed creating loopback device"
+sudo build/install-image-container --device "$LODEV" --device "$LODEV2" --any-pubkey --path build \
+    "${TMP}/build/sample-disk.container" || die "Failed installing container to multiple devices"
+sudo build/install-image-container --device "$LODEV" --device "$LODEV2" --any-pubkey --path build \
+    --verify-device "${TMP}/build/sample-disk.container" || die "Failed verifying multiple devices"
+for dev in "$LODEV" "$LODEV2"; do
+	sudo mount "${dev}p1" "${TMP}/mnt" || die "Failed mounting loop device"
+	file1="$(cat "${TMP}/mnt/file1")" || die "Failed reading file1"
+	[ "$file1" = "content1" ] || die "Failed file1 content"
+	sudo umount "${TMP}/mnt" || die "Failed unmounting"
+done
+
 cleanup
 echo "Success!"
 exit 0
\ No newline at end of file
@@ -6,9 +6,17 @@ import os
 import subprocess
 import struct
 import shutil
+import sys
+import time
+import io
+import hashlib
+import atexit
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from argparse import ArgumentParser
 from subprocess import CalledProcessError
 from cryptography.hazmat.primitives.asymmetric import rsa, ec
 from cryptography.hazmat.primitives import serialization
+import image_container
 
 class ENOENT(RuntimeError):
     pass
@@ -21,10 +29,10 @@ class EINVAL(RuntimeError):
 class EUNKNOWN(RuntimeError):
     pass
 
-def container_util(args):
+def container_util(args, stdin=None):
     largs = ['build/container-util', '-d']
     largs.extend(args)
-    r = subprocess.run(largs, capture_output=True, text=True)
+    r = subprocess.run(largs, capture_output=True, text=True, stdin=stdin)
     if r.returncode == 2:
         raise ENOENT(r.stdout + r.stderr)
     if r.returncode == 9:
@@ -53,25 +61,40 @@ def container_util_create(file, private_key):
 def container_util_roothash(file, public_key):
     return container_util(['--roothash', '-q', '--pubkey', public_key, file])
 
-def generate_rsa_keypair(key_size, priv_format=serialization.PrivateFormat.TraditionalOpenSSL):
-    private = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=key_size,
-    )
-    private_pem = private.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=priv_format,
-        encryption_algorithm=serialization.NoEncryption()
-    )
-    public = private.public_key()
-    public_der = public.public_bytes(
-        encoding=serialization.Encoding.DER,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
-    return private_pem, public_der
+# Opt-in directory of keypairs generated by earlier runs, addressed by a hash
+# of the key parameters. Empty to generate new keys for each run. Holds
+# unencrypted private keys, default location is outside the source tree.
+KEY_CACHE = os.environ.get('TEST_KEY_CACHE', '')
+DEFAULT_KEY_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                 'image-tools', 'test-keys')
+
+# Return private key with key parameters of content, generated by generate()
+# or loaded from KEY_CACHE. Tests needing distinct keys of equal parameters
+# pass a different variant.
+def cached_private_key(content, generate):
+    if not KEY_CACHE:
+        return generate()
+    digest = hashlib.sha256(repr(content).encode()).hexdigest()
+    path = os.path.join(KEY_CACHE, '{}.pem'.format(digest))
+    try:
+        with open(path, mode='rb') as f:
+            return serialization.load_pem_private_key(f.read(), password=None)
+    except FileNotFoundError:
+        pass
+    private = generate()
+    os.makedirs(KEY_CACHE, mode=0o700, exist_ok=True)
+    # parallel workers may generate the same key, last one wins
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode='wb') as f:
+        f.write(private.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    os.replace(tmp, path)
+    return private
 
-def generate_ec_keypair(curve, priv_format=serialization.PrivateFormat.TraditionalOpenSSL):
-    private = ec.generate_private_key(curve)
+def keypair(private, priv_format):
     private_pem = private.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=priv_format,
@@ -84,6 +107,17 @@ def generate_ec_keypair(curve, priv_format=serialization.PrivateFormat.Tradition
     )
     return private_pem, public_der
 
+def generate_rsa_keypair(key_size, priv_format=serialization.PrivateFormat.TraditionalOpenSSL, variant=0):
+    private = cached_private_key(('rsa', key_size, variant), lambda: rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=key_size,
+    ))
+    return keypair(private, priv_format)
+
+def generate_ec_keypair(curve, priv_format=serialization.PrivateFormat.TraditionalOpenSSL, variant=0):
+    private = cached_private_key(('ec', curve.name, variant), lambda: ec.generate_private_key(curve))
+    return keypair(private, priv_format)
+
 def generate_file(path, size):
     with open(path, mode='wb') as f:
         f.write(b'\x7a' * size)
@@ -92,12 +126,48 @@ def write_file(path, data):
     with open(path, mode='wb') as f:
         f.write(data)
 
-def dmverity_format(roothash, tree, data):
+def dmverity_format(roothash, tree, data, extra=[]):
     args = ['/usr/sbin/veritysetup', '--data-block-size=4096', '--hash-block-size=4096',
             'format', '--root-hash-file={}'.format(roothash), data, tree]
+    args[1:1] = extra
     r = subprocess.run(args, capture_output=True, text=True, check=True)
     return r.stdout
 
+# Directory of fixtures shared by all tests and parallel workers of a run
+SESSION_DIR = os.environ.get('TEST_SESSION_DIR')
+
+# Return directory of fixture name, created by builder(dir) once per run
+def session_fixture(name, builder):
+    global SESSION_DIR
+    if SESSION_DIR is None:
+        SESSION_DIR = tempfile.mkdtemp(prefix='test-container-util-')
+        os.environ['TEST_SESSION_DIR'] = SESSION_DIR
+        atexit.register(shutil.rmtree, SESSION_DIR, True)
+    path = os.path.join(SESSION_DIR, name)
+    if not os.path.isdir(path):
+        tmp = tempfile.mkdtemp(dir=SESSION_DIR)
+        try:
+            builder(tmp)
+        except Exception:
+            shutil.rmtree(tmp)
+            raise
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # created by other worker meanwhile
+            shutil.rmtree(tmp)
+    return path
+
+# 16 KiB data with tree and roothash by veritysetup
+def verity_fixture(dir):
+    generate_file(os.path.join(dir, 'data'), 16384)
+    dmverity_format(os.path.join(dir, 'roothash'), os.path.join(dir, 'tree'), os.path.join(dir, 'data'))
+
+def copy_verity_fixture(data, tree, roothash):
+    fixture = session_fixture('verity', verity_fixture)
+    for name, path in [('data', data), ('tree', tree), ('roothash', roothash)]:
+        shutil.copy(os.path.join(fixture, name), path)
+
 def sign_data(key, data, digest, hash='sha256', extra=['-pkeyopt', 'rsa_padding_mode:pkcs1']):
     args = ['openssl', 'pkeyutl', '-sign', '-in', data, '-inkey', key, '-out', digest,
             '-digest', hash, '-rawin']
@@ -106,6 +176,14 @@ def sign_data(key, data, digest, hash='sha256', extra=['-pkeyopt', 'rsa_padding_
     r = subprocess.run(args, capture_output=True, text=True, check=True)
     return r.stdout
 
+# Split container into data, tree and roothash
+def split_container(path):
+    with open(path, mode='rb') as f:
+        container = f.read()
+    magic, tree_offset, root_offset, digest_offset = struct.unpack('<L28xQQQ', container[-64:-8])
+    return (container[:tree_offset], container[tree_offset:root_offset],
+            container[root_offset:digest_offset].decode())
+
 def make_header(path, data, tree, roothash, digest, public_key):
     with open(path, mode='wb') as f:
         f.write(struct.pack('<L', 0x494d4721))
@@ -134,7 +212,6 @@ class test_verify(unittest.TestCase):
         self.roothash = os.path.join(self.dir, 'roothash')
         self.tree = os.path.join(self.dir, 'tree')
         self.data = os.path.join(self.dir, 'data')
-        generate_file(self.data, 16384)
         self.private_key = os.path.join(self.dir, 'private_key')
         self.public_key = os.path.join(self.dir, 'public_key')
         write_file(self.private_key, self.private_pem)
@@ -142,7 +219,7 @@ class test_verify(unittest.TestCase):
         self.digest = os.path.join(self.dir, 'digest')
         self.header = os.path.join(self.dir, 'header')
         self.container = os.path.join(self.dir, 'container')
-        dmverity_format(self.roothash, self.tree, self.data)
+        copy_verity_fixture(self.data, self.tree, self.roothash)
         sign_data(self.private_key, self.roothash, self.digest)
     def tearDown(self):
         self.tmpdir.cleanup()
@@ -167,7 +244,7 @@ class test_verify(unittest.TestCase):
         public_dir = os.path.join(self.dir, 'public_dir')
         os.mkdir(public_dir)
         shutil.copy(self.public_key, public_dir)
-        wrong_private_pem, wrong_public_der = generate_rsa_keypair(1024)
+        wrong_private_pem, wrong_public_der = generate_rsa_keypair(1024, variant='wrong')
         write_file(os.path.join(public_dir, 'public_key.wrong'), wrong_public_der)
         self.assertIn('File verified OK', container_util_verify(self.container, public_dir=public_dir))
     def test_error_empty_pubkey_dir(self):
@@ -182,12 +259,12 @@ class test_verify(unittest.TestCase):
         assemble_file(self.container, self.data, self.tree, self.roothash, self.digest, self.public_key, self.header)
         public_dir = os.path.join(self.dir, 'public_dir')
         os.mkdir(public_dir)
-        wrong_private_pem, wrong_public_der = generate_rsa_keypair(1024)
+        wrong_private_pem, wrong_public_der = generate_rsa_keypair(1024, variant='wrong')
         write_file(os.path.join(public_dir, 'public_key.wrong'), wrong_public_der)
         with self.assertRaises(EBADF):
             container_util_verify(self.container, public_dir=public_dir)
     def test_error_wrong_public_key(self):
-        wrong_private_pem, wrong_public_der = generate_rsa_keypair(1024)
+        wrong_private_pem, wrong_public_der = generate_rsa_keypair(1024, variant='wrong')
         write_file(self.public_key, wrong_public_der)
         make_header(self.header, self.data, self.tree, self.roothash, self.digest, self.public_key)
         assemble_file(self.container, self.data, self.tree, self.roothash, self.digest, self.public_key, self.header)
@@ -239,6 +316,117 @@ class test_create(unittest.TestCase):
     def test_ok(self):
         container_util_create(self.data, self.private_key)
         self.assertIn('File verified OK', container_util_verify(self.data, public_key=self.public_key))
+    def test_ok_threads(self):
+        # single block, single level and two level trees
+        for blocks in [1, 129, 128 * 128 + 1]:
+            write_file(self.data, os.urandom(blocks * 4096))
+            container_util(['--create', '--threads', '4', '--keyfile', self.private_key, self.data])
+            self.assertIn('File verified OK', container_util_verify(self.data, public_key=self.public_key))
+            # tree and roothash equal to veritysetup with same salt and uuid
+            data, tree, roothash = split_container(self.data)
+            salt = tree[88:120].hex()
+            uuid = '{}-{}-{}-{}-{}'.format(*[tree[16:32].hex()[x:y] for x, y in
+                                             [(0, 8), (8, 12), (12, 16), (16, 20), (20, 32)]])
+            data_path = os.path.join(self.dir, 'data-{}'.format(blocks))
+            tree_path = os.path.join(self.dir, 'tree-{}'.format(blocks))
+            root_path = os.path.join(self.dir, 'root-{}'.format(blocks))
+            write_file(data_path, data)
+            dmverity_format(root_path, tree_path, data_path,
+                            ['--salt={}'.format(salt), '--uuid={}'.format(uuid)])
+            with open(tree_path, mode='rb') as f:
+                self.assertEqual(f.read(), tree)
+            with open(root_path, mode='r') as f:
+                self.assertEqual(f.read().strip(), roothash)
+    def test_error_threads(self):
+        with self.assertRaises(EINVAL):
+            container_util(['--create', '--threads', '-1', '--keyfile', self.private_key, self.data])
+    def test_ok_stream(self):
+        # single block, single level and two level trees, last block partial
+        for size in [4096, 129 * 4096 - 100, 128 * 128 * 4096 + 1]:
+            content = os.urandom(size)
+            write_file(self.data, content)
+            container = os.path.join(self.dir, 'stream-{}.container'.format(size))
+            # data read from pipe
+            producer = subprocess.Popen(['cat', self.data], stdout=subprocess.PIPE)
+            with producer.stdout:
+                container_util(['--create', '--stream', '--keyfile', self.private_key, container], producer.stdout)
+            producer.wait()
+            self.assertIn('File verified OK', container_util_verify(container, public_key=self.public_key))
+            data, tree, roothash = split_container(container)
+            self.assertEqual(data, content + bytes(-size % 4096))
+    def test_error_stream(self):
+        with self.assertRaises(EINVAL):
+            container_util(['--verify', '--stream', '--pubkey-any', self.data])
+        with open(os.devnull, 'rb') as f:
+            with self.assertRaises(EINVAL):
+                container_util(['--create', '--stream', '--keyfile', self.private_key,
+                                os.path.join(self.dir, 'empty')], f)
+        # existing container is not replaced without --force
+        container_util_create(self.data, self.private_key)
+        with open(os.devnull, 'rb') as f:
+            with self.assertRaises(EBADF):
+                container_util(['--create', '--stream', '--keyfile', self.private_key, self.data], f)
+
+class test_cache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_der = generate_rsa_keypair(1024)
+        cls.other_pem, cls.other_der = generate_rsa_keypair(1024, variant='other')
+    def setUp(self):
+        if os.geteuid() != 0:
+            self.skipTest('verification cache only used by root')
+        self.tmpdir = tempfile.TemporaryDirectory(delete=True)
+        self.dir = self.tmpdir.name
+        self.data = os.path.join(self.dir, 'data')
+        generate_file(self.data, 16384)
+        self.private_key = os.path.join(self.dir, 'private_key')
+        write_file(self.private_key, self.private_pem)
+        self.public_dir = os.path.join(self.dir, 'public_dir')
+        os.mkdir(self.public_dir)
+        write_file(os.path.join(self.public_dir, 'other'), self.other_der)
+        write_file(os.path.join(self.public_dir, 'public_key'), self.public_der)
+        self.cache = os.path.join(self.dir, 'cache')
+        container_util_create(self.data, self.private_key)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def verify(self):
+        return container_util(['--verify', '--cache-dir', self.cache, '--pubkey-dir', self.public_dir, self.data])
+    def test_ok(self):
+        self.assertNotIn('key type: cached', self.verify())
+        out = self.verify()
+        self.assertIn('File verified OK', out)
+        self.assertIn('key type: cached', out)
+    def test_ok_modified(self):
+        self.verify()
+        os.utime(self.data, ns=(0, 0))
+        self.assertNotIn('key type: cached', self.verify())
+        self.assertIn('key type: cached', self.verify())
+    def test_ok_lru(self):
+        self.verify()
+        # oldest of 64 entries evicted
+        for x in range(64):
+            path = os.path.join(self.dir, 'data-{}'.format(x))
+            shutil.copy(self.data, path)
+            container_util(['--verify', '--cache-dir', self.cache, '--pubkey-any', path])
+        with open(os.path.join(self.cache, 'verified'), mode='r') as f:
+            self.assertEqual(len(f.readlines()), 64)
+        self.assertNotIn('key type: cached', self.verify())
+    def test_error_removed_key(self):
+        self.verify()
+        os.unlink(os.path.join(self.public_dir, 'public_key'))
+        with self.assertRaisesRegex(EBADF, 'container - valid, cached'):
+            self.verify()
+    def test_error_modified_data(self):
+        self.verify()
+        with open(self.data, mode='r+b') as f:
+            f.write(b'\x00')
+        with self.assertRaisesRegex(EBADF, 'crypt_activate_by_signed_key'):
+            self.verify()
+    def test_error_untrusted_cache(self):
+        os.mkdir(self.cache, 0o777)
+        os.chmod(self.cache, 0o777)
+        self.assertIn('cache not used', self.verify())
+        self.assertFalse(os.path.exists(os.path.join(self.cache, 'verified')))
 
 class test_roothash(unittest.TestCase):
     @classmethod
@@ -250,7 +438,6 @@ class test_roothash(unittest.TestCase):
         self.roothash = os.path.join(self.dir, 'roothash')
         self.tree = os.path.join(self.dir, 'tree')
         self.data = os.path.join(self.dir, 'data')
-        generate_file(self.data, 16384)
         self.private_key = os.path.join(self.dir, 'private_key')
         self.public_key = os.path.join(self.dir, 'public_key')
         write_file(self.private_key, self.private_pem)
@@ -258,7 +445,7 @@ class test_roothash(unittest.TestCase):
         self.digest = os.path.join(self.dir, 'digest')
         self.header = os.path.join(self.dir, 'header')
         self.container = os.path.join(self.dir, 'container')
-        dmverity_format(self.roothash, self.tree, self.data)
+        copy_verity_fixture(self.data, self.tree, self.roothash)
         sign_data(self.private_key, self.roothash, self.digest)
     def tearDown(self):
         self.tmpdir.cleanup()
@@ -308,17 +495,15 @@ class test_key_types(unittest.TestCase):
         for bits, hash, pkey_format, extra, success in self.rsa_key_types:
             # generate data
             data_path = os.path.join(self.dir, 'rsa-{}.data'.format(bits))
-            generate_file(data_path, 16384)
+            tree_path = os.path.join(self.dir, 'rsa-{}.tree'.format(bits))
+            root_path = os.path.join(self.dir, 'rsa-{}.root'.format(bits))
+            copy_verity_fixture(data_path, tree_path, root_path)
             # generate and write keys
             pkey_pem, pub_der = generate_rsa_keypair(bits, priv_format=pkey_format)
             pkey_path = os.path.join(self.dir, 'rsa-{}.priv'.format(bits))
             pub_path  = os.path.join(self.dir, 'rsa-{}.pub'.format(bits))
             write_file(pkey_path, pkey_pem)
             write_file(pub_path, pub_der)
-            # Generate tree and roothash
-            tree_path = os.path.join(self.dir, 'rsa-{}.tree'.format(bits))
-            root_path = os.path.join(self.dir, 'rsa-{}.root'.format(bits))
-            dmverity_format(root_path, tree_path, data_path)
             # generate and write digest
             digest_path = os.path.join(self.dir, 'rsa-{}.digest'.format(bits))
             sign_data(pkey_path, root_path, digest_path, hash=hash, extra=extra)
@@ -354,17 +539,15 @@ class test_key_types(unittest.TestCase):
         for curve, hash, pkey_format, success in self.ec_key_types:
             # generate data
             data_path = os.path.join(self.dir, 'ec-{}.data'.format(curve.name))
-            generate_file(data_path, 16384)
+            tree_path = os.path.join(self.dir, 'ec-{}.tree'.format(curve.name))
+            root_path = os.path.join(self.dir, 'ec-{}.root'.format(curve.name))
+            copy_verity_fixture(data_path, tree_path, root_path)
             # generate and write keys
             pkey_pem, pub_der = generate_ec_keypair(curve(), priv_format=pkey_format)
             pkey_path = os.path.join(self.dir, 'ec-{}.priv'.format(curve.name))
             pub_path  = os.path.join(self.dir, 'ec-{}.pub'.format(curve.name))
             write_file(pkey_path, pkey_pem)
             write_file(pub_path, pub_der)
-            # Generate tree and roothash
-            tree_path = os.path.join(self.dir, 'ec-{}.tree'.format(curve.name))
-            root_path = os.path.join(self.dir, 'ec-{}.root'.format(curve.name))
-            dmverity_format(root_path, tree_path, data_path)
             # generate and write digest
             digest_path = os.path.join(self.dir, 'ec-{}.digest'.format(curve.name))
             sign_data(pkey_path, root_path, digest_path, hash=hash, extra=None)
@@ -397,5 +580,125 @@ class test_key_types(unittest.TestCase):
             container_util_create(data_path, pkey_path)
             self.assertIn('File verified OK', container_util_verify(data_path, public_key=pub_path))
 
+class test_library(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.rsa_private_pem, cls.rsa_public_der = generate_rsa_keypair(2048)
+        cls.ec_private_pem, cls.ec_public_der = generate_ec_keypair(ec.SECP384R1())
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(delete=True)
+        self.dir = self.tmpdir.name
+        self.public_dir = os.path.join(self.dir, 'public_dir')
+        os.mkdir(self.public_dir)
+        self.containers = []
+        # single block, single level and two level hash trees
+        for i, (size, private_pem, public_der) in enumerate([
+                (4096, self.rsa_private_pem, self.rsa_public_der),
+                (16384, self.ec_private_pem, self.ec_public_der),
+                (4096 * 128 * 2 + 4096, self.rsa_private_pem, self.rsa_public_der)]):
+            private_key = os.path.join(self.dir, 'private_key{}'.format(i))
+            write_file(private_key, private_pem)
+            write_file(os.path.join(self.public_dir, 'public_key{}'.format(i)), public_der)
+            container = os.path.join(self.dir, 'container{}'.format(i))
+            write_file(container, os.urandom(size))
+            container_util_create(container, private_key)
+            self.containers.append(container)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_ok_regions(self):
+        with image_container.Container(self.containers[1]) as container:
+            self.assertEqual(container.roothash, container_util_roothash(
+                self.containers[1], os.path.join(self.public_dir, 'public_key1')).strip())
+            self.assertEqual(bytes(container.key), self.ec_public_der)
+            self.assertEqual(len(container.data), 16384)
+            self.assertTrue(container.verify_signature())
+            self.assertTrue(container.verify_tree())
+    def test_ok_verify_many(self):
+        trusted = image_container.TrustedKeys(dirs=[self.public_dir])
+        self.assertEqual(image_container.verify_many(self.containers, trusted), [None] * 3)
+        self.assertEqual(image_container.verify_many(self.containers), [None] * 3)
+    def test_error_verify_many(self):
+        with open(self.containers[2], 'r+b') as f:
+            f.seek(4096 * 200)
+            f.write(b'\x00')
+        os.remove(os.path.join(self.public_dir, 'public_key1'))
+        trusted = image_container.TrustedKeys(dirs=[self.public_dir])
+        results = image_container.verify_many(self.containers, trusted)
+        self.assertIsNone(results[0])
+        self.assertIn('pubkey validation failed', results[1])
+        self.assertIn('data does not match roothash', results[2])
+        self.assertEqual(image_container.verify_many(self.containers[2:], tree=False), [None])
+    def test_error_signature(self):
+        with image_container.Container(self.containers[0]) as container:
+            digest_offset = len(container.data) + len(container.tree) + len(container.root)
+        with open(self.containers[0], 'r+b') as f:
+            f.seek(digest_offset)
+            byte = f.read(1)[0]
+            f.seek(digest_offset)
+            f.write(bytes([byte ^ 0xff]))
+        with self.assertRaisesRegex(image_container.ContainerError, 'invalid signature'):
+            image_container.verify(self.containers[0])
+    def test_error_not_container(self):
+        data = os.path.join(self.dir, 'data')
+        generate_file(data, 16384)
+        with self.assertRaisesRegex(image_container.ContainerError, 'not a container'):
+            image_container.verify(data)
+
+# Run tests of name in worker process with its own temporary directory.
+# Returns (name, output, tests run, failures, errors, skipped).
+def run_worker(name):
+    tmpdir = tempfile.mkdtemp(prefix='test-container-util-worker-')
+    parent = tempfile.tempdir
+    tempfile.tempdir = tmpdir
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromName(name, sys.modules[__name__])
+        stream = io.StringIO()
+        result = unittest.TextTestRunner(stream=stream, verbosity=1).run(suite)
+        return (name, stream.getvalue(), result.testsRun, len(result.failures),
+                len(result.errors), len(result.skipped))
+    finally:
+        tempfile.tempdir = parent
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+# Run test classes, or tests of names, in parallel worker processes
+def run_parallel(jobs, names):
+    if not names:
+        names = [name for name, value in sorted(globals().items())
+                 if isinstance(value, type) and issubclass(value, unittest.TestCase)]
+    # fixtures are shared by workers, errors are reported by the tests using them
+    try:
+        session_fixture('verity', verity_fixture)
+    except (OSError, CalledProcessError):
+        pass
+    start = time.monotonic()
+    run = failures = errors = skipped = 0
+    with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        futures = [executor.submit(run_worker, name) for name in names]
+        for future in as_completed(futures):
+            name, output, tests, f, e, s = future.result()
+            print('{}:\n{}'.format(name, output), end='', file=sys.stderr, flush=True)
+            run += tests
+            failures += f
+            errors += e
+            skipped += s
+    print('Ran {} tests in {:.3f}s with {} jobs'.format(run, time.monotonic() - start, jobs or os.cpu_count()),
+          file=sys.stderr)
+    if failures or errors:
+        print('FAILED (failures={}, errors={})'.format(failures, errors), file=sys.stderr)
+        return 1
+    print('OK (skipped={})'.format(skipped) if skipped else 'OK', file=sys.stderr)
+    return 0
+
 if __name__ == '__main__':
-    unittest.main()
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Run test classes in parallel worker processes, 0 for one per CPU')
+    parser.add_argument('--key-cache', nargs='?', default=KEY_CACHE, const=DEFAULT_KEY_CACHE,
+                        help='Reuse keypairs between runs from directory, default {}'.format(DEFAULT_KEY_CACHE))
+    args, rest = parser.parse_known_args()
+    if args.jobs < 0:
+        parser.error('invalid --jobs')
+    KEY_CACHE = os.environ['TEST_KEY_CACHE'] = args.key_cache
+    if args.jobs == 1:
+        unittest.main(argv=sys.argv[:1] + rest)
+    sys.exit(run_parallel(args.jobs, [x for x in rest if not x.startswith('-')]))
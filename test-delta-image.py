@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+import unittest
+import tempfile
+import os
+import subprocess
+
+BLOCK_SIZE = 4096
+
+
+class EDELTAIMAGE(RuntimeError):
+    pass
+
+def delta_image(args):
+    largs = ['build/delta-image']
+    largs.extend(args)
+    r = subprocess.run(largs, capture_output=True)
+    if r.returncode != 0:
+        raise EDELTAIMAGE((r.stdout + r.stderr).decode())
+    return r.stdout.decode()
+
+def write_file(path, data):
+    with open(path, mode='wb') as f:
+        f.write(data)
+
+def read_file(path):
+    with open(path, mode='rb') as f:
+        return f.read()
+
+class test_delta(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(delete=True)
+        self.dir = self.tmpdir.name
+        self.source = os.path.join(self.dir, 'source')
+        self.target = os.path.join(self.dir, 'target')
+        self.delta = os.path.join(self.dir, 'delta')
+        self.output = os.path.join(self.dir, 'output')
+        # 4 MiB of random blocks followed by 4 MiB of zeros
+        self.source_data = os.urandom(4 << 20) + bytes(4 << 20)
+        write_file(self.source, self.source_data)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def create_apply(self, target_data, output_data=b''):
+        write_file(self.target, target_data)
+        write_file(self.output, output_data)
+        out = delta_image(['--create', '--source', self.source, '--target', self.target, self.delta])
+        delta_image(['--apply', '--source', self.source, '--target', self.output, self.delta])
+        self.assertEqual(read_file(self.output), target_data)
+        return out
+
+    def test_ok_unchanged(self):
+        out = self.create_apply(self.source_data)
+        self.assertIn('Literal: 0 b', out)
+        self.assertLess(os.path.getsize(self.delta), BLOCK_SIZE)
+
+    def test_ok_changed_moved_zero(self):
+        data = bytearray(self.source_data)
+        # changed block
+        data[BLOCK_SIZE + 10:BLOCK_SIZE + 20] = os.urandom(10)
+        # block moved into zero area
+        data[5 << 20:(5 << 20) + BLOCK_SIZE] = self.source_data[(2 << 20):(2 << 20) + BLOCK_SIZE]
+        # zeroed block
+        data[3 << 20:(3 << 20) + BLOCK_SIZE] = bytes(BLOCK_SIZE)
+        out = self.create_apply(bytes(data), os.urandom(8 << 20))
+        self.assertIn('Literal: 4096 b', out)
+        self.assertIn('Zero:    {} b'.format(4 << 20), out)
+
+    def test_ok_size_change(self):
+        self.create_apply(self.source_data[:(6 << 20) + 100])
+        self.create_apply(self.source_data + os.urandom(BLOCK_SIZE + 7))
+
+    def test_error_source_mismatch(self):
+        data = bytearray(self.source_data)
+        data[0] ^= 1
+        write_file(self.target, bytes(data))
+        write_file(self.output, b'')
+        delta_image(['--create', '--source', self.source, '--target', self.target, self.delta])
+        # only blocks copied from source are verified
+        other = os.path.join(self.dir, 'other')
+        write_file(other, bytes(BLOCK_SIZE) + self.source_data[BLOCK_SIZE:])
+        delta_image(['--apply', '--source', other, '--target', self.output, self.delta])
+        self.assertEqual(read_file(self.output), bytes(data))
+        write_file(self.output, b'')
+        write_file(other, self.source_data[:BLOCK_SIZE] + bytes(BLOCK_SIZE) + self.source_data[2 * BLOCK_SIZE:])
+        with self.assertRaises(EDELTAIMAGE):
+            delta_image(['--apply', '--source', other, '--target', self.output, self.delta])
+        self.assertEqual(read_file(self.output), b'')
+
+    def test_error_truncated(self):
+        data = bytearray(self.source_data)
+        data[100] ^= 1
+        write_file(self.target, bytes(data))
+        write_file(self.output, b'')
+        delta_image(['--create', '--source', self.source, '--target', self.target, self.delta])
+        with open(self.delta, 'r+b') as f:
+            f.truncate(os.path.getsize(self.delta) - 1)
+        with self.assertRaises(EDELTAIMAGE):
+            delta_image(['--apply', '--source', self.source, '--target', self.output, self.delta])
+
+if __name__ == '__main__':
+    unittest.main()
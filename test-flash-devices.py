@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+import unittest
+import tempfile
+import os
+import subprocess
+
+BLOCK_SIZE = 4096
+
+
+class EFLASHDEVICES(RuntimeError):
+    pass
+
+def run(tool, args):
+    largs = [tool]
+    largs.extend(args)
+    r = subprocess.run(largs, capture_output=True)
+    if r.returncode != 0:
+        raise EFLASHDEVICES((r.stdout + r.stderr).decode())
+    return r.stdout.decode()
+
+def flash_devices(args, allow_file=True):
+    return run('build/flash-devices', (['--allow-file'] if allow_file else []) + args)
+
+def gpt_insert(args):
+    return run('build/gpt-insert', args)
+
+def write_file(path, data, offset=0):
+    with open(path, mode='r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+
+def read_file(path):
+    with open(path, mode='rb') as f:
+        return f.read()
+
+class test_flash(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(delete=True)
+        self.dir = self.tmpdir.name
+        self.image = os.path.join(self.dir, 'disk.img')
+        self.bmap = os.path.join(self.dir, 'disk.img.bmap')
+        # 16 MiB sparse image with data at 0, 4 MiB and an unaligned tail at end
+        self.size = (16 << 20) - 100
+        with open(self.image, mode='wb') as f:
+            f.truncate(self.size)
+        write_file(self.image, os.urandom(3 << 20), 0)
+        write_file(self.image, os.urandom(3 * BLOCK_SIZE + 17), 4 << 20)
+        write_file(self.image, os.urandom(1000), self.size - 1000)
+        gpt_insert(['--finalize', '--bmap', self.bmap, self.image])
+        self.devices = [os.path.join(self.dir, 'device{}'.format(x)) for x in range(3)]
+        for device in self.devices:
+            write_file(device, b'')
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ok(self):
+        out = flash_devices(['--bmap', self.bmap, self.image] + self.devices)
+        image = read_file(self.image)
+        # mapped blocks, last block partial
+        mapped = (3 << 20) + 4 * BLOCK_SIZE + BLOCK_SIZE - 100
+        for device in self.devices:
+            self.assertEqual(read_file(device), image)
+            self.assertIn('{}: OK {} b in'.format(device, mapped), out)
+    def test_ok_buffers(self):
+        # Fewer and smaller buffers than data in flight
+        flash_devices(['--buffers', '1', '--buffer-size', str(BLOCK_SIZE), '--bmap', self.bmap,
+                       self.image] + self.devices)
+        image = read_file(self.image)
+        for device in self.devices:
+            self.assertEqual(read_file(device), image)
+    def test_ok_existing_data(self):
+        # Unmapped ranges of existing device are not written
+        write_file(self.devices[0], b'stale', 8 << 20)
+        flash_devices(['--bmap', self.bmap, self.image, self.devices[0]])
+        self.assertEqual(read_file(self.devices[0])[8 << 20:(8 << 20) + 5], b'stale')
+    def test_ok_truncate(self):
+        # Regular file larger than image is truncated to image size
+        write_file(self.devices[0], b'stale', self.size + (1 << 20))
+        flash_devices(['--bmap', self.bmap, self.image, self.devices[0]])
+        self.assertEqual(read_file(self.devices[0]), read_file(self.image))
+    def test_error_device_isolated(self):
+        # Failing open and failing writes do not affect other devices
+        missing = os.path.join(self.dir, 'missing', 'device')
+        devices = [self.devices[0], missing, '/dev/full', self.devices[1]]
+        with self.assertRaises(EFLASHDEVICES) as cm:
+            flash_devices(['--buffers', '2', '--buffer-size', str(BLOCK_SIZE), '--bmap', self.bmap,
+                           self.image] + devices)
+        out = str(cm.exception)
+        self.assertIn('{}: FAILED'.format(missing), out)
+        self.assertFalse(os.path.exists(missing))
+        self.assertIn('/dev/full: FAILED', out)
+        image = read_file(self.image)
+        for device in self.devices[:2]:
+            self.assertIn('{}: OK'.format(device), out)
+            self.assertEqual(read_file(device), image)
+    def test_error_not_block_device(self):
+        with self.assertRaises(EFLASHDEVICES) as cm:
+            flash_devices(['--bmap', self.bmap, self.image, self.devices[0]], allow_file=False)
+        self.assertIn('{}: FAILED Not a block device'.format(self.devices[0]), str(cm.exception))
+        self.assertEqual(read_file(self.devices[0]), b'')
+    def test_error_missing(self):
+        # Missing device is never created
+        missing = os.path.join(self.dir, 'missing')
+        with self.assertRaisesRegex(EFLASHDEVICES, '{}: FAILED'.format(missing)):
+            flash_devices(['--bmap', self.bmap, self.image, missing])
+        self.assertFalse(os.path.exists(missing))
+    def test_error_image(self):
+        write_file(self.image, b'x', (4 << 20) + 1)
+        with self.assertRaisesRegex(EFLASHDEVICES, 'Image checksum mismatch'):
+            flash_devices(['--bmap', self.bmap, self.image] + self.devices)
+    def test_error_args(self):
+        with self.assertRaisesRegex(EFLASHDEVICES, 'Duplicate DEVICE'):
+            flash_devices(['--bmap', self.bmap, self.image, self.devices[0], self.devices[0]])
+        with self.assertRaisesRegex(EFLASHDEVICES, 'Invalid --buffer-size'):
+            flash_devices(['--buffer-size', '1000', '--bmap', self.bmap, self.image, self.devices[0]])
+
+if __name__ == '__main__':
+    unittest.main()
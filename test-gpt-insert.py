@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+
+import unittest
+import tempfile
+import os
+import subprocess
+import struct
+import uuid
+import zlib
+import hashlib
+import json
+import pstats
+import xml.etree.ElementTree as ET
+import lzma
+import gzip
+
+SECTOR_SIZE = 512
+NUM_ENTRIES = 128
+ENTRY_SIZE = 128
+
+class EGPTINSERT(RuntimeError):
+    pass
+
+def gpt_insert(args, stdin=None):
+    largs = ['build/gpt-insert']
+    largs.extend(args)
+    r = subprocess.run(largs, capture_output=True, stdin=stdin)
+    if r.returncode != 0:
+        raise EGPTINSERT((r.stdout + r.stderr).decode())
+    return r.stdout.decode()
+
+def gpt_header(current_lba, backup_lba, last_lba, disk_guid, entries_lba, entries):
+    first_usable = 2 + (NUM_ENTRIES * ENTRY_SIZE) // SECTOR_SIZE
+    last_usable = last_lba - 1 - (NUM_ENTRIES * ENTRY_SIZE) // SECTOR_SIZE
+    fields = [b'EFI PART', 0x00010000, 92, 0, 0, current_lba, backup_lba,
+              first_usable, last_usable, disk_guid, entries_lba, NUM_ENTRIES, ENTRY_SIZE,
+              zlib.crc32(entries)]
+    header = struct.pack('<8sIIIIQQQQ16sQIII', *fields)
+    fields[3] = zlib.crc32(header)
+    return struct.pack('<8sIIIIQQQQ16sQIII', *fields)
+
+# partitions is list of (name, offset, size) in bytes
+def make_gpt(path, disk_size, partitions):
+    entries = bytearray(NUM_ENTRIES * ENTRY_SIZE)
+    for i, (name, offset, size) in enumerate(partitions):
+        struct.pack_into('<16s16sQQQ72s', entries, i * ENTRY_SIZE,
+                         uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4').bytes_le,
+                         uuid.uuid4().bytes_le, offset // SECTOR_SIZE,
+                         (offset + size) // SECTOR_SIZE - 1, 0, name.encode('utf-16-le'))
+    last_lba = disk_size // SECTOR_SIZE - 1
+    backup_entries_lba = last_lba - (NUM_ENTRIES * ENTRY_SIZE) // SECTOR_SIZE
+    disk_guid = uuid.uuid4().bytes_le
+    with open(path, mode='wb') as f:
+        f.truncate(disk_size)
+        f.seek(SECTOR_SIZE)
+        f.write(gpt_header(1, last_lba, last_lba, disk_guid, 2, entries))
+        f.seek(2 * SECTOR_SIZE)
+        f.write(entries)
+        f.seek(backup_entries_lba * SECTOR_SIZE)
+        f.write(entries)
+        f.write(gpt_header(last_lba, 1, last_lba, disk_guid, backup_entries_lba, entries))
+
+def generate_file(path, size, data_offsets=[0]):
+    with open(path, mode='wb') as f:
+        f.truncate(size)
+        for offset in data_offsets:
+            f.seek(offset)
+            f.write(os.urandom(min(65536, size - offset)))
+
+def write_file(path, data):
+    with open(path, mode='wb') as f:
+        f.write(data)
+
+def read_file(path, offset=0, size=-1):
+    with open(path, mode='rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+def sha256_file(path):
+    with open(path, mode='rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Validate bmap towards image as done by bmaptool, returns mapped blocks
+def check_bmap(testcase, bmap, image):
+    with open(bmap, 'r') as f:
+        content = f.read()
+    root = ET.fromstring(content)
+    checksum = root.find('BmapFileChecksum').text.strip()
+    testcase.assertEqual(hashlib.sha256(content.replace(checksum, '0' * len(checksum)).encode()).hexdigest(),
+                         checksum)
+    testcase.assertEqual(int(root.find('ImageSize').text), os.path.getsize(image))
+    block_size = int(root.find('BlockSize').text)
+    blocks = []
+    for r in root.find('BlockMap').findall('Range'):
+        first, _, last = r.text.strip().partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        blocks.append((first, last))
+        data = read_file(image, first * block_size, (last - first + 1) * block_size)
+        testcase.assertEqual(hashlib.sha256(data).hexdigest(), r.get('chksum'))
+    testcase.assertEqual(int(root.find('MappedBlocksCount').text), sum(l - f + 1 for f, l in blocks))
+    return blocks
+
+class test_insert(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(delete=True)
+        self.dir = self.tmpdir.name
+        self.disk = os.path.join(self.dir, 'disk.img')
+        self.parts = [('rootfs1', 1 << 20, 8 << 20), ('rootfs2', 9 << 20, 8 << 20),
+                      ('data', 17 << 20, 4 << 20)]
+        make_gpt(self.disk, 32 << 20, self.parts)
+        self.input = os.path.join(self.dir, 'input')
+        generate_file(self.input, 4 << 20, [0, 1 << 20, (4 << 20) - 4096])
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_ok(self):
+        gpt_insert(['--label', 'rootfs2', '--input', self.input, self.disk])
+        self.assertEqual(read_file(self.disk, 9 << 20, 4 << 20), read_file(self.input))
+    def test_ok_copy_engines(self):
+        for engine in ['copy_file_range', 'sendfile', 'read']:
+            make_gpt(self.disk, 32 << 20, self.parts)
+            out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--copy-engine', engine,
+                              '--debug', self.disk])
+            self.assertIn('Copy engine: {}'.format(engine), out)
+            self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+    def test_ok_copy_engine_journal(self):
+        # Journaled data is copied by selected engine and hashed from IMAGE
+        journal = os.path.join(self.dir, 'journal')
+        for engine in ['copy_file_range', 'sendfile']:
+            make_gpt(self.disk, 32 << 20, self.parts)
+            out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--copy-engine', engine,
+                              '--journal', journal, '--debug', self.disk])
+            self.assertIn('Copy engine: {}'.format(engine), out)
+            out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--journal', journal,
+                              '--resume', self.disk])
+            self.assertIn('Resumed:     135168 of 4194304 b', out)
+    def test_error_copy_engine(self):
+        # Hashed data is copied by engine read only
+        bmap = os.path.join(self.dir, 'input.bmap')
+        sha256 = os.path.join(self.dir, 'sha256')
+        for args in [['--bmap', bmap], ['--sha256', sha256]]:
+            with self.assertRaisesRegex(EGPTINSERT, '--copy-engine sendfile can not be combined'):
+                gpt_insert(['--label', 'rootfs1', '--input', self.input, '--copy-engine', 'sendfile',
+                            self.disk] + args)
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--copy-engine', 'read',
+                          '--sha256', sha256, '--debug', self.disk])
+        self.assertIn('Copy engine: read', out)
+    def test_ok_multiple(self):
+        data = os.path.join(self.dir, 'data.img')
+        generate_file(data, 1 << 20)
+        manifest = os.path.join(self.dir, 'manifest')
+        with open(manifest, 'w') as f:
+            f.write('# comment\ndata=data.img\n')
+        profile = os.path.join(self.dir, 'profile')
+        gpt_insert(['--insert', 'rootfs1={}'.format(self.input), '--manifest', manifest,
+                    '--profile', profile, self.disk])
+        self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+        self.assertEqual(read_file(self.disk, 17 << 20, 1 << 20), read_file(data))
+        # Partitions written in worker threads are profiled
+        calls = {func[2]: stat[1] for func, stat in pstats.Stats(profile).stats.items()}
+        self.assertEqual(calls['insert_partition'], 2)
+    def test_ok_bmap_sha256(self):
+        bmap = os.path.join(self.dir, 'input.bmap')
+        sha256 = os.path.join(self.dir, 'input.sha256')
+        gpt_insert(['--label', 'rootfs1', '--input', self.input, '--bmap', bmap, '--sha256', sha256, self.disk])
+        self.assertEqual(check_bmap(self, bmap, self.input), [(0, 15), (256, 271), (1023, 1023)])
+        self.assertEqual(read_file(sha256), '{}  -\n'.format(sha256_file(self.input)).encode())
+    def test_ok_finalize(self):
+        bmap = os.path.join(self.dir, 'disk.bmap')
+        sha256 = os.path.join(self.dir, 'disk.sha256')
+        gpt_insert(['--label', 'rootfs1', '--input', self.input, self.disk])
+        gpt_insert(['--finalize', '--bmap', bmap, '--sha256', sha256, self.disk])
+        check_bmap(self, bmap, self.disk)
+        self.assertEqual(read_file(sha256), '{}  -\n'.format(sha256_file(self.disk)).encode())
+    def test_ok_finalize_extent_map(self):
+        bmap = os.path.join(self.dir, 'disk.bmap')
+        sha256 = os.path.join(self.dir, 'disk.sha256')
+        extent_map = os.path.join(self.dir, 'disk.extents')
+        # stale data outside of inserted extents is not mapped
+        with open(self.disk, 'r+b') as f:
+            f.seek(9 << 20)
+            f.write(b'\x01' * 4096)
+        gpt_insert(['--label', 'rootfs1', '--input', self.input, '--extent-map', extent_map, self.disk])
+        gpt_insert(['--finalize', '--extent-map', extent_map, '--bmap', bmap, '--sha256', sha256, self.disk])
+        blocks = check_bmap(self, bmap, self.disk)
+        self.assertNotIn((9 << 20) // 4096, [b for f, l in blocks for b in range(f, l + 1)])
+        with open(self.disk, 'r+b') as f:
+            f.seek(9 << 20)
+            f.write(bytes(4096))
+        self.assertEqual(read_file(sha256), '{}  -\n'.format(sha256_file(self.disk)).encode())
+    def test_ok_stdin(self):
+        with open(self.input, 'rb') as f:
+            gpt_insert(['--label', 'rootfs2', '--input', '-', self.disk], stdin=f)
+        self.assertEqual(read_file(self.disk, 9 << 20, 4 << 20), read_file(self.input))
+    def test_ok_compressed(self):
+        for name, compress in [('xz', lzma.compress), ('gz', gzip.compress)]:
+            make_gpt(self.disk, 32 << 20, self.parts)
+            compressed = os.path.join(self.dir, 'input.{}'.format(name))
+            write_file(compressed, compress(read_file(self.input)))
+            bmap = os.path.join(self.dir, 'input.bmap')
+            sha256 = os.path.join(self.dir, 'input.sha256')
+            gpt_insert(['--label', 'rootfs1', '--input', compressed, '--bmap', bmap, '--sha256', sha256, self.disk])
+            self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+            self.assertEqual(check_bmap(self, bmap, self.input), [(0, 15), (256, 271), (1023, 1023)])
+            self.assertEqual(read_file(sha256), '{}  -\n'.format(sha256_file(self.input)).encode())
+    def test_ok_stream_zero_blocks_skipped(self):
+        # dense input with zero blocks
+        write_file(self.input, read_file(self.input))
+        with open(self.input, 'rb') as f:
+            gpt_insert(['--label', 'rootfs1', '--input', '-', self.disk], stdin=f)
+        self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+        with open(self.disk, 'rb') as f:
+            self.assertEqual(os.lseek(f.fileno(), (1 << 20) + 65536, os.SEEK_DATA), 2 << 20)
+    def test_ok_sparsify(self):
+        # stale data in partition within input hole and after input
+        with open(self.disk, 'r+b') as f:
+            for offset in [(1 << 20) + (512 << 10), (1 << 20) + (6 << 20)]:
+                f.seek(offset)
+                f.write(b'\x01' * 65536)
+        # block of zeros in input data extent
+        with open(self.input, 'r+b') as f:
+            f.seek(8192)
+            f.write(bytes(4096))
+        gpt_insert(['--label', 'rootfs1', '--input', self.input, '--sparsify', self.disk])
+        self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+        self.assertEqual(read_file(self.disk, 5 << 20, 4 << 20), bytes(4 << 20))
+        data = []
+        with open(self.disk, 'rb') as f:
+            offset = 1 << 20
+            while offset < 9 << 20:
+                offset = os.lseek(f.fileno(), offset, os.SEEK_DATA)
+                end = os.lseek(f.fileno(), offset, os.SEEK_HOLE)
+                data.append((offset - (1 << 20), end - offset))
+                offset = end
+        self.assertEqual(data[:4], [(0, 8192), (12288, 65536 - 12288), (1 << 20, 65536),
+                                    ((4 << 20) - 4096, 4096)])
+    def test_ok_incremental(self):
+        gpt_insert(['--label', 'rootfs1', '--input', self.input, self.disk])
+        with open(self.input, 'r+b') as f:
+            f.seek((1 << 20) + 100)
+            f.write(b'\x02' * 16)
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--incremental', self.disk])
+        self.assertIn('Rewritten:   65536 of 4194304 b', out)
+        self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+
+    def test_ok_journal_resume(self):
+        journal = os.path.join(self.dir, 'journal')
+        bmap = os.path.join(self.dir, 'input.bmap')
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--journal', journal, self.disk])
+        self.assertIn('Resumed:     0 of 4194304 b', out)
+        # Interrupted after first extent, later extents not written
+        with open(journal, 'r') as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 4)
+        with open(journal, 'w') as f:
+            f.writelines(lines[:2])
+            f.write('{"label": "rootf')
+        with open(self.disk, 'r+b') as f:
+            f.seek((1 << 20) + (1 << 20))
+            f.write(bytes(3 << 20))
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--journal', journal, '--resume',
+                          '--bmap', bmap, self.disk])
+        self.assertIn('Resumed:     65536 of 4194304 b', out)
+        self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+        self.assertEqual(check_bmap(self, bmap, self.input), [(0, 15), (256, 271), (1023, 1023)])
+        # Completed journal, nothing written
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--journal', journal, '--resume', self.disk])
+        self.assertIn('Resumed:     135168 of 4194304 b', out)
+        # Last journaled extent modified in IMAGE is written again
+        with open(self.disk, 'r+b') as f:
+            f.seek((1 << 20) + (4 << 20) - 4096)
+            f.write(bytes(4096))
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--journal', journal, '--resume', self.disk])
+        self.assertIn('Resumed:     131072 of 4194304 b', out)
+        self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+
+    def test_error_journal_resume(self):
+        journal = os.path.join(self.dir, 'journal')
+        gpt_insert(['--label', 'rootfs1', '--input', self.input, '--journal', journal, self.disk])
+        # Modified input
+        with open(self.input, 'r+b') as f:
+            f.write(b'\x03')
+        with self.assertRaisesRegex(EGPTINSERT, 'does not match'):
+            gpt_insert(['--label', 'rootfs1', '--input', self.input, '--journal', journal, '--resume', self.disk])
+        # Different target partition
+        with self.assertRaisesRegex(EGPTINSERT, 'does not match'):
+            gpt_insert(['--label', 'rootfs2', '--input', self.input, '--journal', journal, '--resume', self.disk])
+        with self.assertRaisesRegex(EGPTINSERT, 'requires --journal'):
+            gpt_insert(['--label', 'rootfs1', '--input', self.input, '--resume', self.disk])
+
+    def test_ok_stats_progress_profile(self):
+        stats = os.path.join(self.dir, 'stats.json')
+        profile = os.path.join(self.dir, 'profile')
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--stats', stats,
+                          '--progress', '60', '--profile', profile, self.disk])
+        self.assertIn('Progress:    135168 of 135168 b (100.0%)', out)
+        with open(stats, 'r') as f:
+            result = json.load(f)
+        for entry in [result['total'], result['partitions']['rootfs1']]:
+            self.assertEqual(entry['input_bytes'], 4 << 20)
+            self.assertEqual(entry['data_bytes'], 135168)
+            self.assertEqual(entry['hole_bytes'], (4 << 20) - 135168)
+            self.assertEqual(entry['written_bytes'], 135168)
+            self.assertGreater(entry['syscalls']['seek'], 0)
+        self.assertEqual([(x['offset'], x['size']) for x in result['partitions']['rootfs1']['extents']],
+                         [(0, 65536), (1 << 20, 65536), ((4 << 20) - 4096, 4096)])
+        self.assertIn('insert_partition', ''.join(str(x) for x in pstats.Stats(profile).stats))
+
+    def test_ok_incremental_index(self):
+        index = os.path.join(self.dir, 'index.json')
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--incremental',
+                          '--index', index, self.disk])
+        self.assertIn('Rewritten:   196608 of 4194304 b', out)
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--incremental',
+                          '--index', index, '--debug', self.disk])
+        self.assertIn('Index:       valid', out)
+        self.assertIn('Rewritten:   0 of 4194304 b', out)
+        # index invalidated by modified image
+        with open(self.disk, 'r+b') as f:
+            f.seek(1 << 20)
+            f.write(bytes(16))
+        out = gpt_insert(['--label', 'rootfs1', '--input', self.input, '--incremental',
+                          '--index', index, '--debug', self.disk])
+        self.assertIn('Index:       none', out)
+        self.assertIn('Rewritten:   65536 of 4194304 b', out)
+        self.assertEqual(read_file(self.disk, 1 << 20, 4 << 20), read_file(self.input))
+
+    def test_error_stream_too_large(self):
+        generate_file(self.input, 5 << 20, [(5 << 20) - 4096])
+        with open(self.input, 'rb') as f:
+            with self.assertRaises(EGPTINSERT):
+                gpt_insert(['--label', 'data', '--input', '-', self.disk], stdin=f)
+    def test_error_duplicate_label(self):
+        with self.assertRaises(EGPTINSERT):
+            gpt_insert(['--insert', 'rootfs1={}'.format(self.input),
+                        '--insert', 'rootfs1={}'.format(self.input), self.disk])
+    def test_error_no_label(self):
+        with self.assertRaises(EGPTINSERT):
+            gpt_insert(['--label', 'rootfs3', '--input', self.input, self.disk])
+    def test_error_input_too_large(self):
+        generate_file(self.input, 5 << 20)
+        with self.assertRaises(EGPTINSERT):
+            gpt_insert(['--label', 'data', '--input', self.input, self.disk])
+    def test_error_header_crc(self):
+        with open(self.disk, 'r+b') as f:
+            f.seek(SECTOR_SIZE + 40)
+            f.write(b'\x01')
+        with self.assertRaises(EGPTINSERT):
+            gpt_insert(['--label', 'rootfs1', '--input', self.input, '--gpt-reader', 'builtin', self.disk])
+    def test_error_entries_crc(self):
+        with open(self.disk, 'r+b') as f:
+            f.seek(2 * SECTOR_SIZE + 32)
+            f.write(b'\x01')
+        with self.assertRaises(EGPTINSERT):
+            gpt_insert(['--label', 'rootfs1', '--input', self.input, '--gpt-reader', 'builtin', self.disk])
+    def test_error_backup_mismatch(self):
+        make_gpt(os.path.join(self.dir, 'other.img'), 32 << 20, self.parts[:1])
+        backup = read_file(os.path.join(self.dir, 'other.img'), (32 << 20) - 33 * SECTOR_SIZE)
+        with open(self.disk, 'r+b') as f:
+            f.seek((32 << 20) - 33 * SECTOR_SIZE)
+            f.write(backup)
+        with self.assertRaises(EGPTINSERT):
+            gpt_insert(['--label', 'rootfs1', '--input', self.input, '--gpt-reader', 'builtin', self.disk])
+    def test_error_not_gpt(self):
+        with self.assertRaises(EGPTINSERT):
+            gpt_insert(['--label', 'rootfs1', '--input', self.input, '--gpt-reader', 'builtin', self.input])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import unittest
+import tempfile
+import os
+import json
+import subprocess
+
+BLOCK_SIZE = 4096
+
+
+class EVERIFYDEVICE(RuntimeError):
+    pass
+
+def run(tool, args):
+    largs = [tool]
+    largs.extend(args)
+    r = subprocess.run(largs, capture_output=True)
+    if r.returncode != 0:
+        raise EVERIFYDEVICE((r.stdout + r.stderr).decode())
+    return r.stdout.decode()
+
+def verify_device(args):
+    return run('build/verify-device', args)
+
+def gpt_insert(args):
+    return run('build/gpt-insert', args)
+
+def write_file(path, data, offset=0):
+    with open(path, mode='r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+
+def read_file(path):
+    with open(path, mode='rb') as f:
+        return f.read()
+
+def direct_supported(path):
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+class test_verify(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(delete=True)
+        self.dir = self.tmpdir.name
+        self.image = os.path.join(self.dir, 'disk.img')
+        self.bmap = os.path.join(self.dir, 'disk.img.bmap')
+        self.device = os.path.join(self.dir, 'device')
+        self.zeros = os.path.join(self.dir, 'disk.img.zeros')
+        # 16 MiB sparse image with data at 0, 4 MiB and an unaligned tail at end
+        self.size = (16 << 20) - 100
+        with open(self.image, mode='wb') as f:
+            f.truncate(self.size)
+        write_file(self.image, os.urandom(1 << 20), 0)
+        write_file(self.image, os.urandom(3 * BLOCK_SIZE + 17), 4 << 20)
+        write_file(self.image, os.urandom(1000), self.size - 1000)
+        gpt_insert(['--finalize', '--bmap', self.bmap, self.image])
+        # Device is larger than image and contains stale data in unmapped ranges
+        write_file(self.device, read_file(self.image) + os.urandom(1 << 20))
+        write_file(self.device, b'stale', 8 << 20)
+        with open(self.zeros, mode='w') as f:
+            json.dump({'block_size': BLOCK_SIZE, 'extents': [[8 << 20, 1 << 20]]}, f)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ok(self):
+        out = verify_device(['--bmap', self.bmap, self.device])
+        self.assertIn('Valid!', out)
+    def test_ok_jobs(self):
+        for jobs in ['1', '3']:
+            verify_device(['--jobs', jobs, '--bmap', self.bmap, self.device])
+    def test_ok_direct(self):
+        if not direct_supported(self.device):
+            self.skipTest('O_DIRECT not supported by filesystem')
+        verify_device(['--direct', '--bmap', self.bmap, self.device])
+    def test_ok_zero_ranges(self):
+        write_file(self.device, bytes(5), 8 << 20)
+        verify_device(['--bmap', self.bmap, '--zero-ranges', self.zeros, self.device])
+    def test_error_zero_ranges(self):
+        with self.assertRaisesRegex(EVERIFYDEVICE, 'not zero'):
+            verify_device(['--bmap', self.bmap, '--zero-ranges', self.zeros, self.device])
+    def test_error_mapped(self):
+        for offset in [0, (4 << 20) + 3 * BLOCK_SIZE + 16, self.size - 1]:
+            data = read_file(self.device)
+            write_file(self.device, bytes([data[offset] ^ 0xff]), offset)
+            with self.assertRaisesRegex(EVERIFYDEVICE, 'checksum mismatch'):
+                verify_device(['--bmap', self.bmap, self.device])
+            write_file(self.device, data[offset:offset + 1], offset)
+    def test_error_device_size(self):
+        os.truncate(self.device, self.size - 1)
+        with self.assertRaisesRegex(EVERIFYDEVICE, 'Device smaller than image'):
+            verify_device(['--bmap', self.bmap, self.device])
+    def test_error_bmap(self):
+        # Range checksum changed without updating BmapFileChecksum
+        content = read_file(self.bmap).decode()
+        start = content.index('chksum="') + len('chksum="')
+        content = content[:start] + ('0' if content[start] != '0' else '1') + content[start + 1:]
+        write_file(self.bmap, content.encode())
+        with self.assertRaisesRegex(EVERIFYDEVICE, 'BmapFileChecksum mismatch'):
+            verify_device(['--bmap', self.bmap, self.device])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import mmap
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from image_bmap import read_bmap
+from image_io import zero_buffer
+
+READ_SIZE = 8 * 1024 * 1024
+# Alignment of offsets, sizes and buffers for O_DIRECT
+DIRECT_ALIGNMENT = 4096
+
+# Zero ranges use the gpt-insert extent map format
+def read_zero_ranges(path):
+    with open(path, 'r') as f:
+        extent_map = json.load(f)
+    return [(offset, size) for offset, size in extent_map['extents']]
+
+class Reader:
+    def __init__(self, device, direct):
+        flags = os.O_RDONLY | os.O_CLOEXEC
+        if direct:
+            flags |= os.O_DIRECT
+        self.fd = os.open(device, flags)
+        self.direct = direct
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        if not direct:
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def close(self):
+        os.close(self.fd)
+
+    # Yield chunks of [offset, offset + size). With O_DIRECT reads are
+    # widened to aligned blocks and chunks trimmed to the requested range.
+    def chunks(self, offset, size):
+        # anonymous mmap is page aligned as required by O_DIRECT
+        buffer = mmap.mmap(-1, READ_SIZE)
+        view = memoryview(buffer)
+        try:
+            end = offset + size
+            position = offset - offset % DIRECT_ALIGNMENT if self.direct else offset
+            while position < end:
+                length = min(READ_SIZE, end - position)
+                if self.direct:
+                    length = min(READ_SIZE, -(-(end - position) // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT)
+                count = os.preadv(self.fd, [view[:length]], position)
+                if count <= 0:
+                    raise RuntimeError('Unexpected end of device at offset {}'.format(position))
+                start = max(offset - position, 0)
+                stop = min(count, end - position)
+                chunk = view[start:stop]
+                try:
+                    yield chunk
+                finally:
+                    # exported views must be released before closing buffer
+                    chunk.release()
+                position += count
+        finally:
+            view.release()
+            buffer.close()
+
+def check_range(reader, checksum_type, offset, size, chksum):
+    hasher = hashlib.new(checksum_type)
+    for chunk in reader.chunks(offset, size):
+        hasher.update(chunk)
+    return hasher.hexdigest() == chksum
+
+def check_zero(reader, offset, size):
+    zeros = zero_buffer()
+    return all(chunk == zeros[:len(chunk)] for chunk in reader.chunks(offset, size))
+
+def verify_device(device, bmap, zero_ranges, jobs, direct, debug):
+    reader = Reader(device, direct)
+    try:
+        if reader.size < bmap['image_size']:
+            raise RuntimeError('Device smaller than image: {} < {}'.format(reader.size, bmap['image_size']))
+        tasks = [('range', offset, size, chksum) for offset, size, chksum in bmap['ranges']]
+        tasks.extend(('zero', offset, size, None) for offset, size in zero_ranges)
+        # largest ranges first to keep workers busy until the end
+        tasks.sort(key=lambda task: task[2], reverse=True)
+
+        def run(task):
+            kind, offset, size, chksum = task
+            if kind == 'range':
+                ok = check_range(reader, bmap['checksum_type'], offset, size, chksum)
+            else:
+                ok = check_zero(reader, offset, size)
+            if debug:
+                print('{} {}+{}: {}'.format(kind, offset, size, 'OK' if ok else 'MISMATCH'))
+            return task, ok
+
+        with ThreadPoolExecutor(max_workers=jobs if jobs > 0 else None) as executor:
+            results = list(executor.map(run, tasks))
+    finally:
+        reader.close()
+
+    failed = sorted(task for task, ok in results if not ok)
+    for kind, offset, size, chksum in failed:
+        what = 'checksum mismatch' if kind == 'range' else 'not zero'
+        print('Range {}-{} b: {}'.format(offset, offset + size - 1, what))
+    mapped = sum(size for offset, size, chksum in bmap['ranges'])
+    zeros = sum(size for offset, size in zero_ranges)
+    print('Verified {} b mapped in {} ranges, {} b zero in {} ranges'.format(
+        mapped, len(bmap['ranges']), zeros, len(zero_ranges)))
+    return not failed
+
+def main():
+    parser = ArgumentParser(description='''Verify device content to bmap of image''',
+                                     epilog='''Return value:
+0 if device matches, 1 for mismatch or failure
+
+Each mapped range of the bmap is read from DEVICE and compared to the range
+checksum of the bmap. Unmapped ranges are not read unless listed by
+--zero-ranges, which are required to read as zero. The zero ranges file is in
+the extent map format of gpt-insert.
+
+Ranges are read in parallel, with --direct by O_DIRECT bypassing the page
+cache so data is read back from the device.
+''',
+                                     formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('DEVICE', help='Path to device or image')
+    parser.add_argument('--bmap', required=True, help='Path to bmap of image written to DEVICE')
+    parser.add_argument('--zero-ranges', help='Path to extent map of ranges required to be zero')
+    parser.add_argument('--jobs', type=int, default=8, help='Number of ranges read in parallel, default 8')
+    parser.add_argument('--direct', action='store_true', help='Read DEVICE with O_DIRECT')
+    parser.add_argument('--debug', action='store_true', help='Print result of each range')
+    args = parser.parse_args()
+
+    bmap = read_bmap(args.bmap)
+    zero_ranges = read_zero_ranges(args.zero_ranges) if args.zero_ranges else []
+    if verify_device(args.DEVICE, bmap, zero_ranges, args.jobs, args.direct, args.debug):
+        print('Valid!')
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Error: {}'.format(e))
+    sys.exit(1)